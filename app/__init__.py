@@ -22,10 +22,28 @@ try:
 except OSError:
     pass
 
-from . import query, annotations, videos
+from . import query, annotations, videos, frames, readiness
 app.register_blueprint(query.bp)
 app.register_blueprint(annotations.bp)
 app.register_blueprint(videos.bp)
+app.register_blueprint(frames.bp)
+app.register_blueprint(readiness.bp)
+
+from .utils import THUMBNAILS_PATH, FRAMES_PATH
+
+
+@app.template_global()
+def frame_url(frame_path):
+    """ URL of a frame, given by its path inside the frames folder, pointing to its thumbnail when it has one.
+    Frames that are not files, since they were packed, are served from the frame store. """
+    if os.path.exists(os.path.join(THUMBNAILS_PATH, frame_path)):
+        return url_for("static", filename="videofiles/thumbnails/" + frame_path)
+    if os.path.exists(os.path.join(FRAMES_PATH, frame_path)):
+        return url_for("static", filename="videofiles/frames/" + frame_path)
+
+    tier, video_id, annotation_id, frame_name = frame_path.rsplit("/", 3)
+    return url_for("frames.get_frame", tier=tier, video_id=video_id, annotation_id=annotation_id,
+                   frame_name=frame_name)
 
 
 # Redirect the root URL to "/query"
@@ -1,13 +1,11 @@
+import functools
 import json
 import os
-import torch
 from datetime import datetime as dt
 
 from flask import Blueprint, request, render_template, flash, url_for, redirect
 
 from .eaf_parser import eaf_parser
-from .embeddings import embeddings_processing
-from .frame_extraction import frames_processing
 from .utils import embedder, FACIAL_EXPRESSIONS_ID, ANNOTATIONS_PATH, opensearch, VIDEO_PATH
 from .opensearch.opensearch import gen_doc
 
@@ -15,20 +13,23 @@ bp = Blueprint('annotations', __name__)
 
 prev_page = ""
 
-is_gpu_available = False
 
-# Check if a gpu is available
-if torch.backends.mps.is_available():
-    is_gpu_available = True
-elif torch.cuda.is_available():
-    is_gpu_available = True
+@functools.lru_cache(maxsize=None)
+def gpu_available():
+    """ Check if a gpu is available, once, when an annotation is first edited instead of when the application starts """
+    import torch
 
-print("Annotations' Device: ", is_gpu_available, flush=True)
+    is_gpu_available = torch.backends.mps.is_available() or torch.cuda.is_available()
+    print("Annotations' Device: ", is_gpu_available, flush=True)
+    return is_gpu_available
 
 
 @bp.route("/edit_annotation/<video_id>/<annotation_id>", methods=("GET", "POST"))
 def edit_annotation(video_id, annotation_id):
     """ Edit an annotation """
+    # Imported when used: they load torch and start the object detector service, which the other pages don't need
+    from .embeddings import embeddings_processing
+    from .frame_extraction import frames_processing
 
     global prev_page
 
@@ -138,11 +139,11 @@ def edit_annotation(video_id, annotation_id):
             return render_template("annotations/edit_annotation.html", video=video_id, annotation_id=annotation_id,
                                    prev_page=prev_page, expression=new_expression, start_time=new_start_time,
                                    end_time=new_end_time, phrase=new_phrase, frame_rate=frame_rate,
-                                   is_gpu_available=is_gpu_available)
+                                   is_gpu_available=gpu_available())
 
     return render_template("annotations/edit_annotation.html", video=video_id, annotation_id=annotation_id,
                            prev_page=prev_page, expression=expression, start_time=start_time,
-                           end_time=end_time, phrase=phrase, frame_rate=frame_rate, is_gpu_available=is_gpu_available)
+                           end_time=end_time, phrase=phrase, frame_rate=frame_rate, is_gpu_available=gpu_available())
 
 
 @bp.route("/add_annotation/<video_id>", methods=("GET", "POST"))
@@ -231,10 +232,10 @@ def add_annotation(video_id):
             flash(f"Annotation with ID {new_annotation_id} already exists!", "danger")
 
         return render_template("annotations/add_annotations.html", video=video_id, prev_page=prev_page,
-                               annotation_id=next_annotation, frame_rate=frame_rate, is_gpu_available=is_gpu_available)
+                               annotation_id=next_annotation, frame_rate=frame_rate, is_gpu_available=gpu_available())
 
     return render_template("annotations/add_annotations.html", video=video_id, prev_page=prev_page,
-                           annotation_id=new_annotation_id, frame_rate=frame_rate, is_gpu_available=is_gpu_available)
+                           annotation_id=new_annotation_id, frame_rate=frame_rate, is_gpu_available=gpu_available())
 
 
 @bp.route("/update_user_rating", methods=["POST"])
@@ -263,6 +264,9 @@ def updated_user_rating():
 
 def update_embeddings_and_index(video_id, new_annotation_id, start_time, end_time):
     """ Update the frames, embeddings and index the new annotation """
+    from .embeddings import embeddings_processing
+    from .frame_extraction import frames_processing
+
     # Convert the start and end time from milliseconds to HH:MM:SS.MS format
     start_time = str(dt.utcfromtimestamp(start_time / 1000).strftime('%H:%M:%S.%f')[:-3])
     end_time = str(dt.utcfromtimestamp(end_time / 1000).strftime('%H:%M:%S.%f')[:-3])
@@ -281,12 +285,12 @@ def update_embeddings_and_index(video_id, new_annotation_id, start_time, end_tim
     doc = gen_doc(
         video_id=video_id,
         annotation_id=new_annotation_id,
-        base_frame_embedding=base_frame_embeddings[video_id][new_annotation_id].tolist(),
-        average_frame_embedding=average_frame_embeddings[video_id][new_annotation_id].tolist(),
-        best_frame_embedding=best_frame_embeddings[video_id][new_annotation_id].tolist(),
-        summed_frame_embeddings=summed_frame_embeddings[video_id][new_annotation_id].tolist(),
-        all_frames_embeddings=all_frame_embeddings[video_id][new_annotation_id].tolist(),
-        annotation_embedding=annotations_embeddings[video_id][new_annotation_id].tolist(),
+        base_frame_embedding=base_frame_embeddings.get(video_id, new_annotation_id).tolist(),
+        average_frame_embedding=average_frame_embeddings.get(video_id, new_annotation_id).tolist(),
+        best_frame_embedding=best_frame_embeddings.get(video_id, new_annotation_id).tolist(),
+        summed_frame_embeddings=summed_frame_embeddings.get(video_id, new_annotation_id).tolist(),
+        all_frames_embeddings=all_frame_embeddings.get(video_id, new_annotation_id).tolist(),
+        annotation_embedding=annotations_embeddings.get(video_id, new_annotation_id).tolist(),
     )
     opensearch.index_if_not_exists(doc)
 
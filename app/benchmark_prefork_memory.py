@@ -0,0 +1,87 @@
+""" Memory benchmark of the pre-fork server.
+
+Starts the gunicorn server configured by serve.py with the encoder loaded once by the master (SERVE_PRELOAD=1) and
+with the encoder loaded by each worker (SERVE_PRELOAD=0), waits for every worker to be ready and reports, for each
+process, its RSS, its PSS (its resident memory with the shared pages split among the processes sharing them) and its private memory.
+The PSS of all the processes together is the memory the server really takes.
+
+Usage: python -m app.benchmark_prefork_memory [workers]
+"""
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+WORKERS = 4
+BIND = "127.0.0.1:5099"
+READY_TIMEOUT = 600  # seconds
+
+
+def memory(pid):
+    """ Get the RSS, PSS and private memory of a process, in MB """
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == "kB":
+                values[fields[0].rstrip(":")] = int(fields[1]) / 1024
+    return values["Rss"], values["Pss"], values["Private_Clean"] + values["Private_Dirty"]
+
+
+def children(pid):
+    """ Get the pids of the child processes of a process """
+    with open(f"/proc/{pid}/task/{pid}/children", "r") as f:
+        return [int(child) for child in f.read().split()]
+
+
+def wait_ready(server, workers):
+    """ Wait until the server has all its workers, answers /ready and the memory of its processes stopped growing
+        (/ready is answered by a single worker, the others may still be loading their encoder) """
+    start = time.time()
+    previous_rss = None
+    while time.time() - start < READY_TIMEOUT:
+        if server.poll() is not None:
+            raise RuntimeError("The server stopped")
+        try:
+            with urllib.request.urlopen(f"http://{BIND}/ready", timeout=5) as response:
+                pids = children(server.pid)
+                if response.status == 200 and len(pids) == workers:
+                    rss = [memory(pid)[0] for pid in pids]
+                    if rss == previous_rss:
+                        return
+                    previous_rss = rss
+        except OSError:
+            pass
+        time.sleep(5)
+    raise TimeoutError("The server didn't get ready")
+
+
+def run(preload, workers):
+    env = dict(os.environ, SERVE_BIND=BIND, SERVE_WORKERS=str(workers), SERVE_PRELOAD="1" if preload else "0")
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "app/serve.py", "app:app"], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(server, workers)
+
+        print(f"SERVE_PRELOAD={int(preload)}, {workers} workers", flush=True)
+        total_pss = 0
+        for name, pid in [("master", server.pid)] + [(f"worker {i}", child)
+                                                      for i, child in enumerate(children(server.pid))]:
+            rss, pss, private = memory(pid)
+            total_pss += pss
+            print(f"  {name:10s} RSS {rss:8.1f} MB   PSS {pss:8.1f} MB   private {private:8.1f} MB", flush=True)
+        print(f"  total PSS {total_pss:8.1f} MB", flush=True)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+
+def main(workers):
+    run(True, workers)
+    run(False, workers)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else WORKERS)
@@ -0,0 +1,58 @@
+""" Benchmark of the startup of the web application.
+
+Starts the application in fresh processes, as the web server does (app/web.py), and reports how long importing it
+takes, how long until /ready reports the encoder as warm, and how long the first query embedding takes. Runs with the
+background warm up (WARMUP=1) and without it (WARMUP=0), where the encoder is loaded by the first query.
+
+Usage: python -m app.benchmark_startup [runs]
+"""
+import json
+import os
+import subprocess
+import sys
+
+RUNS = 3
+READY_TIMEOUT = 600  # seconds
+
+# Run in each process, prints the timings as JSON
+WORKER = """
+import json, time
+start = time.perf_counter()
+import app.web
+imported = time.perf_counter()
+
+client = app.app.test_client()
+ready = None
+while ready is None and time.perf_counter() - start < {timeout} and app.utils.WARMUP:
+    if client.get("/ready").status_code == 200:
+        ready = time.perf_counter()
+    else:
+        time.sleep(0.05)
+
+query_start = time.perf_counter()
+app.embeddings.embeddings_processing.generate_query_embeddings("expressão de surpresa", app.utils.embedder)
+query_end = time.perf_counter()
+
+print(json.dumps({{"import": imported - start, "ready": None if ready is None else ready - start,
+                   "first_query": query_end - query_start}}))
+"""
+
+
+def run_worker(warmup):
+    env = dict(os.environ, WARMUP="1" if warmup else "0")
+    output = subprocess.run([sys.executable, "-c", WORKER.format(timeout=READY_TIMEOUT)], env=env, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(runs):
+    for warmup in (True, False):
+        timings = [run_worker(warmup) for _ in range(runs)]
+        ready = [timing["ready"] for timing in timings if timing["ready"] is not None]
+        print(f"WARMUP={int(warmup)}  import {min(timing['import'] for timing in timings):7.2f}s   "
+              f"ready {min(ready) if ready else float('nan'):7.2f}s   "
+              f"first query {min(timing['first_query'] for timing in timings):7.2f}s   (best of {runs})", flush=True)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else RUNS)
@@ -6,10 +6,12 @@ import webvtt
 import xml.etree.ElementTree as ET
 
 from app.utils import ANNOTATIONS_PATH, CAPTIONS_PATH, EAF_PATH, VIDEO_PATH, FACIAL_EXPRESSIONS_ID_2, FACIAL_EXPRESSIONS_ID
+from app import preprocessing_manifest
 
 
 def parse_eaf_files():
-    """ Parses the eaf files and extracts the data from it """
+    """ Parses the eaf files and extracts the data from it.
+        An eaf file is parsed again when its contents changed since it was parsed. """
 
     # Create the annotations and captions directories if they don't exist
     if not os.path.exists(ANNOTATIONS_PATH):
@@ -21,7 +23,14 @@ def parse_eaf_files():
         videoname, extension = os.path.splitext(eaf)
         video_annotations_path = os.path.join(ANNOTATIONS_PATH, videoname + '.json')
 
-        if os.path.isfile(video_annotations_path) or extension != '.eaf':
+        if extension != '.eaf':
+            continue
+
+        eaf_fingerprint = {preprocessing_manifest.VIDEO_UNIT:
+                           preprocessing_manifest.file_fingerprint(os.path.join(EAF_PATH, eaf), content=True)}
+        if os.path.isfile(video_annotations_path) and (
+                preprocessing_manifest.adopt_units(videoname, preprocessing_manifest.STAGE_PARSE, eaf_fingerprint) or
+                not preprocessing_manifest.stale_units(videoname, preprocessing_manifest.STAGE_PARSE, eaf_fingerprint)):
             continue
 
         data_dict = {}
@@ -117,13 +126,37 @@ def parse_eaf_files():
                             expression_glosa['phrase'] = phrase['value']
                             break
 
+            # Keep the ratings given in the web application when the eaf file is parsed again
+            keep_user_ratings(data_dict, video_annotations_path)
+
             # Save the data dict as a json file
             with open(video_annotations_path, 'w') as f:
                 json.dump(data_dict, f)
+            preprocessing_manifest.mark_completed(videoname, preprocessing_manifest.STAGE_PARSE, eaf_fingerprint)
 
             generate_captions(data_dict['LP_P1 transcrição livre']['annotations'], videoname)
 
 
+def keep_user_ratings(data_dict, video_annotations_path):
+    """ Copy the user ratings of the previously parsed annotations to the same annotations in data_dict """
+    if not os.path.isfile(video_annotations_path):
+        return
+
+    with open(video_annotations_path, 'r') as f:
+        previous_data_dict = json.load(f)
+
+    for tier_id, tier in data_dict.items():
+        if tier_id not in previous_data_dict or not isinstance(tier, dict) or 'annotations' not in tier:
+            continue
+
+        user_ratings = {annotation['annotation_id']: annotation['user_rating']
+                        for annotation in previous_data_dict[tier_id].get('annotations', [])
+                        if 'user_rating' in annotation}
+        for annotation in tier['annotations']:
+            if annotation['annotation_id'] in user_ratings:
+                annotation['user_rating'] = user_ratings[annotation['annotation_id']]
+
+
 def generate_captions(phrases, videoname):
     """ Generates the captions in WebVTT format from the 'LP_P1 transcrição livre' annotations """
     vtt = webvtt.WebVTT()
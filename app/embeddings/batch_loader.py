@@ -0,0 +1,36 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+LOADER_THREAD_COUNT = 4  # threads decoding and preprocessing images, PIL and the transforms release the GIL
+PREFETCH_BATCHES = 2  # batches loaded ahead of the one being encoded
+
+
+def iter_batches(items, load, batch_size, thread_count=LOADER_THREAD_COUNT, prefetch=PREFETCH_BATCHES):
+    """ Load the items in batches in background threads, a few batches ahead of the one being used, so the next
+        images are decoded and preprocessed while the model encodes the current ones.
+        load(item) returns the loaded item, or None to leave it out. Yields ([items], [loaded items]) in order. """
+    items = list(items)
+
+    with ThreadPoolExecutor(max_workers=thread_count) as executor:
+        pending = deque()
+        for i in range(0, len(items), batch_size):
+            batch = items[i:i + batch_size]
+            pending.append((batch, [executor.submit(load, item) for item in batch]))
+
+            if len(pending) > prefetch:
+                yield collect_batch(*pending.popleft())
+
+        while pending:
+            yield collect_batch(*pending.popleft())
+
+
+def collect_batch(items, futures):
+    """ Wait for the items of a batch to be loaded, keeping the ones that were """
+    loaded_items = []
+    kept_items = []
+    for item, future in zip(items, futures):
+        loaded_item = future.result()
+        if loaded_item is not None:
+            kept_items.append(item)
+            loaded_items.append(loaded_item)
+    return kept_items, loaded_items
@@ -0,0 +1,49 @@
+""" Parity check between the PyTorch and the ONNX Runtime text encoders of CAPIVARA.
+
+Encodes the same texts with both backends and compares the embeddings with the cosine similarity. Exits with an error
+if the mean cosine is below MIN_MEAN_COSINE or any cosine is below MIN_COSINE.
+
+Usage: python -m app.embeddings.check_text_onnx_parity <texts_file, one text per line> [--quantize]
+"""
+import sys
+
+import torch
+
+from app.embeddings.encoders.capivara import CapivaraEncoder
+
+MIN_MEAN_COSINE = 0.99
+MIN_COSINE = 0.95
+BATCH_SIZE = 64
+
+
+def encode(encoder, texts):
+    embeddings = []
+    with torch.no_grad():
+        for i in range(0, len(texts), BATCH_SIZE):
+            embeddings.append(encoder.text_encode_batch(texts[i:i + BATCH_SIZE]).float())
+    return torch.cat(embeddings)
+
+
+def main(texts_path, quantize):
+    with open(texts_path, "r") as f:
+        texts = [line.strip().lower() for line in f if line.strip()]
+
+    torch_encoder = CapivaraEncoder("cpu")
+    torch_encoder.model.eval()
+    onnx_encoder = CapivaraEncoder("cpu", text_backend="onnx", text_quantize=quantize)
+
+    cosines = torch.nn.functional.cosine_similarity(encode(torch_encoder, texts), encode(onnx_encoder, texts))
+
+    print(f"{len(texts)} texts, quantized: {quantize}", flush=True)
+    print(f"Cosine mean: {cosines.mean().item():.4f}, min: {cosines.min().item():.4f}", flush=True)
+
+    if cosines.mean().item() < MIN_MEAN_COSINE or cosines.min().item() < MIN_COSINE:
+        print("ONNX text encoder is NOT in parity with the PyTorch one", flush=True)
+        for i in torch.argsort(cosines)[:5].tolist():
+            print(f"  {cosines[i].item():.4f} {texts[i]}", flush=True)
+        sys.exit(1)
+    print("ONNX text encoder is in parity with the PyTorch one", flush=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], "--quantize" in sys.argv[2:])
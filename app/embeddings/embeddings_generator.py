@@ -1,7 +1,19 @@
+import os
+
 import torch
 
-from app.embeddings.encoders.clip import ClipEncoder
-from app.embeddings.encoders.capivara import CapivaraEncoder
+PINNED_CACHE_FILE = ".pinned"  # written in the model cache once the models were loaded from it
+
+
+def use_model_cache(cache_dir):
+    """ Download the models from the Hugging Face hub to cache_dir. Once they were loaded from it the cache is pinned,
+    and the models are loaded offline, without asking the hub for newer versions. Must be called before the libraries
+    of the models (open_clip, transformers) are imported """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault("HF_HOME", cache_dir)
+    if os.path.exists(os.path.join(cache_dir, PINNED_CACHE_FILE)):
+        os.environ.setdefault("HF_HUB_OFFLINE", "1")
+        os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
 
 
 class Embedder:
@@ -9,9 +21,14 @@ class Embedder:
     Embedder class to encode text and image and generate its embeddings using one of two CLIP models:
     - clip-ViT-B-32: the image and text model CLIP from OpenAI
     - CAPIVARA: optimized for texts written in Portuguese
+    The texts can be encoded by the PyTorch model (text_backend="torch") or by its text tower exported to ONNX and
+    run on onnxruntime, on the CPU (text_backend="onnx"), optionally with its weights quantized to int8
     """
 
-    def __init__(self, check_gpu):
+    def __init__(self, check_gpu, text_backend="torch", text_quantize=False, text_intra_op_threads=0,
+                 model_cache_dir=None):
+        if model_cache_dir is not None:
+            use_model_cache(model_cache_dir)
 
         if check_gpu:
             # Check if a GPU is available and if so, move the model to the GPU
@@ -26,13 +43,48 @@ class Embedder:
 
         print("Embedder's Device: ", self.device, flush=True)
 
-        # Select the model to be used
-        self.encoder = CapivaraEncoder(self.device)
+        # Select the model to be used, the encoders are imported here as their libraries take long to import
+        from app.embeddings.encoders.capivara import CapivaraEncoder
+        self.encoder = CapivaraEncoder(self.device, text_backend, text_quantize, text_intra_op_threads)
+
+        if model_cache_dir is not None:
+            open(os.path.join(model_cache_dir, PINNED_CACHE_FILE), "w").close()
+
+    @property
+    def model_id(self):
+        """ Identifier of the selected model """
+        return self.encoder.model_id
+
+    @property
+    def text_model_id(self):
+        """ Identifier of the model encoding the texts, which differs from model_id with the ONNX text backend """
+        return self.encoder.text_model_id
 
     def text_encode(self, text):
         """ Encode text and generate its embeddings  using the selected model """
         return self.encoder.text_encode(text)
 
     def image_encode(self, path):
-        """ Encode image and generate its embeddings using the selected model """
+        """ Encode image, given as a path or an image, and generate its embeddings using the selected model """
         return self.encoder.image_encode(path)
+
+    def text_encode_batch(self, texts):
+        """ Encode a list of texts at once using the selected model, returning their embeddings as rows """
+        return self.encoder.text_encode_batch(texts)
+
+    def image_encode_batch(self, images, preprocessed=False):
+        """ Encode a list of images, given as paths or images, or as returned by preprocess_image if preprocessed,
+        at once using the selected model, returning their embeddings as rows """
+        return self.encoder.image_encode_batch(images, preprocessed)
+
+    def freeze(self):
+        """ Make the model inference only, with its weights in shared memory, before forking processes that use it """
+        self.encoder.freeze()
+
+    def after_fork(self):
+        """ Prepare the model to be used in a process forked after it was loaded """
+        self.encoder.after_fork()
+
+    def preprocess_image(self, path):
+        """ Open and prepare an image to be encoded by image_encode_batch, without using the model """
+        return self.encoder.preprocess_image(path)
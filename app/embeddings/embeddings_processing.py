@@ -1,19 +1,26 @@
 import io
 import json
 
-import numpy as np
 import torch
-from torch.cuda import amp
-from torch.utils import checkpoint
 
 from .embeddings_generator import Embedder
+from . import batch_loader, frame_embeddings_store, vector_store
+from .query_cache import query_cache
 import os
-import pickle
 import gc
 
-from ..utils import FACIAL_EXPRESSIONS_FRAMES_DIR, ANNOTATIONS_PATH, FACIAL_EXPRESSIONS_ID, \
-    CPU_Unpickler, BASE_FRAMES_EMBEDDINGS_FILE, AVERAGE_FRAMES_EMBEDDINGS_FILE, BEST_FRAMES_EMBEDDINGS_FILE, \
-    SUMMED_FRAMES_EMBEDDINGS_FILE, ANNOTATIONS_EMBEDDINGS_FILE, ALL_FRAMES_EMBEDDINGS_FILE
+from ..utils import FACIAL_EXPRESSIONS_FRAMES_DIR, ANNOTATIONS_PATH, VIDEO_PATH, FACIAL_EXPRESSIONS_ID, \
+    ENCODE_BATCH_SIZE
+from ..frame_extraction import frame_dedup, frame_store, frames_manifest
+from .. import preprocessing_manifest
+
+FRAMES_CHUNK_SIZE = 1024  # frames whose embeddings are held at once while generating the embeddings of a video
+GLOSSES_BATCH_SIZE = 256  # glosses encoded at once, texts are short so their batches can be larger than the frames'
+
+# Stores of the embeddings generated from the facial expressions frames
+FRAMES_EMBEDDINGS_STORES = [vector_store.BASE_FRAMES_EMBEDDINGS, vector_store.AVERAGE_FRAMES_EMBEDDINGS,
+                            vector_store.BEST_FRAMES_EMBEDDINGS, vector_store.SUMMED_FRAMES_EMBEDDINGS,
+                            vector_store.ALL_FRAMES_EMBEDDINGS]
 
 
 def generate_video_embeddings():
@@ -22,339 +29,408 @@ def generate_video_embeddings():
     # Initialize the Embeddings Generator using the GPU
     embedder = Embedder(check_gpu=True)
 
-    generate_frame_embeddings(embedder)
-    print("Frame embeddings generated", flush=True)
-
-    generate_average_and_best_frame_embeddings(embedder)
-    print("Average and best frame embeddings generated", flush=True)
-
-    generate_summed_embeddings()
-    print("Summed embeddings generated", flush=True)
+    # The base, average, best, summed and all frames embeddings are generated together, encoding each frame once
+    embeddings = load_frames_embeddings()
+    for video in os.listdir(FACIAL_EXPRESSIONS_FRAMES_DIR):
+        if video.startswith('.') or all(video in video_embeddings for video_embeddings in embeddings):
+            continue
 
-    generate_all_frames_embeddings(embedder)
-    print("All frames embeddings generated", flush=True)
+        save_video_frames_embeddings(embeddings, video, generate_video_frames_embeddings(video, embedder))
+        gc.collect()
+    print("Frame embeddings generated", flush=True)
 
     generate_annotations_embeddings(embedder)
     print("Annotations embeddings generated", flush=True)
 
 
-def generate_frame_embeddings(eb: Embedder):
-    """ Generates facial expression frame embeddings for a folder of videos, choosing 4 frames
-    equally spaced for each video. """
-    print("Generating frame embeddings", flush=True)
+def generate_streamed_video_embeddings():
+    """ Generates the facial expression frame embeddings while the frames are decoded and cropped in memory,
+    instead of reading back the extracted frames of each video from disk """
+    from ..frame_extraction import frames_processing
 
-    embeddings = {}
-    annotations_batch_size = 16
-    if os.path.exists(BASE_FRAMES_EMBEDDINGS_FILE):
-        with open(BASE_FRAMES_EMBEDDINGS_FILE, 'rb') as f:
-            embeddings = pickle.load(f)
+    embedder = Embedder(check_gpu=True)
+    embeddings = load_frames_embeddings()
 
-    for video in os.listdir(FACIAL_EXPRESSIONS_FRAMES_DIR):
-        video_dir = os.path.join(FACIAL_EXPRESSIONS_FRAMES_DIR, video)
-        annotations_dir = os.listdir(video_dir)
+    for video in os.listdir(VIDEO_PATH):
+        video_name, _ = os.path.splitext(video)
+        video_path = os.path.join(VIDEO_PATH, video)
+        annotation_path = os.path.join(ANNOTATIONS_PATH, f"{video_name}.json")
+        video_facial_expressions_dir = os.path.join(FACIAL_EXPRESSIONS_FRAMES_DIR, video_name)
 
-        if video in embeddings or len(annotations_dir) == 0 or video.startswith('.'):
+        if video.startswith('.') or not os.path.exists(annotation_path):
             continue
 
-        embeddings[video] = {}
-        print(f"Working on {video}", flush=True)
-
-        for i in range(0, len(annotations_dir), annotations_batch_size):
-            annotations_batch = annotations_dir[i:i + annotations_batch_size]
-            for annotation in annotations_batch:
-                with torch.no_grad():  # Avoid storing computations for gradient calculation
-                    annotation_embedding = generate_annotation_frame_embeddings(video, annotation, eb)
-                embeddings[video][annotation] = annotation_embedding
-
-                del annotation_embedding
-                torch.cuda.empty_cache()
-
-            with open(BASE_FRAMES_EMBEDDINGS_FILE, 'wb') as f:
-                pickle.dump(embeddings, f)
-            gc.collect()
-
-    torch.cuda.empty_cache()  # Final cache clear
-
-
-def generate_average_and_best_frame_embeddings(eb: Embedder):
-    """ Generates the average and best facial expression frame embeddings of a video for a folder of videos """
-    print("Generating average and best frame embeddings", flush=True)
-
-    annotations_batch_size = 4
-    average_embeddings = {}
-    best_embeddings = {}
+        stale_annotations, fingerprints = stale_streamed_annotations(video_path, annotation_path, embedder,
+                                                                     embeddings)
+        if not stale_annotations:
+            continue
 
-    if os.path.exists(AVERAGE_FRAMES_EMBEDDINGS_FILE):
-        with open(AVERAGE_FRAMES_EMBEDDINGS_FILE, 'rb') as f:
-            average_embeddings = pickle.load(f)
+        os.makedirs(video_facial_expressions_dir, exist_ok=True)
+        # The frames of partially pre-processed annotations are replaced
+        for annotation_id in stale_annotations:
+            frames_processing.delete_frames(video_name, annotation_id)
 
-    if os.path.exists(BEST_FRAMES_EMBEDDINGS_FILE):
-        with open(BEST_FRAMES_EMBEDDINGS_FILE, 'rb') as f:
-            best_embeddings = pickle.load(f)
+        video_embeddings = ({}, {}, {}, {}, {})
+        frames_rows = {}
+        print(f"Working on {video_name}", flush=True)
 
-    for video in os.listdir(FACIAL_EXPRESSIONS_FRAMES_DIR):
-        video_dir = os.path.join(FACIAL_EXPRESSIONS_FRAMES_DIR, video)
-        annotations_dir = os.listdir(video_dir)
+        for annotation_id, frames, weights in frames_processing.stream_facial_expressions_frames(
+                video_path, video_facial_expressions_dir, annotation_path, stale_annotations):
+            frame_embeddings = []
+            with torch.no_grad():  # Avoid storing computations for gradient calculation
+                for i in range(0, len(frames), ENCODE_BATCH_SIZE):
+                    frame_embeddings.extend(embedder.image_encode_batch(frames[i:i + ENCODE_BATCH_SIZE]))
 
-        if video in average_embeddings and video in best_embeddings:
-            continue
-
-        if len(annotations_dir) == 0 or video.startswith('.'):
-            continue
+            for annotations_embeddings, embedding in zip(video_embeddings,
+                                                         aggregate_frame_embeddings(frame_embeddings, weights=weights)):
+                annotations_embeddings[annotation_id] = embedding
+            frames_rows[annotation_id] = (stack_frames_rows(frame_embeddings), weights or [1] * len(frame_embeddings))
 
-        average_embeddings[video] = {}
-        best_embeddings[video] = {}
-        print(f"Working on {video}", flush=True)
+            del frame_embeddings
+            torch.cuda.empty_cache()
 
-        for i in range(0, len(annotations_dir), annotations_batch_size):
-            annotations_batch = annotations_dir[i:i + annotations_batch_size]
-            for annotation in annotations_batch:
-                average_embedding, best_embedding = (
-                    generate_annotation_average_and_best_frame_embeddings(video, annotation, eb))
-                average_embeddings[video][annotation] = average_embedding
-                best_embeddings[video][annotation] = best_embedding
-                del best_embedding
-                torch.cuda.empty_cache()
+        frame_embeddings_store.save_annotations(video_name, frames_rows, embedder.model_id)
+        save_video_frames_embeddings(embeddings, video_name, video_embeddings, frames_rows)
 
-            with open(AVERAGE_FRAMES_EMBEDDINGS_FILE, 'wb') as f:
-                pickle.dump(average_embeddings, f)
+        # Recorded once the embeddings are saved, so they are generated again if the pre-processing stops before.
+        # Streaming extracts, crops and encodes an annotation at once, so it finishes the three stages together.
+        for stage in preprocessing_manifest.FACIAL_EXPRESSIONS_STAGES:
+            preprocessing_manifest.mark_completed(video_name, stage, {annotation_id: fingerprints[stage][annotation_id]
+                                                                      for annotation_id in frames_rows})
+        gc.collect()
 
-            with open(BEST_FRAMES_EMBEDDINGS_FILE, 'wb') as f:
-                pickle.dump(best_embeddings, f)
-
-            gc.collect()
+    print("Frame embeddings generated", flush=True)
 
+    generate_annotations_embeddings(embedder)
+    print("Annotations embeddings generated", flush=True)
 
-def generate_summed_embeddings():
-    """ Generate the summed embeddings for all the facial expressions annotations' values """
-    print("Generating summed embeddings", flush=True)
 
-    # Load embeddings
-    with open(BASE_FRAMES_EMBEDDINGS_FILE, 'rb') as f:
-        base_embeddings = pickle.load(f)
-    with open(AVERAGE_FRAMES_EMBEDDINGS_FILE, 'rb') as f:
-        average_embeddings = pickle.load(f)
-    with open(BEST_FRAMES_EMBEDDINGS_FILE, 'rb') as f:
-        best_embeddings = pickle.load(f)
+def stale_streamed_annotations(video_path, annotation_path, eb: Embedder, embeddings):
+    """ Get the facial expressions annotations of a video whose streaming didn't finish with the same inputs, and the
+    fingerprints of all its annotations as {stage: {annotation_id: fingerprint}} (see preprocessing_manifest) """
+    video_id, _ = os.path.splitext(os.path.basename(video_path))
+    with open(annotation_path, "r") as f:
+        facial_expressions = json.load(f).get(FACIAL_EXPRESSIONS_ID, {}).get("annotations", [])
+
+    video_fingerprint = preprocessing_manifest.file_fingerprint(video_path)
+    extract_fingerprints = {expression["annotation_id"]: preprocessing_manifest.extract_fingerprint(video_fingerprint,
+                                                                                                    expression)
+                            for expression in facial_expressions}
+    embed_fingerprints = {annotation_id: preprocessing_manifest.embed_fingerprint(fingerprint, eb.model_id)
+                          for annotation_id, fingerprint in extract_fingerprints.items()}
+    fingerprints = {preprocessing_manifest.STAGE_EXTRACT: extract_fingerprints,
+                    preprocessing_manifest.STAGE_CROP: extract_fingerprints,
+                    preprocessing_manifest.STAGE_EMBED: embed_fingerprints}
+
+    # Videos streamed before the completion records existed were finished if they have their embeddings
+    if os.path.isdir(os.path.join(FACIAL_EXPRESSIONS_FRAMES_DIR, video_id)) and \
+            all(video_id in video_embeddings for video_embeddings in embeddings):
+        for stage, stage_fingerprints in fingerprints.items():
+            preprocessing_manifest.adopt_units(video_id, stage, stage_fingerprints)
+    for stage in preprocessing_manifest.FACIAL_EXPRESSIONS_STAGES:
+        preprocessing_manifest.start_stage(video_id, stage)
+
+    stale_annotations = set()
+    for stage, stage_fingerprints in fingerprints.items():
+        stale_annotations.update(preprocessing_manifest.stale_units(video_id, stage, stage_fingerprints))
+    return stale_annotations, fingerprints
+
+
+def generate_video_frames_embeddings(video_id, eb: Embedder, annotation_ids=None):
+    """ Generate the base, average, best, summed and all frames embeddings of the facial expressions of one video,
+    or of the ones in annotation_ids, returned in that order as {annotation_id: embedding} dicts.
+    The annotations are processed in chunks of about FRAMES_CHUNK_SIZE frames, each frame being encoded once, and
+    the embeddings of every frame are kept in the frame embeddings store """
+    base_embeddings, average_embeddings, best_embeddings, summed_embeddings, all_embeddings = {}, {}, {}, {}, {}
+
+    print(f"Working on {video_id}", flush=True)
+
+    annotations_frames = frames_manifest.list_annotations_frames(video_id)
+    if annotation_ids is None:
+        annotation_ids = list(annotations_frames)
+
+    chunks = [{}]
+    chunk_size = 0
+    for annotation_id in annotation_ids:
+        if chunk_size >= FRAMES_CHUNK_SIZE:
+            chunks.append({})
+            chunk_size = 0
+        chunks[-1][annotation_id] = annotations_frames.get(annotation_id, ([], None))
+        chunk_size += len(chunks[-1][annotation_id][0])
+
+    frames_rows = {}
+    for chunk in chunks:
+        for annotation_id, (base, average, best, summed, all_frames) in \
+                generate_annotations_frames_embeddings(video_id, chunk, eb, frames_rows).items():
+            base_embeddings[annotation_id] = base
+            average_embeddings[annotation_id] = average
+            best_embeddings[annotation_id] = best
+            all_embeddings[annotation_id] = all_frames
+
+            if summed is not None:
+                summed_embeddings[annotation_id] = summed
+
+        torch.cuda.empty_cache()
+
+    frame_embeddings_store.save_annotations(video_id, frames_rows, eb.model_id)
+
+    return base_embeddings, average_embeddings, best_embeddings, summed_embeddings, all_embeddings
+
+
+def generate_annotations_frames_embeddings(video_id, annotations_frames, eb: Embedder, frames_rows=None):
+    """ Generate the base, average, best, summed and all frames embeddings of some facial expressions of a video,
+    given as {annotation_id: ([frame names], [frame weights] or None)}.
+    The frames of all the annotations are encoded once, in batches that span annotations, and the embeddings of each
+    annotation are reductions of the matrix of its frames' embeddings (see aggregate_frame_embeddings).
+    The streamed annotations only stored their display frames, so their frames are streamed again instead (see
+    generate_streamed_annotations_frames_embeddings).
+    Returns {annotation_id: (base, average, best, summed, all frames embedding)}, on the CPU. The embeddings of the
+    frames are added to frames_rows, if given, as {annotation_id: (float16 array, [frame weights])} """
+    streamed_annotations = frames_manifest.list_streamed_annotations(video_id)
+    embeddings = generate_streamed_annotations_frames_embeddings(
+        video_id, [annotation_id for annotation_id in annotations_frames if annotation_id in streamed_annotations],
+        eb, frames_rows)
+    annotations_frames = {annotation_id: annotation_frames for annotation_id, annotation_frames in
+                          annotations_frames.items() if annotation_id not in streamed_annotations}
+
+    frames_embeddings = encode_frames([(video_id, annotation_id, frame)
+                                       for annotation_id, (frames, _) in annotations_frames.items()
+                                       for frame in frames], eb)
+
+    for annotation_id, (frames, weights) in annotations_frames.items():
+        # Deduplicated frames count as many times as the frames they stand for
+        weights = weights or [1] * len(frames)
+
+        annotation_embeddings = []
+        annotation_weights = []
+        for frame, weight in zip(frames, weights):
+            if (video_id, annotation_id, frame) in frames_embeddings:
+                annotation_embeddings.append(frames_embeddings[(video_id, annotation_id, frame)])
+                annotation_weights.append(weight)
+
+        embeddings[annotation_id] = tuple(None if embedding is None else embedding.cpu() for embedding in
+                                          aggregate_frame_embeddings(annotation_embeddings, weights=annotation_weights))
+        if frames_rows is not None:
+            frames_rows[annotation_id] = (stack_frames_rows(annotation_embeddings), annotation_weights)
+
+    return embeddings
+
+
+def generate_streamed_annotations_frames_embeddings(video_id, annotation_ids, eb: Embedder, frames_rows=None):
+    """ Generate the embeddings of some streamed facial expressions of a video from all the frames kept while they
+    were streamed, decoding and cropping them in memory again. Returns them as generate_annotations_frames_embeddings
+    does """
+    if not annotation_ids:
+        return {}
+    from ..frame_extraction import frames_processing
+
+    embeddings = {annotation_id: (None, None, None, None, None) for annotation_id in annotation_ids}
+    for annotation_id, frames, weights in frames_processing.restream_facial_expressions_frames(video_id,
+                                                                                              annotation_ids):
+        frame_embeddings = []
+        with torch.no_grad():  # Avoid storing computations for gradient calculation
+            for i in range(0, len(frames), ENCODE_BATCH_SIZE):
+                frame_embeddings.extend(eb.image_encode_batch(frames[i:i + ENCODE_BATCH_SIZE]))
 
-    summed_embeddings = {}
-    if os.path.exists(SUMMED_FRAMES_EMBEDDINGS_FILE):
-        with open(SUMMED_FRAMES_EMBEDDINGS_FILE, 'rb') as f:
-            summed_embeddings = pickle.load(f)
+        embeddings[annotation_id] = tuple(None if embedding is None else embedding.cpu() for embedding in
+                                          aggregate_frame_embeddings(frame_embeddings, weights=weights))
+        if frames_rows is not None:
+            frames_rows[annotation_id] = (stack_frames_rows(frame_embeddings), weights or [1] * len(frame_embeddings))
 
-    for video, annotations in base_embeddings.items():
+    return embeddings
 
-        if video in summed_embeddings or video not in base_embeddings:
-            continue
 
-        summed_embeddings[video] = {}
+def stack_frames_rows(frame_embeddings):
+    """ Stack the embeddings of the frames of an annotation into the float16 rows kept in the frame embeddings store """
+    if not frame_embeddings:
+        return []
+    return torch.stack(frame_embeddings).to(torch.float16).cpu().numpy()
 
-        print(f"Working on {video}", flush=True)
 
-        for annotation_id, base_emb in annotations.items():
-            # Ensure the annotation exists in all embeddings
-            if video in average_embeddings and annotation_id in average_embeddings[video] and \
-                    video in best_embeddings and annotation_id in best_embeddings[video]:
-                # Sum the embeddings
-                summed_emb = base_emb + average_embeddings[video][annotation_id] + best_embeddings[video][annotation_id]
-                summed_embeddings[video][annotation_id] = summed_emb
+def load_frames_embeddings():
+    """ Open the stores of the base, average, best, summed and all frames embeddings """
+    return [vector_store.open_store(name) for name in FRAMES_EMBEDDINGS_STORES]
 
-    # Save the summed embeddings
-    with open(SUMMED_FRAMES_EMBEDDINGS_FILE, 'wb') as f:
-        pickle.dump(summed_embeddings, f)
 
+def save_video_frames_embeddings(embeddings, video_id, video_embeddings, annotation_ids=None):
+    """ Save the base, average, best, summed and all frames embeddings of a video, given as {annotation_id: embedding}
+    dicts, to the stores load_frames_embeddings returns, in the same order. The annotations in annotation_ids (by
+    default, the ones in the dicts) without an embedding have their stored embedding deleted """
+    for store, annotations_embeddings in zip(embeddings, video_embeddings):
+        saved_annotation_ids = annotation_ids if annotation_ids is not None else annotations_embeddings
+        store.put_many({(video_id, annotation_id): annotations_embeddings[annotation_id]
+                        for annotation_id in saved_annotation_ids
+                        if annotations_embeddings.get(annotation_id) is not None})
+        store.delete_many([(video_id, annotation_id) for annotation_id in saved_annotation_ids
+                           if annotations_embeddings.get(annotation_id) is None])
 
-def generate_all_frames_embeddings(eb: Embedder):
-    """ Generate the embeddings for all the facial expressions frames """
-    print("Generating all frames embeddings", flush=True)
 
-    embeddings = {}
+def aggregate_frame_embeddings(frame_embeddings, n_embeddings=4, weights=None):
+    """ Get the base, average, best, summed and all frames embeddings of an annotation from the embeddings of its
+    frames, in time order, with vectorized reductions over the matrix of the frames' embeddings.
+    Deduplicated frames count as many times as their weight, the number of frames they stand for """
+    if not frame_embeddings:
+        return None, None, None, None, None
 
-    if os.path.exists(ALL_FRAMES_EMBEDDINGS_FILE):
-        with open(ALL_FRAMES_EMBEDDINGS_FILE, 'rb') as f:
-            embeddings = pickle.load(f)
+    frame_embeddings = torch.stack(frame_embeddings)
+    if not weights:
+        weights = [1] * len(frame_embeddings)
 
-    for video in os.listdir(FACIAL_EXPRESSIONS_FRAMES_DIR):
-        video_dir = os.path.join(FACIAL_EXPRESSIONS_FRAMES_DIR, video)
-        annotations_dir = os.listdir(video_dir)
+    # Select #n_embeddings frames for the base embedding, among all the frames the deduplicated ones stand for
+    frames_indexes = frame_dedup.expand_weights(range(len(frame_embeddings)), weights)
+    if len(frames_indexes) <= n_embeddings:
+        step_size = 1
+    else:
+        step_size = (len(frames_indexes) - 1) // n_embeddings + 1
+    base_embedding = frame_embeddings[frames_indexes[::step_size][:n_embeddings]].sum(dim=0)
 
-        if video in embeddings or len(annotations_dir) == 0 or video.startswith('.'):
-            continue
+    frames_weights = torch.tensor(weights, dtype=frame_embeddings.dtype, device=frame_embeddings.device)
+    all_frames_embedding = (frame_embeddings * frames_weights.unsqueeze(1)).sum(dim=0)
+    average_embedding = all_frames_embedding / frames_weights.sum()
 
-        embeddings[video] = {}
-        print(f"Working on {video}", flush=True)
+    # The higher the norm, more intense and distinct the expression is, the better the embedding
+    best_embedding = frame_embeddings[torch.argmax(torch.linalg.norm(frame_embeddings, dim=1))]
 
-        for annotation in annotations_dir:
-            embeddings[video][annotation] = generate_annotation_all_frames_embeddings(video, annotation, eb)
-            torch.cuda.empty_cache()  # Clear GPU cache after each annotation
+    summed_embedding = base_embedding + average_embedding + best_embedding
 
-    with open(ALL_FRAMES_EMBEDDINGS_FILE, 'wb') as f:
-        pickle.dump(embeddings, f)
+    return base_embedding, average_embedding, best_embedding, summed_embedding, all_frames_embedding
 
 
 def generate_annotations_embeddings(eb: Embedder):
-    """ Generate the embeddings for all the facial expressions annotations' values """
+    """ Generate the embeddings for all the facial expressions annotations' values.
+    Only the annotations whose value or model changed since their embedding was generated are encoded again, and
+    each distinct gloss of the corpus is encoded once (see encode_glosses) """
     print("Generating annotations embeddings", flush=True)
 
-    embeddings = {}
+    embeddings = vector_store.open_store(vector_store.ANNOTATIONS_EMBEDDINGS)
 
-    if os.path.exists(ANNOTATIONS_EMBEDDINGS_FILE):
-        with open(ANNOTATIONS_EMBEDDINGS_FILE, 'rb') as f:
-            embeddings = pickle.load(f)
+    # The stale annotations of every video, as {video_name: (fingerprints, {annotation_id: gloss})}
+    stale_videos = {}
 
     for video_annotations in os.listdir(ANNOTATIONS_PATH):
 
         video_name = video_annotations.split(".")[0]
 
-        if video_name in embeddings or video_annotations.startswith('.'):
+        if video_annotations.startswith('.'):
             continue
 
-        print(f"Working on {video_annotations}", flush=True)
-
         annotation_json = os.path.join(ANNOTATIONS_PATH, video_annotations)
 
-        embeddings[video_name] = {}
-
         with open(annotation_json, 'r') as f:
             annotations = json.load(f)
 
-            if FACIAL_EXPRESSIONS_ID not in annotations:
-                continue
-
-            expressions = annotations[FACIAL_EXPRESSIONS_ID]["annotations"]
-
-            for expression in expressions:
-                annotation_id = expression["annotation_id"]
-                annotation_value = expression["value"]
-
-                if annotation_value is not None:
-                    embeddings[video_name][annotation_id] = eb.text_encode(annotation_value.lower())
-                else:
-                    embeddings[video_name][annotation_id] = torch.zeros(512)
-
-    with open(ANNOTATIONS_EMBEDDINGS_FILE, 'wb') as f:
-        pickle.dump(embeddings, f)
-
-
-def generate_query_embeddings(query_input, eb: Embedder):
-    """ Generate the user queries embeddings """
-    return eb.text_encode(query_input.lower())
-
-
-def generate_annotation_frame_embeddings(video_id, annotation_id, eb: Embedder):
-    """ Generate facial expression frame embeddings for a specific annotation of a video, choosing 4 frames """
-    n_embeddings = 4
-
-    video_dir = os.path.join(FACIAL_EXPRESSIONS_FRAMES_DIR, video_id)
-    expression_frames_dir = os.path.join(video_dir, annotation_id)
-    annotation_embedding = None
-
-    all_frames = os.listdir(expression_frames_dir)
-
-    # Select #n_embeddings frames to generate embeddings
-    if len(all_frames) <= n_embeddings:
-        step_size = 1
-    else:
-        # Calculate the step size
-        step_size = (len(all_frames) - 1) // n_embeddings + 1
+        if FACIAL_EXPRESSIONS_ID not in annotations:
+            continue
 
-    frames_to_encode = all_frames[::step_size]
-    frames_to_encode = frames_to_encode[:n_embeddings]
+        expressions = annotations[FACIAL_EXPRESSIONS_ID]["annotations"]
+        fingerprints = {expression["annotation_id"]: preprocessing_manifest.fingerprint(expression["value"],
+                                                                                       eb.text_model_id)
+                        for expression in expressions}
 
-    for frame in frames_to_encode:
-        full_path = os.path.abspath(os.path.join(expression_frames_dir, frame))
+        # Embeddings generated before the completion records existed are kept
+        if video_name in embeddings:
+            preprocessing_manifest.adopt_units(video_name, preprocessing_manifest.STAGE_GLOSSES, fingerprints)
+        stale_annotations = set(preprocessing_manifest.stale_units(video_name, preprocessing_manifest.STAGE_GLOSSES,
+                                                                   fingerprints))
 
-        if not os.path.isfile(full_path):
+        if video_name in embeddings and not stale_annotations:
             continue
 
-        # Initialize embeddings[video][annotation] as a zero tensor if it's not already initialized
-        if annotation_embedding is None:
-            annotation_embedding = torch.zeros_like(eb.image_encode(full_path))
+        if video_name in embeddings:
+            embeddings.delete_many([(video_name, annotation_id)
+                                    for annotation_id in set(embeddings[video_name]) - set(fingerprints)])
 
-        # generate embedding and sum it to the total embedding
-        annotation_embedding += eb.image_encode(full_path)
+        stale_videos[video_name] = (fingerprints, {expression["annotation_id"]: normalize_gloss(expression["value"])
+                                                   for expression in expressions
+                                                   if expression["annotation_id"] in stale_annotations})
 
-    return annotation_embedding
+    glosses_embeddings = encode_glosses({gloss for _, glosses in stale_videos.values() for gloss in glosses.values()
+                                         if gloss is not None}, eb)
 
+    for video_name, (fingerprints, glosses) in stale_videos.items():
+        print(f"Working on {video_name}", flush=True)
 
-def generate_annotation_average_and_best_frame_embeddings(video_id, annotation_id, eb: Embedder):
-    """ Generate the average and best facial expression frame embeddings for a specific annotation of a video """
-    video_dir = os.path.join(FACIAL_EXPRESSIONS_FRAMES_DIR, video_id)
-    expression_frames_dir = os.path.join(video_dir, annotation_id)
-    total_embedding = None
-    average_embedding = None
-    best_embedding = None
-    best_score = -1
-    frame_count = 0
+        embeddings.put_many({(video_name, annotation_id):
+                             torch.zeros(512) if gloss is None else glosses_embeddings[gloss]
+                             for annotation_id, gloss in glosses.items()})
 
-    for frame in os.listdir(expression_frames_dir):
-        full_path = os.path.abspath(os.path.join(expression_frames_dir, frame))
+        # Recorded once the embeddings are saved, so they are generated again if the pre-processing stops before
+        preprocessing_manifest.mark_completed(video_name, preprocessing_manifest.STAGE_GLOSSES,
+                                              {annotation_id: fingerprints[annotation_id] for annotation_id in glosses})
 
-        if not os.path.isfile(full_path):
-            continue
 
-        with torch.no_grad():  # Avoid storing computations for gradient calculation
-            current_embedding = eb.image_encode(full_path)
+def normalize_gloss(annotation_value):
+    """ Get the text encoded for an annotation's value (or a query), or None if it has no value """
+    return None if annotation_value is None else annotation_value.lower()
 
-        # calculate score based on the norm (or length) of the embedding vector
-        # the higher the norm, more intense and distinct the expression is, the better the embedding
-        current_score = np.linalg.norm(current_embedding.detach().cpu().numpy())
 
-        if current_score > best_score:
-            best_score = current_score
-            best_embedding = current_embedding
+def encode_glosses(glosses, eb: Embedder):
+    """ Get the embeddings of normalized glosses, given as a set. The glosses are kept in a gloss table, by text model
+    (see Embedder.text_model_id), so only the ones never encoded by the model before are encoded, in batches, and
+    added to it.
+    Returns {gloss: embedding} """
+    glosses_table = vector_store.open_store(vector_store.GLOSSES_EMBEDDINGS)
 
-        if total_embedding is None:
-            total_embedding = current_embedding
+    embeddings = {}
+    missing_glosses = {}
+    for gloss in glosses:
+        embedding = glosses_table.get(eb.text_model_id, gloss)
+        if embedding is not None:
+            embeddings[gloss] = embedding
         else:
-            total_embedding += current_embedding
-        frame_count += 1
+            missing_glosses[gloss] = gloss
 
-    # calculate average embedding
-    if frame_count > 0:
-        average_embedding = total_embedding / frame_count
+    if missing_glosses:
+        print(f"Encoding {len(missing_glosses)} new glosses out of {len(glosses)}", flush=True)
+        new_embeddings = encode_texts(missing_glosses, eb, GLOSSES_BATCH_SIZE)
+        glosses_table.put_many({(eb.text_model_id, gloss): embedding for gloss, embedding in new_embeddings.items()})
+        embeddings.update(new_embeddings)
 
-    return average_embedding, best_embedding
+    return embeddings
 
 
-def generate_annotation_all_frames_embeddings(video_id, annotation_id, eb: Embedder):
-    """ Generate the embeddings for all the facial expressions frames of a specific annotation of a video """
-    video_dir = os.path.join(FACIAL_EXPRESSIONS_FRAMES_DIR, video_id)
-    expression_frames_dir = os.path.join(video_dir, annotation_id)
-    annotation_embedding = None
+def encode_texts(texts, eb: Embedder, batch_size=ENCODE_BATCH_SIZE):
+    """ Encode texts, given as {key: text}, in batches. Returns {key: embedding} """
+    keys = list(texts)
+    embeddings = {}
 
-    frames = os.listdir(expression_frames_dir)
-    batch_size = 8  # Process frames in smaller batches
+    for i in range(0, len(keys), batch_size):
+        batch_keys = keys[i:i + batch_size]
+        with torch.no_grad():  # Avoid storing computations for gradient calculation
+            batch_embeddings = eb.text_encode_batch([texts[key] for key in batch_keys])
+        embeddings.update(zip(batch_keys, batch_embeddings))
 
-    for i in range(0, len(frames), batch_size):
-        batch_frames = frames[i:i + batch_size]
-        batch_embeddings = []
+    return embeddings
 
-        for frame in batch_frames:
-            frame_path = os.path.join(expression_frames_dir, frame)
 
-            if not os.path.isfile(frame_path):
-                continue
+def encode_frames(frames, eb: Embedder):
+    """ Encode facial expressions frames, given as (video_id, annotation_id, frame name) tuples, in batches. The next
+    batches are read and preprocessed in background threads while the model encodes the current one.
+    Returns {(video_id, annotation_id, frame name): embedding} for the frames that exist, each encoded once """
 
-            with amp.autocast():  # Use mixed precision
-                frame_embedding = checkpoint.checkpoint(eb.image_encode, frame_path)
-                batch_embeddings.append(frame_embedding.cpu())  # Move to CPU to save GPU memory
+    def load_frame(frame):
+        image = frame_store.open_frame(FACIAL_EXPRESSIONS_ID, *frame)
+        return None if image is None else eb.preprocess_image(image)
 
-        if annotation_embedding is None:
-            annotation_embedding = sum(batch_embeddings)
-        else:
-            annotation_embedding += sum(batch_embeddings)
+    embeddings = {}
+    for batch_frames, images in batch_loader.iter_batches(dict.fromkeys(frames), load_frame, ENCODE_BATCH_SIZE):
+        if not images:
+            continue
+        with torch.no_grad():  # Avoid storing computations for gradient calculation
+            batch_embeddings = eb.image_encode_batch(images, preprocessed=True)
+        embeddings.update(zip(batch_frames, batch_embeddings))
 
-        torch.cuda.empty_cache()  # Clear GPU cache after each frame
+    return embeddings
 
-    return annotation_embedding
 
+def generate_query_embeddings(query_input, eb: Embedder):
+    """ Generate the user queries embeddings, or get them from the query cache if they were generated before """
+    return query_cache.get(normalize_gloss(query_input), eb)
 
-def update_annotations_embeddings(video_id, annotation_id, eb: Embedder):
-    """ Update the embeddings for a specific annotation of a video """
 
-    with open(ANNOTATIONS_EMBEDDINGS_FILE, 'rb') as f:
-        embeddings = CPU_Unpickler(f).load()
+def update_annotations_embeddings(video_id, annotation_id, eb: Embedder):
+    """ Update the embeddings for a specific annotation of a video, logging the new embedding (see vector_store) """
+    embeddings = vector_store.open_store(vector_store.ANNOTATIONS_EMBEDDINGS)
 
     annotation_json = os.path.join(ANNOTATIONS_PATH, f"{video_id}.json")
 
@@ -365,85 +441,42 @@ def update_annotations_embeddings(video_id, annotation_id, eb: Embedder):
 
         for expression in expressions:
             if expression["annotation_id"] == annotation_id:
-                annotation_value = expression["value"]
+                gloss = normalize_gloss(expression["value"])
 
-                if annotation_value is not None:
-                    embeddings[video_id][annotation_id] = eb.text_encode(annotation_value.lower())
+                if gloss is not None:
+                    # A lookup in the gloss table when the gloss was already encoded
+                    embeddings.log_put(video_id, annotation_id, encode_glosses({gloss}, eb)[gloss])
                 else:
-                    embeddings[video_id][annotation_id] = torch.zeros(512)
-
-    with open(ANNOTATIONS_EMBEDDINGS_FILE, 'wb') as f:
-        pickle.dump(embeddings, f)
+                    embeddings.log_put(video_id, annotation_id, torch.zeros(512))
 
-    return embeddings[video_id][annotation_id]
+    return embeddings.get(video_id, annotation_id)
 
 
 def add_embeddings(video_id, annotation_id, eb: Embedder):
-    """ Add or update the embeddings for a specific annotation of a video """
-    base_embeddings, average_embeddings, best_embeddings, summed_embeddings, all_embeddings, annotations_embeddings = load_embeddings()
+    """ Add or update the embeddings for a specific annotation of a video, logging them (see vector_store) """
+    *frames_embeddings, annotations_embeddings = load_embeddings()
 
     # Add the embeddings
-    base_embeddings[video_id][annotation_id] = generate_annotation_frame_embeddings(video_id, annotation_id, eb)
-    average_embeddings[video_id][annotation_id], best_embeddings[video_id][annotation_id] = \
-        generate_annotation_average_and_best_frame_embeddings(video_id, annotation_id, eb)
-    summed_embeddings[video_id][annotation_id] = base_embeddings[video_id][annotation_id] + \
-                                                 average_embeddings[video_id][annotation_id] + \
-                                                 best_embeddings[video_id][annotation_id]
-    all_embeddings[video_id][annotation_id] = generate_annotation_all_frames_embeddings(video_id, annotation_id, eb)
-    annotations_embeddings[video_id][annotation_id] = eb.text_encode(annotation_id.lower())
-
-    # Save the embeddings
-    save_embeddings(base_embeddings, average_embeddings, best_embeddings, summed_embeddings, all_embeddings,
-                    annotations_embeddings)
+    annotation_frames = frames_manifest.list_annotations_frames(video_id).get(annotation_id, ([], None))
+    frames_rows = {}
+    video_embeddings = generate_annotations_frames_embeddings(video_id, {annotation_id: annotation_frames}, eb,
+                                                              frames_rows)[annotation_id]
+    for embeddings, embedding in zip(frames_embeddings, video_embeddings):
+        if embedding is not None:
+            embeddings.log_put(video_id, annotation_id, embedding)
+        else:
+            embeddings.log_delete(video_id, annotation_id)
+    frame_embeddings_store.save_annotations(video_id, frames_rows, eb.model_id)
+    annotations_embeddings.log_put(video_id, annotation_id, eb.text_encode(annotation_id.lower()))
 
 
 def delete_embeddings(video_id, annotation_id):
-    """ Delete the embeddings for a specific annotation of a video """
-    base_embeddings, average_embeddings, best_embeddings, summed_embeddings, all_embeddings, annotations_embeddings = load_embeddings()
-
-    # Delete the embeddings
-    del base_embeddings[video_id][annotation_id]
-    del average_embeddings[video_id][annotation_id]
-    del best_embeddings[video_id][annotation_id]
-    del summed_embeddings[video_id][annotation_id]
-    del all_embeddings[video_id][annotation_id]
-    del annotations_embeddings[video_id][annotation_id]
-
-    # Save the embeddings
-    save_embeddings(base_embeddings, average_embeddings, best_embeddings, summed_embeddings, all_embeddings,
-                    annotations_embeddings)
+    """ Delete the embeddings for a specific annotation of a video, logging their deletion (see vector_store) """
+    for embeddings in load_embeddings():
+        embeddings.log_delete(video_id, annotation_id)
+    frame_embeddings_store.delete_annotations(video_id, [annotation_id])
 
 
 def load_embeddings():
-    """Load all embeddings from files."""
-    with open(BASE_FRAMES_EMBEDDINGS_FILE, 'rb') as f:
-        base_embeddings = CPU_Unpickler(f).load()
-    with open(AVERAGE_FRAMES_EMBEDDINGS_FILE, 'rb') as f:
-        average_embeddings = CPU_Unpickler(f).load()
-    with open(BEST_FRAMES_EMBEDDINGS_FILE, 'rb') as f:
-        best_embeddings = CPU_Unpickler(f).load()
-    with open(SUMMED_FRAMES_EMBEDDINGS_FILE, 'rb') as f:
-        summed_embeddings = CPU_Unpickler(f).load()
-    with open(ALL_FRAMES_EMBEDDINGS_FILE, 'rb') as f:
-        all_embeddings = CPU_Unpickler(f).load()
-    with open(ANNOTATIONS_EMBEDDINGS_FILE, 'rb') as f:
-        annotations_embeddings = CPU_Unpickler(f).load()
-
-    return base_embeddings, average_embeddings, best_embeddings, summed_embeddings, all_embeddings, annotations_embeddings
-
-
-def save_embeddings(base_embeddings, average_embeddings, best_embeddings, summed_embeddings, all_embeddings,
-                    annotations_embeddings):
-    """Save all embeddings back to their files."""
-    with open(BASE_FRAMES_EMBEDDINGS_FILE, 'wb') as f:
-        pickle.dump(base_embeddings, f)
-    with open(AVERAGE_FRAMES_EMBEDDINGS_FILE, 'wb') as f:
-        pickle.dump(average_embeddings, f)
-    with open(BEST_FRAMES_EMBEDDINGS_FILE, 'wb') as f:
-        pickle.dump(best_embeddings, f)
-    with open(SUMMED_FRAMES_EMBEDDINGS_FILE, 'wb') as f:
-        pickle.dump(summed_embeddings, f)
-    with open(ALL_FRAMES_EMBEDDINGS_FILE, 'wb') as f:
-        pickle.dump(all_embeddings, f)
-    with open(ANNOTATIONS_EMBEDDINGS_FILE, 'wb') as f:
-        pickle.dump(annotations_embeddings, f)
+    """ Open the stores of the base, average, best, summed, all frames and annotations embeddings """
+    return tuple(load_frames_embeddings()) + (vector_store.open_store(vector_store.ANNOTATIONS_EMBEDDINGS),)
@@ -1,9 +1,20 @@
 from abc import ABC, abstractmethod
 
+from PIL import Image
+
 
 class AbstractEncoder(ABC):
     """Abstract class for encoders."""
 
+    # Identifies the model, so the embeddings generated with another model are generated again
+    model_id = None
+
+    @property
+    def text_model_id(self):
+        """ Identifies the model that encodes the texts, which is the model itself unless the texts are encoded by
+        another backend, whose text embeddings can't be mixed with the model's """
+        return self.model_id
+
     @abstractmethod
     def text_encode(self, text):
         pass
@@ -11,3 +22,31 @@ class AbstractEncoder(ABC):
     @abstractmethod
     def image_encode(self, path):
         pass
+
+    @abstractmethod
+    def text_encode_batch(self, texts):
+        """ Encode a list of texts at once, returning their embeddings as the rows of a tensor """
+        pass
+
+    @abstractmethod
+    def image_encode_batch(self, images, preprocessed=False):
+        """ Encode a list of images, given as paths or images, or as returned by preprocess_image if preprocessed,
+        at once, returning their embeddings as the rows of a tensor """
+        pass
+
+    def freeze(self):
+        """ Make the model inference only and move its weights to shared memory, so the processes forked afterwards
+        use the same weights instead of each getting its own copy """
+        self.model.eval()
+        self.model.requires_grad_(False)
+        self.model.share_memory()
+
+    def after_fork(self):
+        """ Recreate, in a forked process, what can't be inherited from the process that loaded the model """
+        pass
+
+    def preprocess_image(self, path):
+        """ Open an image, given as a path or an image, and prepare it to be encoded by image_encode_batch.
+        It doesn't use the model, so images can be preprocessed in other threads while the model runs """
+        # Frames decoded in memory are given as images instead of paths
+        return Image.open(path) if isinstance(path, str) else path
@@ -1,3 +1,4 @@
+import torch
 from PIL import Image
 from app.embeddings.encoders.abstract_encoder import AbstractEncoder
 import open_clip
@@ -5,14 +6,30 @@ import open_clip
 
 class CapivaraEncoder(AbstractEncoder):
     """ Encoder class to encode text and image using the CAPIVARA model """
+    model_id = 'hf-hub:hiaac-nlp/CAPIVARA'
 
-    def __init__(self, device):
+    def __init__(self, device, text_backend="torch", text_quantize=False, text_intra_op_threads=0):
         self.device = device
-        self.model, _, self.preprocess_val = open_clip.create_model_and_transforms('hf-hub:hiaac-nlp/CAPIVARA')
-        self.tokenizer = open_clip.get_tokenizer('hf-hub:hiaac-nlp/CAPIVARA')
+        self.model, _, self.preprocess_val = open_clip.create_model_and_transforms(self.model_id)
+        self.tokenizer = open_clip.get_tokenizer(self.model_id)
         self.model = self.model.to(self.device)
 
+        # The texts can be encoded by the text tower exported to ONNX, on the CPU, see onnx_backend.py
+        self.onnx_text_encoder = None
+        if text_backend == "onnx":
+            from app.embeddings.encoders import onnx_backend
+            self.onnx_text_encoder = onnx_backend.OnnxTextEncoder("capivara-text", self.model, self.tokenizer,
+                                                                  text_quantize, text_intra_op_threads)
+
+    @property
+    def text_model_id(self):
+        if self.onnx_text_encoder is not None:
+            return f"{self.model_id}#{self.onnx_text_encoder.variant}"
+        return self.model_id
+
     def text_encode(self, text):
+        if self.onnx_text_encoder is not None:
+            return self.onnx_text_encoder([text]).view(-1)
         text = self.tokenizer(text)
         text = text.to(self.device)
         model_output = self.model.encode_text(text)
@@ -21,10 +38,32 @@ class CapivaraEncoder(AbstractEncoder):
         return model_output
 
     def image_encode(self, path):
-        image = Image.open(path)
+        # Frames decoded in memory are given as images instead of paths
+        image = Image.open(path) if isinstance(path, str) else path
         image = self.preprocess_val(image).unsqueeze(0)
         image = image.to(self.device)
         model_output = self.model.encode_image(image)
         if model_output.dim() > 1:
             model_output = model_output.view(-1)
         return model_output
+
+    def text_encode_batch(self, texts):
+        if self.onnx_text_encoder is not None:
+            return self.onnx_text_encoder(texts)
+        texts = self.tokenizer(list(texts))
+        texts = texts.to(self.device)
+        return self.model.encode_text(texts)
+
+    def after_fork(self):
+        # The onnxruntime threads of the parent process don't exist in the forked one
+        if self.onnx_text_encoder is not None:
+            self.onnx_text_encoder.start_session()
+
+    def preprocess_image(self, path):
+        return self.preprocess_val(super().preprocess_image(path))
+
+    def image_encode_batch(self, images, preprocessed=False):
+        if not preprocessed:
+            images = [self.preprocess_image(image) for image in images]
+        images = torch.stack(images).to(self.device)
+        return self.model.encode_image(images)
@@ -6,9 +6,10 @@ from sentence_transformers import SentenceTransformer
 
 class ClipEncoder(AbstractEncoder):
     """ Encoder class to encode text and image using the clip-Vit-B-32 model """
+    model_id = 'clip-ViT-B-32'
 
     def __init__(self, device):
-        self.model = SentenceTransformer('clip-ViT-B-32', device=device)
+        self.model = SentenceTransformer(self.model_id, device=device)
         self.model = self.model.to(device)
 
     def text_encode(self, text):
@@ -18,8 +19,18 @@ class ClipEncoder(AbstractEncoder):
         return model_output
 
     def image_encode(self, path):
-        image = Image.open(path)
+        # Frames decoded in memory are given as images instead of paths
+        image = Image.open(path) if isinstance(path, str) else path
         model_output = self.model.encode(image, convert_to_tensor=True)
         if model_output.dim() > 1:
             model_output = model_output.view(-1)
         return model_output
+
+    def text_encode_batch(self, texts):
+        return self.model.encode(list(texts), batch_size=len(texts), convert_to_tensor=True)
+
+    def image_encode_batch(self, images, preprocessed=False):
+        # The model preprocesses the images itself, so preprocess_image only opens them
+        if not preprocessed:
+            images = [self.preprocess_image(image) for image in images]
+        return self.model.encode(images, batch_size=len(images), convert_to_tensor=True)
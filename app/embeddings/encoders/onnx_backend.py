@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+import torch
+from open_clip.tokenizer import HFTokenizer
+
+from app.frame_extraction.onnx_session import ONNX_MODELS_DIR, ONNX_OPSET, create_session, quantized_path
+
+# A query is a few tokens, past a few threads onnxruntime spends more time synchronizing them than computing
+MAX_TEXT_INTRA_OP_THREADS = 4
+
+
+class TextTower(torch.nn.Module):
+    """ Wraps a CLIP model so that the exported graph only encodes texts """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, text):
+        return self.model.encode_text(text)
+
+
+def export_text_tower(model, tokenizer, model_dir):
+    """ Export the text tower of a CLIP model to ONNX, with dynamic batch size, and save its tokenizer next to it """
+    os.makedirs(model_dir, exist_ok=True)
+    text = tokenizer(["expressão facial"])
+
+    training = model.training
+    model.eval()
+    with torch.no_grad():
+        torch.onnx.export(TextTower(model), (text,), os.path.join(model_dir, "text.onnx"),
+                          input_names=["text"], output_names=["embeddings"],
+                          dynamic_axes={"text": {0: "batch"}, "embeddings": {0: "batch"}},
+                          opset_version=ONNX_OPSET)
+    model.train(training)
+
+    if isinstance(tokenizer, HFTokenizer):
+        tokenizer.tokenizer.save_pretrained(os.path.join(model_dir, "tokenizer"))
+
+
+class OnnxTextEncoder:
+    """ Text tower of a CLIP model running on onnxruntime, called like text_encode_batch. The model is exported to
+        ONNX_MODELS_DIR/name the first time, with its tokenizer, which is then always loaded from there. Its
+        embeddings differ slightly from the PyTorch ones, variant tells them apart """
+
+    def __init__(self, name, model, tokenizer, quantize=False, intra_op_threads=0):
+        model_dir = os.path.join(ONNX_MODELS_DIR, name)
+        model_path = os.path.join(model_dir, "text.onnx")
+        if not os.path.exists(model_path):
+            export_text_tower(model, tokenizer, model_dir)
+        if quantize:
+            model_path = quantized_path(model_path)
+        self.model_path = model_path
+        self.variant = "onnx-int8" if quantize else "onnx"
+        # Each call encodes a few short texts, past a few threads they are spent synchronizing
+        self.intra_op_threads = intra_op_threads or min(len(os.sched_getaffinity(0)), MAX_TEXT_INTRA_OP_THREADS)
+        self.start_session()
+
+        tokenizer_dir = os.path.join(model_dir, "tokenizer")
+        self.tokenizer = HFTokenizer(tokenizer_dir) if os.path.isdir(tokenizer_dir) else tokenizer
+
+    def start_session(self):
+        self.session = create_session(self.model_path, self.intra_op_threads, 1)
+
+    def __call__(self, texts):
+        text = self.tokenizer(list(texts))
+        embeddings, = self.session.run(None, {"text": text.cpu().numpy().astype(np.int64)})
+        return torch.from_numpy(embeddings)
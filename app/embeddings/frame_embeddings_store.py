@@ -0,0 +1,193 @@
+""" Store of the embedding of every facial expressions frame, so new annotation embeddings can be computed from them
+without encoding the frames again.
+
+Each video has a float16 matrix with one row per frame, saved with numpy and memory mapped when read, and a JSON
+index with the model that encoded the frames and, for each annotation, its first row and the weights of its frames
+(the number of frames each deduplicated frame stands for). The rows of an annotation are its frames in time order,
+so a frame is identified by (video_id, annotation_id, frame_idx).
+
+New annotation embeddings are defined as aggregations of the frames of an annotation, registered with
+register_aggregation, and computed for the whole corpus with aggregate.
+"""
+import functools
+import json
+import os
+import threading
+import uuid
+
+import numpy as np
+
+from ..utils import FRAME_EMBEDDINGS_PATH
+
+BASE_FRAMES_COUNT = 4  # frames summed in the base embedding
+
+# Serializes the updates of the stored videos, which are read, changed and written back
+store_lock = threading.Lock()
+
+# Aggregations by name, see register_aggregation
+AGGREGATIONS = {}
+
+
+def register_aggregation(name):
+    """ Register a function that computes an annotation embedding from the embeddings of its frames, given as a float32
+        (frames, dimensions) array in time order, and their weights, given as an int array """
+
+    def register(aggregation):
+        AGGREGATIONS[name] = aggregation
+        return aggregation
+
+    return register
+
+
+class VideoFrameEmbeddings:
+    """ Embeddings of the frames of a video, memory mapped, so only the rows that are used are read """
+
+    def __init__(self, index_path):
+        with open(index_path, "r") as f:
+            self.index = json.load(f)
+        self.model_id = self.index["model_id"]
+        self.matrix = np.load(os.path.join(os.path.dirname(index_path), self.index["matrix"]), mmap_mode="r")
+
+    def annotations(self):
+        return list(self.index["annotations"])
+
+    def frames(self, annotation_id):
+        """ Get the float16 embeddings of the frames of an annotation, one row per frame_idx, and their weights """
+        annotation = self.index["annotations"][annotation_id]
+        weights = np.asarray(annotation["weights"], dtype=np.int64)
+        return self.matrix[annotation["start"]:annotation["start"] + len(weights)], weights
+
+    def frame(self, annotation_id, frame_idx):
+        """ Get the float16 embedding of a frame of an annotation """
+        return self.matrix[self.index["annotations"][annotation_id]["start"] + frame_idx]
+
+
+def index_path(video_id):
+    return os.path.join(FRAME_EMBEDDINGS_PATH, f"{video_id}.json")
+
+
+@functools.lru_cache(maxsize=64)
+def cached_video(path, modified_time):
+    # The modification time is part of the key, so rewritten videos are opened again
+    return VideoFrameEmbeddings(path)
+
+
+def open_video(video_id):
+    """ Get the stored frame embeddings of a video, or None if there are none """
+    try:
+        return cached_video(index_path(video_id), os.stat(index_path(video_id)).st_mtime_ns)
+    except FileNotFoundError:
+        return None
+
+
+def list_videos():
+    """ Get the ids of the videos with stored frame embeddings """
+    if not os.path.isdir(FRAME_EMBEDDINGS_PATH):
+        return []
+    return sorted(os.path.splitext(entry)[0] for entry in os.listdir(FRAME_EMBEDDINGS_PATH) if entry.endswith(".json"))
+
+
+def save_annotations(video_id, annotations_frames, model_id):
+    """ Store the frame embeddings of some annotations of a video, given as {annotation_id: (array of the frames'
+        embeddings in time order, [frame weights])}, replacing their previous ones. The other annotations of the
+        video are kept if they were encoded by the same model. """
+    with store_lock:
+        video = open_video(video_id)
+        annotations = {}
+        if video is not None and video.model_id == model_id:
+            annotations = {annotation_id: video.frames(annotation_id) for annotation_id in video.annotations()
+                           if annotation_id not in annotations_frames}
+        annotations.update(annotations_frames)
+        write_video(video_id, annotations, model_id)
+
+
+def delete_annotations(video_id, annotation_ids):
+    """ Delete the stored frame embeddings of some annotations of a video """
+    with store_lock:
+        video = open_video(video_id)
+        if video is None or not set(annotation_ids) & set(video.annotations()):
+            return
+        write_video(video_id, {annotation_id: video.frames(annotation_id) for annotation_id in video.annotations()
+                               if annotation_id not in annotation_ids}, video.model_id)
+
+
+def write_video(video_id, annotations_frames, model_id):
+    """ Write the matrix and index of a video. The matrix gets a new file name, so the index is replaced at once and
+        readers never see an index and a matrix that don't match """
+    os.makedirs(FRAME_EMBEDDINGS_PATH, exist_ok=True)
+    previous_video = open_video(video_id)
+
+    rows = []
+    index = {"model_id": model_id, "matrix": f"{video_id}.{uuid.uuid4().hex[:8]}.npy", "annotations": {}}
+    start = 0
+    for annotation_id, (embeddings, weights) in annotations_frames.items():
+        index["annotations"][annotation_id] = {"start": start, "weights": [int(weight) for weight in weights]}
+        if len(weights) > 0:
+            rows.append(np.asarray(embeddings, dtype=np.float16).reshape(len(weights), -1))
+        start += len(weights)
+
+    matrix = np.concatenate(rows) if rows else np.zeros((0, 0), dtype=np.float16)
+    np.save(os.path.join(FRAME_EMBEDDINGS_PATH, index["matrix"]), matrix)
+
+    tmp_path = index_path(video_id) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path(video_id))
+
+    if previous_video is not None:
+        os.remove(os.path.join(FRAME_EMBEDDINGS_PATH, previous_video.index["matrix"]))
+
+
+def aggregate(name, video_ids=None):
+    """ Compute an aggregation for all the annotations of the given videos (all by default) from their stored frame
+        embeddings. Returns {video_id: {annotation_id: embedding as a float32 array}} """
+    aggregation = AGGREGATIONS[name]
+    embeddings = {}
+
+    for video_id in video_ids if video_ids is not None else list_videos():
+        video = open_video(video_id)
+        if video is None:
+            continue
+
+        embeddings[video_id] = {}
+        for annotation_id in video.annotations():
+            frames, weights = video.frames(annotation_id)
+            embeddings[video_id][annotation_id] = None if len(frames) == 0 else \
+                aggregation(np.asarray(frames, dtype=np.float32), weights)
+
+    return embeddings
+
+
+# The aggregations generated by the pre-processing (see embeddings_processing.aggregate_frame_embeddings)
+
+@register_aggregation("base")
+def base_embedding(frames, weights):
+    """ Sum of #BASE_FRAMES_COUNT evenly spaced frames """
+    frames_indexes = np.repeat(np.arange(len(frames)), weights)
+    if len(frames_indexes) <= BASE_FRAMES_COUNT:
+        step_size = 1
+    else:
+        step_size = (len(frames_indexes) - 1) // BASE_FRAMES_COUNT + 1
+    return frames[frames_indexes[::step_size][:BASE_FRAMES_COUNT]].sum(axis=0)
+
+
+@register_aggregation("all")
+def all_frames_embedding(frames, weights):
+    """ Sum of all the frames """
+    return (frames * weights[:, None]).sum(axis=0)
+
+
+@register_aggregation("average")
+def average_embedding(frames, weights):
+    return all_frames_embedding(frames, weights) / weights.sum()
+
+
+@register_aggregation("best")
+def best_embedding(frames, weights):
+    """ Frame with the highest norm, the most intense and distinct expression """
+    return frames[np.argmax(np.linalg.norm(frames, axis=1))]
+
+
+@register_aggregation("summed")
+def summed_embedding(frames, weights):
+    return base_embedding(frames, weights) + average_embedding(frames, weights) + best_embedding(frames, weights)
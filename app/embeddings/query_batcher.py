@@ -0,0 +1,155 @@
+""" Micro-batching of the encoding of the users' queries.
+
+Each request encodes its query on its own thread, so under concurrent load the text encoder would run once per query,
+with a batch of one. The batcher queues the queries instead and a single thread encodes them in batches: it takes the
+queries arriving within QUERY_BATCH_WINDOW_MS of the first one, up to QUERY_BATCH_SIZE, runs one forward pass for all
+of them and gives each request its embedding through a future. Queries repeated in a batch are encoded once.
+"""
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, TimeoutError
+
+import numpy as np
+
+from ..utils import QUERY_BATCH_WINDOW_MS, QUERY_BATCH_SIZE
+
+WAIT_SAMPLES = 1024  # last waits kept for the percentiles of the stats
+ENCODE_TIMEOUT = 10  # seconds a query waits for its batch before it is encoded on its own thread
+
+
+class QueryRequest:
+    """ A query waiting to be encoded by the batcher """
+
+    def __init__(self, text, eb):
+        self.text = text
+        self.eb = eb
+        self.future = Future()
+        self.submitted = time.perf_counter()
+
+
+class QueryBatcher:
+
+    def __init__(self, window_ms=QUERY_BATCH_WINDOW_MS, max_batch_size=QUERY_BATCH_SIZE):
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.requests = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+        self.max_queue_depth = 0
+        self.batch_sizes = Counter()  # {batch size: batches}
+        self.waits = deque(maxlen=WAIT_SAMPLES)  # seconds from a query's submission until its batch started
+        self.encode_time = 0.0
+        self.timeouts = 0
+
+    def encode(self, text, eb):
+        """ Encode a query with the embedder, batched with the concurrent ones, as a float32 array """
+        if self.window <= 0 or self.max_batch_size <= 1:
+            return self.encode_alone(text, eb)
+
+        request = QueryRequest(text, eb)
+        with self.lock:
+            # Started on the first query, a thread started before forking doesn't exist in the forked process
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.requests.put(request)
+            self.max_queue_depth = max(self.max_queue_depth, self.requests.qsize())
+
+        try:
+            return request.future.result(timeout=ENCODE_TIMEOUT)
+        except TimeoutError:
+            # The batcher thread is stuck or died, the query doesn't wait for it any longer
+            request.future.cancel()
+            with self.lock:
+                self.timeouts += 1
+            return self.encode_alone(text, eb)
+
+    @staticmethod
+    def encode_alone(text, eb):
+        import torch  # not imported with the module, so the web application starts without loading torch
+
+        with torch.no_grad():
+            return eb.text_encode(text).detach().cpu().float().numpy().reshape(-1)
+
+    def next_batch(self):
+        """ Wait for a query and take it with the ones arriving within the window, or already waiting """
+        batch = [self.requests.get()]
+        deadline = batch[0].submitted + self.window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                batch.append(self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            self.run_batch(self.next_batch())
+
+    def run_batch(self, batch):
+        import torch
+
+        # The queries that timed out were encoded on their own
+        batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        start = time.perf_counter()
+        with self.lock:
+            self.batch_sizes[len(batch)] += 1
+            self.waits.extend(start - request.submitted for request in batch)
+
+        # The queries of a batch are all encoded by the same embedder, unless it changed in between
+        by_embedder = {}
+        for request in batch:
+            by_embedder.setdefault(id(request.eb), []).append(request)
+
+        for requests in by_embedder.values():
+            texts = list(dict.fromkeys(request.text for request in requests))
+            try:
+                with torch.no_grad():
+                    embeddings = requests[0].eb.text_encode_batch(texts).detach().cpu().float().numpy()
+            except Exception as e:
+                for request in requests:
+                    request.future.set_exception(e)
+                continue
+
+            rows = dict(zip(texts, embeddings))
+            for request in requests:
+                request.future.set_result(rows[request.text].copy())
+
+        with self.lock:
+            self.encode_time += time.perf_counter() - start
+
+    def stats(self):
+        """ Get the queue depth, the distribution of the batch sizes and the wait of the queries before encoding """
+        with self.lock:
+            batches = sum(self.batch_sizes.values())
+            queries = sum(size * count for size, count in self.batch_sizes.items())
+            waits = np.array(self.waits) * 1000
+            return {
+                "window_ms": self.window * 1000,
+                "max_batch_size": self.max_batch_size,
+                "queue_depth": self.requests.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "batches": batches,
+                "queries": queries,
+                "batch_sizes": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                "mean_batch_size": queries / batches if batches else 0.0,
+                "wait_ms": {
+                    "mean": float(waits.mean()) if len(waits) else 0.0,
+                    "p50": float(np.percentile(waits, 50)) if len(waits) else 0.0,
+                    "p95": float(np.percentile(waits, 95)) if len(waits) else 0.0,
+                    "max": float(waits.max()) if len(waits) else 0.0,
+                },
+                "mean_encode_ms": self.encode_time * 1000 / batches if batches else 0.0,
+                "timeouts": self.timeouts,
+            }
+
+
+# Batcher of the process, see query_cache.QueryCache.get
+query_batcher = QueryBatcher()
@@ -0,0 +1,71 @@
+""" Cache of the embeddings of the users' queries, so repeated queries don't run the text encoder again.
+
+The cache has two tiers: an LRU of the last QUERY_CACHE_SIZE queries in the process, and the gloss table on disk
+(see vector_store.GLOSSES_EMBEDDINGS), shared by all the processes. The gloss table already has every gloss of the
+corpus, encoded by the pre-processing, so queries for a known gloss are hits from the start. The queries only read it:
+the queries that are encoded are only kept in the LRU, so arbitrary user input doesn't grow the gloss table nor costs
+a write to disk. Both tiers are keyed by the normalized query and the model that encoded it.
+"""
+import threading
+from collections import OrderedDict
+
+from . import vector_store
+from .query_batcher import query_batcher
+from ..utils import QUERY_CACHE_SIZE
+
+
+class QueryCache:
+
+    def __init__(self, size=QUERY_CACHE_SIZE):
+        self.size = size
+        self.embeddings = OrderedDict()  # {(text_model_id, query): embedding}, the least recently used first
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, query, eb):
+        """ Get the embedding of a normalized query as a float32 array, encoding it with the embedder on a miss """
+        key = (eb.text_model_id, query)
+
+        with self.lock:
+            if key in self.embeddings:
+                self.embeddings.move_to_end(key)
+                self.memory_hits += 1
+                return self.embeddings[key]
+
+        glosses_table = vector_store.open_store(vector_store.GLOSSES_EMBEDDINGS)
+        embedding = glosses_table.get(*key)
+        disk_hit = embedding is not None
+        if not disk_hit:
+            embedding = query_batcher.encode(query, eb)
+
+        with self.lock:
+            if disk_hit:
+                self.disk_hits += 1
+            else:
+                self.misses += 1
+            self.embeddings[key] = embedding
+            self.embeddings.move_to_end(key)
+            while len(self.embeddings) > self.size:
+                self.embeddings.popitem(last=False)
+
+        return embedding
+
+    def stats(self):
+        """ Get the hits of each tier, the misses and the hit rates of the cache """
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "size": len(self.embeddings),
+                "lookups": lookups,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_hit_rate": self.memory_hits / lookups if lookups else 0.0,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+
+# Cache of the process, see embeddings_processing.generate_query_embeddings
+query_cache = QueryCache()
@@ -0,0 +1,521 @@
+""" Memory mapped vector store for the embeddings of the annotations, one store per embedding type.
+
+A store keeps its vectors as the rows of a single contiguous float32 (or float16) matrix, opened with np.memmap so
+opening a store doesn't read the vectors and reading a vector doesn't copy it. Next to the matrix there is an id
+table, with the (video_id, annotation_id) of each row, one JSON line per row, and a tombstone bitmap with a bit per
+row set when the row was replaced or deleted. Vectors are only ever appended, so adding or deleting the embedding of
+one annotation writes a single row or bit instead of rewriting the whole store. The dead rows are dropped by
+compacting the store, which writes a new generation of its files.
+
+Files of a store in VECTORS_PATH: {name}.json, with the dimension, type and generation of the store and the version
+of its tombstone bitmap, and
+{name}.{generation}.vectors, {name}.{generation}.ids and {name}.{generation}.tombstones.
+
+The single annotation edits of the annotation editor are appended to a log, {name}.log, instead of being written to
+the store: one JSON line per added, replaced or deleted vector, replayed over the store when it is read. Once the log
+has LOG_ENTRIES_TO_APPLY edits, it is applied to the store in a background thread and removed, so an edit costs one
+appended line whatever the size of the store. The first line of a log has a random id, so a log written after the
+previous one was removed is never mistaken for it.
+
+The stores replace the pickled {video_id: {annotation_id: tensor}} dicts, which are migrated once when a store is
+first opened, and then renamed to {pickle}.migrated (see migrate_pickle).
+
+The stores are written by several processes, the pre-processing and the workers of the web server: every write holds
+an exclusive flock on {name}.lock and reads the store again first, so it appends after the rows written by the others
+and sets its tombstones over theirs (see VectorStore.locked).
+"""
+import base64
+import contextlib
+import fcntl
+import json
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ..utils import VECTORS_PATH, CPU_Unpickler, BASE_FRAMES_EMBEDDINGS_FILE, AVERAGE_FRAMES_EMBEDDINGS_FILE, \
+    BEST_FRAMES_EMBEDDINGS_FILE, SUMMED_FRAMES_EMBEDDINGS_FILE, ALL_FRAMES_EMBEDDINGS_FILE, ANNOTATIONS_EMBEDDINGS_FILE
+
+BASE_FRAMES_EMBEDDINGS = "base_frame_embeddings"
+AVERAGE_FRAMES_EMBEDDINGS = "average_frame_embeddings"
+BEST_FRAMES_EMBEDDINGS = "best_frame_embeddings"
+SUMMED_FRAMES_EMBEDDINGS = "summed_frame_embeddings"
+ALL_FRAMES_EMBEDDINGS = "all_frame_embeddings"
+ANNOTATIONS_EMBEDDINGS = "annotations_embeddings"
+GLOSSES_EMBEDDINGS = "glosses_embeddings"  # gloss table, by (text_model_id, normalized gloss)
+
+# Pickles of the embeddings saved before the stores existed
+LEGACY_PICKLES = {
+    BASE_FRAMES_EMBEDDINGS: BASE_FRAMES_EMBEDDINGS_FILE,
+    AVERAGE_FRAMES_EMBEDDINGS: AVERAGE_FRAMES_EMBEDDINGS_FILE,
+    BEST_FRAMES_EMBEDDINGS: BEST_FRAMES_EMBEDDINGS_FILE,
+    SUMMED_FRAMES_EMBEDDINGS: SUMMED_FRAMES_EMBEDDINGS_FILE,
+    ALL_FRAMES_EMBEDDINGS: ALL_FRAMES_EMBEDDINGS_FILE,
+    ANNOTATIONS_EMBEDDINGS: ANNOTATIONS_EMBEDDINGS_FILE,
+}
+
+MIGRATED_EXTENSION = ".migrated"  # added to the legacy pickles once migrated
+
+MIN_DEAD_ROWS_TO_COMPACT = 1024  # dead rows above which, if they are also the majority, the store is compacted
+LOG_ENTRIES_TO_APPLY = 64  # logged edits above which the log is applied to the store, in the background
+
+# Apply the logs of the stores to them, one at a time, by process id: the thread of an executor created before a fork
+# doesn't exist in the forked process
+log_executors = {}
+log_executors_lock = threading.Lock()
+
+# Opened stores by name, see open_store
+stores = {}
+stores_lock = threading.Lock()
+
+
+def log_executor():
+    """ Get the executor applying the logs in this process """
+    with log_executors_lock:
+        pid = os.getpid()
+        if pid not in log_executors:
+            log_executors[pid] = ThreadPoolExecutor(max_workers=1)
+        return log_executors[pid]
+
+
+def to_array(vector):
+    """ Get a vector, given as a torch tensor, a numpy array or a list, as a flat numpy array """
+    if hasattr(vector, "detach"):
+        vector = vector.detach().cpu().float().numpy()
+    return np.asarray(vector).reshape(-1)
+
+
+class VectorStore:
+    """ Vectors of one embedding type, indexed by (video_id, annotation_id). Reading a video, as store[video_id],
+        gives {annotation_id: vector} with the vectors as read only views of the memory mapped matrix.
+        The store is refreshed before every read, so the changes made by other processes are seen. """
+
+    def __init__(self, name, path=VECTORS_PATH):
+        self.name = name
+        self.path = path
+        self.lock = threading.RLock()
+        self.lock_file = None  # held while the store is written, see locked
+        self.lock_depth = 0
+
+        # Edits of the log, as {video_id: {annotation_id: vector, or None if deleted}}, see log_put
+        self.log_by_video = {}
+        self.log_entries = 0
+        self.log_id = None  # first line of the log, None if there is none
+        self.log_size = 0  # bytes of the log read
+        self.log_apply_pending = None  # id of the process that scheduled applying the log
+
+        self.load()
+
+    # Files
+
+    def meta_path(self):
+        return os.path.join(self.path, f"{self.name}.json")
+
+    def lock_path(self):
+        return os.path.join(self.path, f"{self.name}.lock")
+
+    def log_path(self):
+        return os.path.join(self.path, f"{self.name}.log")
+
+    def file_path(self, extension, generation=None):
+        generation = self.generation if generation is None else generation
+        return os.path.join(self.path, f"{self.name}.{generation}.{extension}")
+
+    def load(self):
+        """ Read the store from scratch """
+        self.meta = None
+        self.generation = None
+        self.ids = []
+        self.ids_size = 0
+        self.tombstones = np.zeros(0, dtype=np.uint8)
+        self.tombstones_version = None
+        self.matrix = None
+        self.rows_by_video = {}
+
+        if os.path.exists(self.meta_path()):
+            with open(self.meta_path(), "r") as f:
+                self.meta = json.load(f)
+            self.generation = self.meta["generation"]
+            self.refresh()
+
+    def refresh(self):
+        """ Read the rows appended and the rows tombstoned since the store was last read """
+        # The log is read first, so edits applied meanwhile are found in the store if they were removed from the log
+        self.read_log()
+        if not os.path.exists(self.meta_path()):
+            return
+        with open(self.meta_path(), "r") as f:
+            meta = json.load(f)
+        rows = len(self.ids)
+        if self.meta is None or meta["generation"] != self.generation:
+            # The store was created or compacted
+            self.meta = meta
+            self.generation = meta["generation"]
+            self.ids, self.ids_size, self.tombstones_version = [], 0, None
+            self.tombstones = np.zeros(0, dtype=np.uint8)
+            rows = None
+        self.meta = meta
+
+        self.read_ids()
+        tombstones_changed = self.read_tombstones()
+
+        if len(self.ids) != rows:
+            if self.ids:
+                self.matrix = np.memmap(self.file_path("vectors"), dtype=self.meta["dtype"], mode="r",
+                                        shape=(len(self.ids), self.meta["dim"]))
+            else:
+                self.matrix = None
+
+        if len(self.ids) != rows or tombstones_changed:
+            self.rows_by_video = {}
+            for row, (video_id, annotation_id) in enumerate(self.ids):
+                if not self.is_dead(row):
+                    self.rows_by_video.setdefault(video_id, {})[annotation_id] = row
+
+    def read_ids(self):
+        """ Read the complete lines appended to the id table """
+        ids_path = self.file_path("ids")
+        if not os.path.exists(ids_path) or os.path.getsize(ids_path) == self.ids_size:
+            return
+
+        with open(ids_path, "rb") as f:
+            f.seek(self.ids_size)
+            data = f.read()
+
+        # A line cut short by an interrupted write is left out, as its row. The vectors are written before the ids, so
+        # every complete line has its row
+        complete = data[:data.rfind(b"\n") + 1]
+        self.ids.extend(tuple(json.loads(line)) for line in complete.splitlines())
+        self.ids_size += len(complete)
+
+    def read_tombstones(self):
+        """ Read the tombstone bitmap if it changed, returns whether it did. Every write of the bitmap increments its
+            version in the meta file, so a change is seen even if the file keeps its size and modification time """
+        version = self.meta.get("tombstones", 0)
+        if version == self.tombstones_version:
+            return False
+
+        self.tombstones = self.load_tombstones()
+        self.tombstones_version = version
+        return True
+
+    def load_tombstones(self):
+        tombstones_path = self.file_path("tombstones")
+        if not os.path.exists(tombstones_path):
+            return np.zeros(0, dtype=np.uint8)
+        return np.fromfile(tombstones_path, dtype=np.uint8)
+
+    def read_log(self):
+        """ Replay the edits appended to the log since it was last read """
+        try:
+            f = open(self.log_path(), "rb")
+        except FileNotFoundError:
+            f = None
+
+        log_id = None
+        if f is not None:
+            with f:
+                log_id = f.readline()
+                if not log_id.endswith(b"\n"):
+                    # Its first line is still being written, the log has no edits yet
+                    log_id = None
+                elif log_id == self.log_id:
+                    f.seek(self.log_size)
+                    data = f.read()
+                else:
+                    data = f.read()
+
+        if log_id != self.log_id:
+            # The log was applied to the store and removed since it was read, and maybe a new one started
+            self.log_by_video, self.log_entries = {}, 0
+            self.log_id, self.log_size = log_id, 0 if log_id is None else len(log_id)
+        if log_id is None:
+            return
+
+        # A line cut short by an interrupted write is left out, as its edit
+        complete = data[:data.rfind(b"\n") + 1]
+        for line in complete.splitlines():
+            entry = json.loads(line)
+            video_id, annotation_id = entry["key"]
+            vector = None if entry["vector"] is None else \
+                np.frombuffer(base64.b64decode(entry["vector"]), dtype=np.float32)
+            self.log_by_video.setdefault(video_id, {})[annotation_id] = vector
+            self.log_entries += 1
+        self.log_size += len(complete)
+
+    def row_size(self):
+        return self.meta["dim"] * np.dtype(self.meta["dtype"]).itemsize
+
+    def is_dead(self, row):
+        return row // 8 < len(self.tombstones) and bool(self.tombstones[row // 8] & (1 << (row % 8)))
+
+    # Reads
+
+    def __getitem__(self, video_id):
+        """ Get {annotation_id: vector} of a video, raising KeyError if the video has no vectors """
+        with self.lock:
+            self.refresh()
+            vectors = self.video_vectors(video_id)
+            if not vectors:
+                raise KeyError(video_id)
+            return vectors
+
+    def __contains__(self, video_id):
+        with self.lock:
+            self.refresh()
+            return bool(self.video_vectors(video_id))
+
+    def get(self, video_id, annotation_id):
+        """ Get the vector of an annotation, or None if there is none """
+        with self.lock:
+            self.refresh()
+            if annotation_id in self.log_by_video.get(video_id, {}):
+                return self.log_by_video[video_id][annotation_id]
+            row = self.rows_by_video.get(video_id, {}).get(annotation_id)
+            return None if row is None else self.matrix[row]
+
+    def videos(self):
+        with self.lock:
+            self.refresh()
+            return [video_id for video_id in {**self.rows_by_video, **self.log_by_video}
+                    if self.video_vectors(video_id)]
+
+    def video_vectors(self, video_id):
+        """ Get {annotation_id: vector} of a video in the store, with the edits of the log """
+        vectors = {annotation_id: self.matrix[row]
+                   for annotation_id, row in self.rows_by_video.get(video_id, {}).items()}
+        for annotation_id, vector in self.log_by_video.get(video_id, {}).items():
+            if vector is None:
+                vectors.pop(annotation_id, None)
+            else:
+                vectors[annotation_id] = vector
+        return vectors
+
+    def live_rows(self):
+        return sum(len(rows) for rows in self.rows_by_video.values())
+
+    # Writes
+
+    @contextlib.contextmanager
+    def locked(self):
+        """ Hold the store's lock and, across processes (e.g. the workers of the web server), its lock file, so the
+            store is only written by one thread of one process at a time """
+        with self.lock:
+            if self.lock_depth == 0:
+                os.makedirs(self.path, exist_ok=True)
+                self.lock_file = open(self.lock_path(), "a")
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            self.lock_depth += 1
+            try:
+                yield
+            finally:
+                self.lock_depth -= 1
+                if self.lock_depth == 0:
+                    # Closing the file releases its lock
+                    self.lock_file.close()
+                    self.lock_file = None
+
+    def put(self, video_id, annotation_id, vector):
+        self.put_many({(video_id, annotation_id): vector})
+
+    def put_many(self, vectors, dtype="float32"):
+        """ Add or replace the vectors of some annotations, given as {(video_id, annotation_id): vector}.
+            The dtype is only used when the store is created. """
+        with self.locked():
+            # The logged edits are applied first, so they don't hide these vectors
+            self.apply_log()
+            self.write_rows(vectors, dtype)
+
+    def write_rows(self, vectors, dtype="float32"):
+        if not vectors:
+            return
+
+        with self.locked():
+            self.refresh()
+            keys = list(vectors)
+            matrix = np.stack([to_array(vector) for vector in vectors.values()])
+            if self.meta is None:
+                self.create(matrix.shape[1], dtype)
+
+            replaced_rows = [self.rows_by_video[video_id][annotation_id] for video_id, annotation_id in keys
+                             if annotation_id in self.rows_by_video.get(video_id, {})]
+
+            # Bytes left by an interrupted write are dropped first, so the new rows line up with their ids
+            with open(self.file_path("vectors"), "r+b") as f:
+                f.truncate(len(self.ids) * self.row_size())
+                f.seek(0, os.SEEK_END)
+                f.write(matrix.astype(self.meta["dtype"]).tobytes())
+            with open(self.file_path("ids"), "r+b") as f:
+                f.truncate(self.ids_size)
+                f.seek(0, os.SEEK_END)
+                f.write("".join(json.dumps(list(key)) + "\n" for key in keys).encode("utf-8"))
+
+            self.set_tombstones(replaced_rows)
+            self.refresh()
+            self.compact_if_needed()
+
+    def delete_many(self, keys):
+        """ Delete the vectors of some annotations, given as (video_id, annotation_id) """
+        with self.locked():
+            self.apply_log()
+            self.delete_rows(keys)
+
+    def delete_rows(self, keys):
+        with self.locked():
+            self.refresh()
+            rows = [self.rows_by_video[video_id][annotation_id] for video_id, annotation_id in keys
+                    if annotation_id in self.rows_by_video.get(video_id, {})]
+            if not rows:
+                return
+            self.set_tombstones(rows)
+            self.refresh()
+            self.compact_if_needed()
+
+    def delete(self, video_id, annotation_id):
+        self.delete_many([(video_id, annotation_id)])
+
+    def log_put(self, video_id, annotation_id, vector):
+        """ Add or replace the vector of an annotation by appending it to the log """
+        vector = base64.b64encode(to_array(vector).astype(np.float32).tobytes()).decode("ascii")
+        self.append_log({"key": [video_id, annotation_id], "vector": vector})
+
+    def log_delete(self, video_id, annotation_id):
+        """ Delete the vector of an annotation by appending its deletion to the log """
+        self.append_log({"key": [video_id, annotation_id], "vector": None})
+
+    def append_log(self, entry):
+        with self.locked():
+            self.read_log()
+            os.makedirs(self.path, exist_ok=True)
+            with open(self.log_path(), "ab") as f:
+                # Bytes left by an interrupted write are dropped first, so the edit starts its own line
+                f.truncate(self.log_size)
+                if self.log_id is None:
+                    f.write((json.dumps({"log": uuid.uuid4().hex}) + "\n").encode("utf-8"))
+                f.write((json.dumps(entry) + "\n").encode("utf-8"))
+                f.flush()
+                os.fsync(f.fileno())
+            self.read_log()
+
+            if self.log_entries >= LOG_ENTRIES_TO_APPLY:
+                self.schedule_apply_log()
+
+    def schedule_apply_log(self):
+        """ Apply the log in a background thread, unless this process already scheduled it """
+        if self.log_apply_pending != os.getpid():
+            self.log_apply_pending = os.getpid()
+            log_executor().submit(self.apply_log)
+
+    def apply_log(self):
+        """ Write the edits of the log to the store, then remove the log """
+        with self.locked():
+            self.log_apply_pending = None
+            self.refresh()
+            if not self.log_by_video:
+                return
+
+            edits = [((video_id, annotation_id), vector) for video_id, vectors in self.log_by_video.items()
+                     for annotation_id, vector in vectors.items()]
+            self.write_rows({key: vector for key, vector in edits if vector is not None})
+            self.delete_rows([key for key, vector in edits if vector is None])
+
+            # Until the log is removed, its edits are read over the same vectors in the store
+            os.remove(self.log_path())
+            self.refresh()
+
+    def set_tombstones(self, rows):
+        if not rows:
+            return
+
+        # Read from disk, under the lock, so the tombstones set since the store was read are kept
+        current = self.load_tombstones()
+        tombstones = np.zeros(max(len(current), (len(self.ids) + 7) // 8), dtype=np.uint8)
+        tombstones[:len(current)] = current
+        for row in rows:
+            tombstones[row // 8] |= 1 << (row % 8)
+
+        tmp_path = self.file_path("tombstones") + ".tmp"
+        tombstones.tofile(tmp_path)
+        os.replace(tmp_path, self.file_path("tombstones"))
+        self.write_meta(dict(self.meta, tombstones=self.meta.get("tombstones", 0) + 1))
+
+    def create(self, dim, dtype):
+        os.makedirs(self.path, exist_ok=True)
+        self.write_generation(0, dim, dtype, np.zeros((0, dim), dtype=dtype), [])
+
+    def compact_if_needed(self):
+        dead_rows = len(self.ids) - self.live_rows()
+        if dead_rows >= MIN_DEAD_ROWS_TO_COMPACT and dead_rows > self.live_rows():
+            self.compact()
+
+    def compact(self):
+        """ Rewrite the store without its dead rows, as a new generation """
+        with self.locked():
+            self.refresh()
+            if self.meta is None:
+                return
+
+            keys = [(video_id, annotation_id) for video_id, video_rows in self.rows_by_video.items()
+                    for annotation_id in video_rows]
+            rows = [self.rows_by_video[video_id][annotation_id] for video_id, annotation_id in keys]
+            matrix = self.matrix[rows] if rows else np.zeros((0, self.meta["dim"]), dtype=self.meta["dtype"])
+
+            previous_generation = self.generation
+            self.write_generation(previous_generation + 1, self.meta["dim"], self.meta["dtype"], matrix, keys)
+            for extension in ("vectors", "ids", "tombstones"):
+                if os.path.exists(self.file_path(extension, previous_generation)):
+                    os.remove(self.file_path(extension, previous_generation))
+            self.load()
+
+    def write_generation(self, generation, dim, dtype, matrix, keys):
+        """ Write the files of a generation of the store, then point the store to it """
+        np.ascontiguousarray(matrix, dtype=dtype).tofile(self.file_path("vectors", generation))
+        with open(self.file_path("ids", generation), "w") as f:
+            f.write("".join(json.dumps(list(key)) + "\n" for key in keys))
+        np.zeros(0, dtype=np.uint8).tofile(self.file_path("tombstones", generation))
+
+        self.write_meta({"dim": dim, "dtype": dtype, "generation": generation, "tombstones": 0})
+        self.load()
+
+    def write_meta(self, meta):
+        tmp_path = self.meta_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path())
+
+
+def open_store(name):
+    """ Get the store of an embedding type, shared by the whole process. The first time a store is opened, the
+        embeddings of its legacy pickle, if any, are migrated to it """
+    with stores_lock:
+        if name not in stores:
+            store = VectorStore(name)
+            if name in LEGACY_PICKLES and os.path.exists(LEGACY_PICKLES[name]):
+                with store.locked():
+                    # Another process may have migrated it meanwhile
+                    store.refresh()
+                    if store.meta is None:
+                        migrate_pickle(store, LEGACY_PICKLES[name])
+                    elif os.path.exists(LEGACY_PICKLES[name]):
+                        os.replace(LEGACY_PICKLES[name], LEGACY_PICKLES[name] + MIGRATED_EXTENSION)
+            stores[name] = store
+
+            # The edits logged before the process stopped are applied once it starts
+            if store.log_entries >= LOG_ENTRIES_TO_APPLY:
+                store.schedule_apply_log()
+        return stores[name]
+
+
+def migrate_pickle(store, pickle_path):
+    """ Copy the embeddings of a pickled {video_id: {annotation_id: tensor}} dict to a store, then rename the pickle
+        with MIGRATED_EXTENSION, so it is no longer migrated but kept as a backup """
+    print("Migrating", pickle_path, "to the vector store", store.name, flush=True)
+    with open(pickle_path, "rb") as f:
+        embeddings = CPU_Unpickler(f).load()
+
+    store.put_many({(video_id, annotation_id): embedding
+                    for video_id, video_embeddings in embeddings.items()
+                    for annotation_id, embedding in video_embeddings.items() if embedding is not None})
+    os.replace(pickle_path, pickle_path + MIGRATED_EXTENSION)
@@ -0,0 +1,127 @@
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+from person_tracker import iou as box_iou
+
+MASK_SIZE = 512  # side of the square input of the segmentation model, RMBG-1.4 was trained with 1024
+MASK_REUSE_THRESHOLD = 4  # mean absolute difference (0-255) between consecutive frames below which a mask is reused
+MASK_REUSE_MIN_IOU = 0.95  # IoU between the crop boxes of consecutive frames above which a mask can be reused
+THUMBNAIL_SIZE = (32, 32)
+MAX_TRACKED_GROUPS = 256  # groups whose last mask is kept, each one takes mask_size^2 bytes
+
+
+class LowResBackgroundRemover:
+    """ Removes the background of the cropped frames using RMBG-1.4 at a reduced resolution.
+
+        The segmentation masks of a whole batch are computed at once on a downscaled mask_size x mask_size
+        tensor and then upsampled and applied to the full resolution crops. Consecutive frames of the same
+        group (e.g. the same annotation) that were cropped to (nearly) the same box and barely differ from the last
+        frame whose mask was inferred reuse that mask instead of running the model. A lower mask_size and a higher
+        reuse_threshold trade quality for speed. """
+
+    def __init__(self, model, device, mask_size=MASK_SIZE, reuse_threshold=MASK_REUSE_THRESHOLD):
+        self.model = model
+        self.device = device
+        self.mask_size = mask_size
+        self.reuse_threshold = reuse_threshold
+        # Thumbnail, mask, crop box and size of the last frame of each group whose mask was inferred
+        self.anchors = OrderedDict()
+
+    def remove_background(self, images, groups=None, boxes=None):
+        """ Remove the background of the images, returning RGBA images where the background is transparent.
+            The groups identify which images are consecutive frames of the same sequence and the boxes, when known,
+            where each image was cropped from its frame (None for a whole frame). """
+        if groups is None:
+            groups = [None] * len(images)
+        if boxes is None:
+            boxes = [None] * len(images)
+
+        thumbnails = [np.asarray(image.convert("L").resize(THUMBNAIL_SIZE), dtype=np.float32) for image in images]
+
+        # Each frame either reuses the mask of its group's anchor frame, if it was cropped to the same place and
+        # barely changed since, or becomes the new anchor and has its mask inferred. Masks of anchors from this
+        # batch are referenced by index.
+        masks = [None] * len(images)
+        to_infer = []
+        for i, (group, frame_thumbnail, box) in enumerate(zip(groups, thumbnails, boxes)):
+            anchor = self.anchors.get(group) if group is not None else None
+            if anchor is not None and self.reuse_threshold > 0 and \
+                    same_crop(anchor[2], anchor[3], box, images[i].size) and \
+                    np.abs(frame_thumbnail - anchor[0]).mean() < self.reuse_threshold:
+                masks[i] = anchor[1]
+            else:
+                masks[i] = i
+                to_infer.append(i)
+                self.set_anchor(group, frame_thumbnail, i, box, images[i].size)
+
+        inferred = self.infer_masks([images[i] for i in to_infer])
+        for i, mask in zip(to_infer, inferred):
+            masks[i] = mask
+
+        masks = [masks[mask] if isinstance(mask, int) else mask for mask in masks]
+        for group, (anchor_thumbnail, anchor_mask, anchor_box, anchor_size) in list(self.anchors.items()):
+            if isinstance(anchor_mask, int):
+                self.anchors[group] = (anchor_thumbnail, masks[anchor_mask], anchor_box, anchor_size)
+
+        return [apply_mask(image, mask) for image, mask in zip(images, masks)]
+
+    def set_anchor(self, group, frame_thumbnail, mask, box, size):
+        if group is None:
+            return
+        self.anchors[group] = (frame_thumbnail, mask, box, size)
+        self.anchors.move_to_end(group)
+        while len(self.anchors) > MAX_TRACKED_GROUPS:
+            self.anchors.popitem(last=False)
+
+    def infer_masks(self, images):
+        """ Compute the low resolution masks of the images in a single batch, as uint8 tensors """
+        if not images:
+            return []
+
+        batch = torch.cat([preprocess_image(image, self.mask_size) for image in images]).to(self.device)
+
+        with torch.no_grad():
+            result = self.model(batch)
+
+        masks = result[0][0].detach().cpu()
+
+        # Normalize each mask to [0, 255], as the original pipeline does
+        normalized_masks = []
+        for mask in masks:
+            mask_max, mask_min = torch.max(mask), torch.min(mask)
+            mask = (mask - mask_min) / (mask_max - mask_min + 1e-8)
+            normalized_masks.append((mask * 255).to(torch.uint8))
+
+        return normalized_masks
+
+
+def same_crop(anchor_box, anchor_size, box, size):
+    """ Whether a frame was cropped close enough to its group's anchor frame for the anchor's mask to fit it:
+        to boxes overlapping by MASK_REUSE_MIN_IOU or, when the boxes are unknown, to the same size """
+    if anchor_box is None or box is None:
+        return anchor_box is None and box is None and anchor_size == size
+    return box_iou(anchor_box, box) >= MASK_REUSE_MIN_IOU
+
+
+def preprocess_image(image, size):
+    """ Resize an image to size x size and normalize it as the RMBG-1.4 model expects """
+    image_tensor = torch.tensor(np.asarray(image.convert("RGB")), dtype=torch.float32).permute(2, 0, 1)
+    image_tensor = F.interpolate(image_tensor.unsqueeze(0), size=(size, size), mode="bilinear")
+    image_tensor = image_tensor / 255.0
+    return image_tensor - 0.5
+
+
+def apply_mask(image, mask):
+    """ Upsample a low resolution mask to the size of the image and use it as the image's alpha channel """
+    width, height = image.size
+    mask = mask.reshape(1, 1, *mask.shape[-2:]).float()
+    mask = F.interpolate(mask, size=(height, width), mode="bilinear")
+    mask = Image.fromarray(mask.squeeze(0).squeeze(0).clamp(0, 255).numpy().astype(np.uint8))
+
+    no_background_image = Image.new("RGBA", image.size, (0, 0, 0, 0))
+    no_background_image.paste(image, mask=mask)
+    return no_background_image
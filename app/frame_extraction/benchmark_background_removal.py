@@ -0,0 +1,82 @@
+""" Benchmark of the background removal modes of the object detector.
+
+Compares the RMBG-1.4 pipeline used by default, at full resolution and one image at a time, with the low
+resolution batched mode for several mask sizes, with and without mask reuse across consecutive frames.
+For each mode it reports the throughput in images/s and the mean IoU of its masks against the pipeline's.
+Runs in the object_detectors_env environment.
+
+Usage: python benchmark_background_removal.py <frames_dir> [mask_size ...]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+import object_detector
+from background_remover import LowResBackgroundRemover, MASK_REUSE_THRESHOLD
+
+MAX_FRAMES = 256
+MASK_SIZES = [1024, 512, 320]
+
+
+def load_frames(frames_dir):
+    """ Get the paths of the frames inside frames_dir, grouped by the directory they are in (one per annotation) """
+    frames = []
+    for root, _, files in sorted(os.walk(frames_dir)):
+        for file in sorted(files):
+            if file.endswith(".png"):
+                frames.append((os.path.join(root, file), root))
+    return frames[:MAX_FRAMES]
+
+
+def alpha_mask(image):
+    """ Binary mask of the person from the alpha channel of an image without background """
+    return np.asarray(image.getchannel("A")) > 127
+
+
+def iou(mask_a, mask_b):
+    union = np.logical_or(mask_a, mask_b).sum()
+    return np.logical_and(mask_a, mask_b).sum() / union if union > 0 else 1.0
+
+
+def run_in_batches(function, images, groups):
+    outputs = []
+    start = time.perf_counter()
+    for i in range(0, len(images), object_detector.BATCH_SIZE):
+        outputs += function(images[i:i + object_detector.BATCH_SIZE], groups[i:i + object_detector.BATCH_SIZE])
+    return outputs, len(images) / (time.perf_counter() - start)
+
+
+def main(frames_dir, mask_sizes):
+    detector = object_detector.ObjectDetector(backend="torch")
+
+    frames = load_frames(frames_dir)
+    images = [Image.open(image_path).convert("RGB") for image_path, _ in frames]
+    groups = [group for _, group in frames]
+
+    # The background is removed from the person crops, as in the pre-processing
+    crops = []
+    for i in range(0, len(images), object_detector.BATCH_SIZE):
+        batch = images[i:i + object_detector.BATCH_SIZE]
+        crops += detector.crop_person_boxes(batch, detector.detect_person_boxes(batch))
+
+    print(f"Benchmarking {len(crops)} frames", flush=True)
+
+    reference, images_per_second = run_in_batches(lambda batch, _: detector.segmentation_model(batch), crops, groups)
+    reference_masks = [alpha_mask(image) for image in reference]
+    print(f"pipeline                      {images_per_second:8.2f} images/s   mask IoU 1.000", flush=True)
+
+    for mask_size in mask_sizes:
+        for reuse_threshold in (0, MASK_REUSE_THRESHOLD):
+            remover = LowResBackgroundRemover(detector.segmentation_model.model, detector.device,
+                                              mask_size=mask_size, reuse_threshold=reuse_threshold)
+            outputs, images_per_second = run_in_batches(remover.remove_background, crops, groups)
+            mean_iou = np.mean([iou(alpha_mask(image), mask) for image, mask in zip(outputs, reference_masks)])
+            print(f"lowres {mask_size:4d}px reuse {reuse_threshold:4.1f}    {images_per_second:8.2f} images/s   "
+                  f"mask IoU {mean_iou:.3f}", flush=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], [int(size) for size in sys.argv[2:]] or MASK_SIZES)
@@ -0,0 +1,76 @@
+""" Check of the mask reuse of the low resolution background removal.
+
+Removes the background of consecutive frames of one annotation with a stand-in segmentation model that counts the
+frames it runs on. The frames are uniform, so their thumbnails never differ: a frame cropped to the same box as its
+group's anchor must reuse the anchor's mask, while a frame whose crop shifted or was resized must have its own mask
+inferred. Exits with an error otherwise. Runs in the object_detectors_env environment.
+
+Usage: python check_mask_reuse.py
+"""
+import sys
+
+import torch
+from PIL import Image
+
+from background_remover import LowResBackgroundRemover
+
+MASK_SIZE = 64
+FRAME_SIZE = (640, 480)
+BOX = [100, 40, 400, 440]
+
+
+class CountingModel:
+    """ Segmentation model that keeps the whole image and counts the images it was run on """
+
+    def __init__(self):
+        self.inferred = 0
+
+    def __call__(self, batch):
+        self.inferred += len(batch)
+        return [[torch.ones(len(batch), 1, *batch.shape[-2:])]]
+
+
+def remove_background(remover, frame, box):
+    """ Remove the background of a frame cropped to a box, as the frames of the annotation "annotation" """
+    crop = frame.crop(box) if box is not None else frame.copy()
+    return remover.remove_background([crop], ["annotation"], [box])[0]
+
+
+def main():
+    model = CountingModel()
+    remover = LowResBackgroundRemover(model, "cpu", mask_size=MASK_SIZE)
+    frame = Image.new("RGB", FRAME_SIZE, (128, 128, 128))
+
+    shifted_box = [BOX[0] + 150, BOX[1], BOX[2] + 150, BOX[3]]
+    resized_box = [BOX[0], BOX[1], BOX[2] - 100, BOX[3]]
+    # (frame's crop box, whether its mask must be inferred)
+    steps = [
+        ("first frame", BOX, True),
+        ("same box", BOX, False),
+        ("box shifted by one pixel", [BOX[0] + 1, BOX[1], BOX[2] + 1, BOX[3]], False),
+        ("shifted box", shifted_box, True),
+        ("same shifted box", shifted_box, False),
+        ("resized box", resized_box, True),
+        ("whole frame", None, True),
+        ("whole frame again", None, False),
+    ]
+
+    failed = False
+    for name, box, must_infer in steps:
+        inferred = model.inferred
+        image = remove_background(remover, frame, box)
+        was_inferred = model.inferred > inferred
+
+        expected_size = (box[2] - box[0], box[3] - box[1]) if box is not None else frame.size
+        ok = was_inferred == must_infer and image.size == expected_size
+        failed |= not ok
+        print(f"{name:25s} mask {'inferred' if was_inferred else 'reused':8s} {'OK' if ok else 'FAILED'}", flush=True)
+
+    if failed:
+        print("Masks are NOT reused only on matching crops", flush=True)
+        sys.exit(1)
+    print("Masks are reused only on matching crops", flush=True)
+
+
+if __name__ == "__main__":
+    main()
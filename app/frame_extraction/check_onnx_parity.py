@@ -0,0 +1,61 @@
+""" Parity check between the PyTorch and the ONNX Runtime backends of the object detector.
+
+Runs the person detection and the low resolution background removal of both backends on the same frames and
+compares the boxes and the masks with IoU. Exits with an error if the mean IoU of the boxes or of the masks is
+below MIN_IOU. Runs in the object_detectors_env environment.
+
+Usage: python check_onnx_parity.py <frames_dir> [--quantize]
+"""
+import sys
+
+import numpy as np
+from PIL import Image
+
+import object_detector
+from benchmark_background_removal import load_frames, alpha_mask, iou
+from person_tracker import iou as box_iou
+
+MIN_IOU = 0.9
+
+
+def detect(detector, images):
+    """ Get the person boxes and the images without background, in batches """
+    boxes, masked_images = [], []
+    for i in range(0, len(images), object_detector.BATCH_SIZE):
+        batch = [image.copy() for image in images[i:i + object_detector.BATCH_SIZE]]
+        batch_boxes = detector.detect_person_boxes(batch)
+        crops = detector.crop_person_boxes(batch, batch_boxes)
+        boxes += batch_boxes
+        masked_images += detector.background_remover.remove_background(crops)
+    return boxes, masked_images
+
+
+def main(frames_dir, quantize):
+    images = [Image.open(image_path).convert("RGB") for image_path, _ in load_frames(frames_dir)]
+
+    torch_boxes, torch_images = detect(object_detector.ObjectDetector(backend="torch"), images)
+    onnx_boxes, onnx_images = detect(object_detector.ObjectDetector(backend="onnx", quantize=quantize), images)
+
+    boxes_iou = [box_iou(torch_box, onnx_box) if torch_box is not None and onnx_box is not None
+                 else float(torch_box is None and onnx_box is None)
+                 for torch_box, onnx_box in zip(torch_boxes, onnx_boxes)]
+
+    # The masks are only comparable when both backends cropped the same box
+    masks_iou = [iou(alpha_mask(torch_image), alpha_mask(onnx_image))
+                 for torch_image, onnx_image in zip(torch_images, onnx_images)
+                 if torch_image.size == onnx_image.size]
+
+    mean_boxes_iou = float(np.mean(boxes_iou)) if boxes_iou else 1.0
+    mean_masks_iou = float(np.mean(masks_iou)) if masks_iou else 1.0
+    print(f"{len(images)} frames, quantized: {quantize}", flush=True)
+    print(f"Boxes mean IoU: {mean_boxes_iou:.3f}", flush=True)
+    print(f"Masks mean IoU: {mean_masks_iou:.3f} ({len(masks_iou)} frames with the same crop)", flush=True)
+
+    if mean_boxes_iou < MIN_IOU or mean_masks_iou < MIN_IOU:
+        print("ONNX backend is NOT in parity with the PyTorch backend", flush=True)
+        sys.exit(1)
+    print("ONNX backend is in parity with the PyTorch backend", flush=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], "--quantize" in sys.argv[2:])
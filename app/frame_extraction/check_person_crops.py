@@ -0,0 +1,77 @@
+""" Check of the person crops of the object detector.
+
+Runs ObjectDetector.detect_person_boxes on the detections of a stand-in DETR model and crops the frames with
+crop_person_boxes, then checks that each frame gives exactly one image: the crop of its most confident person box,
+the whole frame when no person was found, and a crop kept inside the frame when the box overflows it.
+Exits with an error otherwise. Runs in the object_detectors_env environment.
+
+Usage: python check_person_crops.py
+"""
+import sys
+
+import torch
+from PIL import Image
+
+from object_detector import ObjectDetector
+
+FRAME_SIZE = (640, 480)
+PERSON_LABEL = 1
+CHAIR_LABEL = 62
+
+
+class StubProcessor:
+    """ DETR image processor returning the given detections, one {"scores", "boxes", "labels"} dict per image """
+
+    def __init__(self, detections):
+        self.detections = detections
+
+    def __call__(self, images, return_tensors):
+        return {"pixel_values": torch.zeros(len(images), 3, 8, 8)}
+
+    def post_process_object_detection(self, outputs, target_sizes, threshold):
+        return [{"scores": torch.tensor([score for score, _, _ in detections]),
+                 "boxes": torch.tensor([box for _, box, _ in detections], dtype=torch.float32).reshape(-1, 4),
+                 "labels": torch.tensor([label for _, _, label in detections], dtype=torch.long)}
+                for detections in self.detections]
+
+
+def stub_detector(detections):
+    """ ObjectDetector whose person detection returns the given detections, without loading the models """
+    detector = ObjectDetector.__new__(ObjectDetector)
+    detector.device = "cpu"
+    detector.crop_processor = StubProcessor(detections)
+    detector.crop_model = lambda **inputs: None
+    return detector
+
+
+def main():
+    # (name, detections of the frame as (score, box, label), expected box, expected size of the frame's image)
+    frames = [
+        ("two persons", [(0.95, [10, 10, 110, 210], PERSON_LABEL), (0.99, [200, 40, 400, 440], PERSON_LABEL)],
+         [200, 40, 400, 440], (200, 400)),
+        ("person and object", [(0.999, [0, 0, 50, 50], CHAIR_LABEL), (0.92, [300, 100, 500, 400], PERSON_LABEL)],
+         [300, 100, 500, 400], (200, 300)),
+        ("no person", [(0.98, [0, 0, 50, 50], CHAIR_LABEL)], None, FRAME_SIZE),
+        ("nothing detected", [], None, FRAME_SIZE),
+        ("box overflowing the frame", [(0.97, [-20, 280, 700, 520], PERSON_LABEL)], [-20, 280, 700, 520], (640, 200)),
+    ]
+
+    detector = stub_detector([detections for _, detections, _, _ in frames])
+    images = [Image.new("RGB", FRAME_SIZE) for _ in frames]
+    boxes = detector.detect_person_boxes(images)
+    crops = detector.crop_person_boxes(images, boxes)
+
+    failed = len(boxes) != len(frames) or len(crops) != len(frames)
+    for (name, _, expected_box, expected_size), box, crop in zip(frames, boxes, crops):
+        ok = box == expected_box and crop.size == expected_size
+        failed |= not ok
+        print(f"{name:26s} box {str(box):22s} crop {crop.size} {'OK' if ok else 'FAILED'}", flush=True)
+
+    if failed:
+        print("The frames do NOT each give their own person crop", flush=True)
+        sys.exit(1)
+    print("The frames each give their own person crop", flush=True)
+
+
+if __name__ == "__main__":
+    main()
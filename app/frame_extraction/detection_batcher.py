@@ -0,0 +1,163 @@
+import queue
+import threading
+import time
+
+from PIL import Image
+
+BATCH_SIZE = 16
+MAX_BATCH_LATENCY = 0.1  # seconds to wait for more frames before running an under-filled batch
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+class BatchJob:
+    """ Frames of one cropping request, which are spread through one or more batches.
+        The frames are either image paths, whose results are saved in place, or in-memory images,
+        whose results are kept in the job. """
+
+    def __init__(self, job_id, frames):
+        self.job_id = job_id
+        self.frames = list(frames)
+        self.results = [None] * len(self.frames)
+        self.remaining = len(self.frames)
+        self.status = JOB_QUEUED if self.remaining else JOB_DONE
+        self.error = None
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+
+        if not self.remaining:
+            self.finished.set()
+
+    def load_frame(self, index):
+        frame = self.frames[index]
+        return Image.open(frame) if isinstance(frame, str) else frame
+
+    def set_result(self, index, image):
+        frame = self.frames[index]
+        if isinstance(frame, str):
+            image.save(frame)
+            image.close()
+        else:
+            self.results[index] = image
+
+    def release(self):
+        """ Drop the in-memory frames and results once they were sent back, keeping only the job status """
+        self.frames = []
+        self.results = []
+
+    def frames_started(self):
+        with self.lock:
+            if self.status == JOB_QUEUED:
+                self.status = JOB_RUNNING
+
+    def frames_finished(self, n_frames, error=None):
+        with self.lock:
+            if error is not None:
+                self.status = JOB_FAILED
+                self.error = str(error)
+            self.remaining -= n_frames
+            if self.remaining <= 0:
+                if self.status != JOB_FAILED:
+                    self.status = JOB_DONE
+                self.finished.set()
+
+    def wait(self):
+        self.finished.wait()
+        return self.to_dict()
+
+    def to_dict(self):
+        with self.lock:
+            return {"job_id": self.job_id, "status": self.status, "error": self.error}
+
+
+class DetectionBatcher:
+    """ Batching scheduler in front of the person cropping and background removal models.
+
+        Frames submitted by any job, from any annotation or video, are collected in a single queue and
+        processed in full batches of batch_size. An under-filled batch is run at most max_latency
+        seconds after its first frame was taken from the queue. The results are saved back to the
+        original paths of the frames. """
+
+    def __init__(self, detector, batch_size=BATCH_SIZE, max_latency=MAX_BATCH_LATENCY):
+        self.detector = detector
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, job_id, frames, boxes=None):
+        """ Queue the frames of a job, given as image paths or images, and return the job, which can be waited on.
+            If the person boxes of the frames are already known, the person detection is skipped for those
+            frames, while the frames with a None box are still detected. """
+        job = BatchJob(job_id, frames)
+        if boxes is None:
+            boxes = [None] * len(job.frames)
+        for index, box in enumerate(boxes):
+            self.queue.put((index, job, box))
+        return job
+
+    def close(self):
+        """ Process the queued frames and stop the scheduler """
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        stop = False
+        while not stop:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            # Fill the batch until it is full or no frames arrive in time
+            batch = [item]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            self.process_batch(batch)
+
+    def process_batch(self, batch):
+        """ Run the models on a batch of frames and scatter the results back to their jobs """
+        # Count the frames of the batch per job to report the progress of each one
+        jobs = {}
+        for _, job, _ in batch:
+            jobs[job] = jobs.get(job, 0) + 1
+
+        for job in jobs:
+            job.frames_started()
+
+        error = None
+        try:
+            boxes = [box for _, _, box in batch]
+            images = [job.load_frame(index) for index, job, _ in batch]
+
+            # Only detect the person in the frames whose box isn't known yet
+            to_detect = [i for i, box in enumerate(boxes) if box is None]
+            if to_detect:
+                detected_boxes = self.detector.detect_person_boxes([images[i] for i in to_detect])
+                for i, box in zip(to_detect, detected_boxes):
+                    boxes[i] = box
+
+            cropped_images = self.detector.crop_person_boxes(images, boxes)
+            groups = [job.job_id for _, job, _ in batch]
+            masked_images = self.detector.detect_person_remove_background(cropped_images, groups, boxes)
+
+            for image, (index, job, _) in zip(masked_images, batch):
+                job.set_result(index, image)
+        except Exception as e:
+            print("Error processing batch:", e, flush=True)
+            error = e
+
+        for job, n_frames in jobs.items():
+            job.frames_finished(n_frames, error)
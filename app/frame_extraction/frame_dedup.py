@@ -0,0 +1,46 @@
+import numpy as np
+from PIL import Image
+
+HASH_SIZE = 8  # the hashes have HASH_SIZE * HASH_SIZE bits
+
+
+def perceptual_hash(frame):
+    """ Difference hash of a RGB frame: one bit per pixel of a small grayscale version of the frame, set if the pixel
+        is brighter than its right neighbour. Near-identical frames have hashes that differ in few bits. """
+    image = Image.fromarray(frame).convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR)
+    pixels = np.asarray(image, dtype=np.int16)
+    return int.from_bytes(np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes(), "big")
+
+
+def hash_distance(hash_1, hash_2):
+    """ Number of bits that differ between two hashes """
+    return bin(hash_1 ^ hash_2).count("1")
+
+
+class FrameDeduplicator:
+    """ Collapses the runs of near-identical consecutive frames of one annotation into their first frame, the
+        representative, weighted by the number of frames of the run. A frame is a duplicate if its hash is at most
+        max_distance bits away from the hash of the last representative; a negative max_distance keeps every frame. """
+
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        self.last_hash = None
+        self.weights = []
+
+    def push(self, frame_hash):
+        """ Returns whether the frame is a new representative, otherwise it is counted in the last one's weight """
+        if self.last_hash is not None and hash_distance(frame_hash, self.last_hash) <= self.max_distance:
+            self.weights[-1] += 1
+            return False
+
+        self.last_hash = frame_hash
+        self.weights.append(1)
+        return True
+
+
+def expand_weights(items, weights=None):
+    """ Repeat each item as many times as its weight, giving back one item per original frame. Without weights,
+        every item stands for a single frame. """
+    if weights is None:
+        return list(items)
+    return [item for item, weight in zip(items, weights) for _ in range(weight)]
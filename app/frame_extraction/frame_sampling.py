@@ -0,0 +1,177 @@
+from abc import ABC, abstractmethod
+
+import numpy as np
+from PIL import Image
+
+from app.utils import N_FRAMES_TO_DISPLAY
+
+THUMBNAIL_SIZE = (32, 32)
+SCENE_CHANGE_THRESHOLD = 12  # mean absolute difference (0-255) to the last kept frame above which a frame is kept
+MOTION_PEAK_THRESHOLD = 4  # mean absolute difference (0-255) to the previous frame below which motion is ignored
+
+# Frame samplers by policy name, see register_sampler
+SAMPLERS = {}
+
+
+def register_sampler(name):
+    """ Register a frame sampler class under a policy name, so that it can be chosen in FRAME_SAMPLING """
+
+    def register(sampler_class):
+        SAMPLERS[name] = sampler_class
+        return sampler_class
+
+    return register
+
+
+def parse_policy(policy):
+    """ Parse a sampling policy given as "<name>" or "<name>:<value>" (e.g. "all", "fps:2", "uniform:8",
+        "scene:12", "motion:4") into the dict stored in the manifests, e.g. {"name": "uniform", "value": 8.0} """
+    if isinstance(policy, dict):
+        return policy
+
+    name, _, value = policy.partition(":")
+    if name not in SAMPLERS:
+        raise ValueError(f"Unknown frame sampling policy {name}, expected one of {', '.join(SAMPLERS)}")
+
+    return {"name": name, "value": float(value) if value else None}
+
+
+def create_sampler(policy, start_ms, end_ms):
+    """ Create the sampler that selects the frames of an annotation from start_ms to end_ms """
+    policy = parse_policy(policy)
+    sampler_class = SAMPLERS[policy["name"]]
+    if policy.get("value") is None:
+        return sampler_class(start_ms, end_ms)
+    return sampler_class(start_ms, end_ms, policy["value"])
+
+
+def select_display_frames(frames, n_frames=N_FRAMES_TO_DISPLAY):
+    """ Select #n_frames evenly spaced frames, in the given order, to be displayed """
+
+    # Calculate the step size
+    if len(frames) <= n_frames:
+        step_size = 1
+    else:
+        step_size = (len(frames) - 1) // n_frames + 1
+
+    return frames[::step_size][:n_frames]
+
+
+def thumbnail(frame):
+    """ Small grayscale version of a RGB frame, used to cheaply compare frames """
+    return np.asarray(Image.fromarray(frame).convert("L").resize(THUMBNAIL_SIZE), dtype=np.float32)
+
+
+class FrameSampler(ABC):
+    """ Selects the frames of one annotation while the video is decoded, so that the frames left out are never
+        cropped, stored nor encoded. Frames are pushed in time order and the kept ones are returned, possibly
+        later than when they were pushed. """
+
+    def __init__(self, start_ms, end_ms):
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+
+    @abstractmethod
+    def push(self, timestamp, frame):
+        """ Get the (timestamp, frame) kept after this frame is decoded """
+        pass
+
+    def flush(self):
+        """ Get the (timestamp, frame) still kept once the annotation ended """
+        return []
+
+
+@register_sampler("all")
+class AllFramesSampler(FrameSampler):
+    """ Keeps every frame """
+
+    def push(self, timestamp, frame):
+        return [(timestamp, frame)]
+
+
+@register_sampler("fps")
+class FixedRateSampler(FrameSampler):
+    """ Keeps at most fps frames per second """
+
+    def __init__(self, start_ms, end_ms, fps=1):
+        super().__init__(start_ms, end_ms)
+        self.interval = 1000 / fps
+        self.next_timestamp = start_ms
+
+    def push(self, timestamp, frame):
+        if timestamp < self.next_timestamp:
+            return []
+        self.next_timestamp += self.interval * ((timestamp - self.next_timestamp) // self.interval + 1)
+        return [(timestamp, frame)]
+
+
+@register_sampler("uniform")
+class UniformSampler(FrameSampler):
+    """ Keeps n_frames frames evenly spaced along the annotation, the first ones decoded at each target time """
+
+    def __init__(self, start_ms, end_ms, n_frames=4):
+        super().__init__(start_ms, end_ms)
+        n_frames = max(1, int(n_frames))
+        step = (end_ms - start_ms) / n_frames
+        self.targets = [start_ms + i * step for i in range(n_frames)]
+
+    def push(self, timestamp, frame):
+        if not self.targets or timestamp < self.targets[0]:
+            return []
+        # A single frame covers all the targets it passed, so short annotations get fewer frames
+        while self.targets and self.targets[0] <= timestamp:
+            self.targets.pop(0)
+        return [(timestamp, frame)]
+
+
+@register_sampler("scene")
+class SceneChangeSampler(FrameSampler):
+    """ Keeps the first frame and every frame that differs enough from the last kept one """
+
+    def __init__(self, start_ms, end_ms, threshold=SCENE_CHANGE_THRESHOLD):
+        super().__init__(start_ms, end_ms)
+        self.threshold = threshold
+        self.last_kept = None
+
+    def push(self, timestamp, frame):
+        frame_thumbnail = thumbnail(frame)
+        if self.last_kept is not None and np.abs(frame_thumbnail - self.last_kept).mean() <= self.threshold:
+            return []
+        self.last_kept = frame_thumbnail
+        return [(timestamp, frame)]
+
+
+@register_sampler("motion")
+class MotionPeakSampler(FrameSampler):
+    """ Keeps the frames where the motion, measured as the difference to the previous frame, peaks.
+        The first frame is always kept, so an annotation without motion still has one frame. """
+
+    def __init__(self, start_ms, end_ms, threshold=MOTION_PEAK_THRESHOLD):
+        super().__init__(start_ms, end_ms)
+        self.threshold = threshold
+        self.previous_thumbnail = None
+        self.candidate = None  # (timestamp, frame, motion) of the previous frame
+        self.rising = True
+
+    def push(self, timestamp, frame):
+        frame_thumbnail = thumbnail(frame)
+        if self.previous_thumbnail is None:
+            self.previous_thumbnail = frame_thumbnail
+            return [(timestamp, frame)]
+
+        motion = np.abs(frame_thumbnail - self.previous_thumbnail).mean()
+        self.previous_thumbnail = frame_thumbnail
+
+        # The previous frame is a peak if the motion rose up to it and falls after it
+        kept = []
+        if self.candidate is not None and self.rising and motion < self.candidate[2] and \
+                self.candidate[2] > self.threshold:
+            kept.append(self.candidate[:2])
+        self.rising = self.candidate is None or motion >= self.candidate[2]
+        self.candidate = (timestamp, frame, motion)
+        return kept
+
+    def flush(self):
+        if self.candidate is not None and self.rising and self.candidate[2] > self.threshold:
+            return [self.candidate[:2]]
+        return []
@@ -0,0 +1,181 @@
+import functools
+import io
+import json
+import mmap
+import os
+import shutil
+import struct
+
+from PIL import Image
+
+from app.utils import FRAMES_PATH, FRAME_STORE
+
+PACK_EXTENSION = ".pack"
+PACK_MAGIC = b"SLVPACK1"
+PACK_FOOTER = struct.Struct("<Q8s")  # length of the index and magic number, at the end of a pack
+MAX_OPEN_PACKS = 256
+
+
+class FramePack:
+    """ Container with all the frames of an annotation, as a single memory mapped file.
+
+        The encoded frames are stored back to back, followed by a JSON index with the name, offset and size of each
+        frame, the length of the index and a magic number. Frames are read by index or name without decoding the
+        others. """
+
+    def __init__(self, pack_path):
+        with open(pack_path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        index_length, magic = PACK_FOOTER.unpack(self.data[-PACK_FOOTER.size:])
+        if magic != PACK_MAGIC:
+            raise ValueError(f"{pack_path} is not a frames pack")
+
+        index_start = len(self.data) - PACK_FOOTER.size - index_length
+        self.frames = json.loads(self.data[index_start:index_start + index_length].decode("utf-8"))["frames"]
+        self.positions = {name: position for position, (name, _, _) in enumerate(self.frames)}
+
+    def names(self):
+        return [name for name, _, _ in self.frames]
+
+    def read(self, index):
+        """ Get the encoded bytes of the frame at an index """
+        _, offset, size = self.frames[index]
+        return self.data[offset:offset + size]
+
+    def read_name(self, name):
+        if name not in self.positions:
+            return None
+        return self.read(self.positions[name])
+
+    def __len__(self):
+        return len(self.frames)
+
+
+def write_pack(pack_path, frames):
+    """ Write the frames, given as (name, encoded bytes), in a pack, replacing it only once it is fully written """
+    tmp_path = pack_path + ".tmp"
+    index = []
+    with open(tmp_path, "wb") as f:
+        for name, data in frames:
+            index.append((name, f.tell(), len(data)))
+            f.write(data)
+
+        index = json.dumps({"frames": index}).encode("utf-8")
+        f.write(index)
+        f.write(PACK_FOOTER.pack(len(index), PACK_MAGIC))
+    os.replace(tmp_path, pack_path)
+
+
+@functools.lru_cache(maxsize=MAX_OPEN_PACKS)
+def cached_pack(pack_path, modified_time):
+    # The modification time is part of the key, so rewritten packs are opened again
+    return FramePack(pack_path)
+
+
+def open_pack(pack_path):
+    """ Get the pack at a path, or None if there is none, keeping the recently used ones open """
+    try:
+        return cached_pack(pack_path, os.stat(pack_path).st_mtime_ns)
+    except FileNotFoundError:
+        return None
+
+
+def annotation_frames_dir(tier, video_id, annotation_id):
+    """ Folder of the frames of an annotation in the PNG layout, where each frame is a file """
+    return os.path.join(FRAMES_PATH, tier, video_id, annotation_id)
+
+
+def annotation_pack_path(tier, video_id, annotation_id):
+    """ Path of the pack of the frames of an annotation in the packed layout """
+    return annotation_frames_dir(tier, video_id, annotation_id) + PACK_EXTENSION
+
+
+def list_annotations(tier, video_id):
+    """ Get the ids of the annotations of a video with extracted frames, in either layout """
+    video_dir = os.path.join(FRAMES_PATH, tier, video_id)
+    if not os.path.isdir(video_dir):
+        return []
+
+    annotations = []
+    for entry in sorted(os.listdir(video_dir)):
+        if entry.endswith(PACK_EXTENSION):
+            annotations.append(entry[:-len(PACK_EXTENSION)])
+        elif os.path.isdir(os.path.join(video_dir, entry)):
+            annotations.append(entry)
+    return annotations
+
+
+def list_frames(tier, video_id, annotation_id):
+    """ Get the names of the frames of an annotation, in time order """
+    pack = open_pack(annotation_pack_path(tier, video_id, annotation_id))
+    if pack is not None:
+        return pack.names()
+
+    frames_dir = annotation_frames_dir(tier, video_id, annotation_id)
+    if not os.path.isdir(frames_dir):
+        return []
+    return sorted(os.listdir(frames_dir))
+
+
+def inside_frames_path(path):
+    """ Whether a path is inside the frames folder, once its ".." and links are resolved """
+    frames_path = os.path.realpath(FRAMES_PATH)
+    return os.path.commonpath([frames_path, os.path.realpath(path)]) == frames_path
+
+
+def read_frame(tier, video_id, annotation_id, frame_name):
+    """ Get the encoded bytes of a frame, or None if it doesn't exist or its path is outside the frames folder """
+    pack_path = annotation_pack_path(tier, video_id, annotation_id)
+    frame_path = os.path.join(annotation_frames_dir(tier, video_id, annotation_id), frame_name)
+    if not inside_frames_path(pack_path) or not inside_frames_path(frame_path):
+        return None
+
+    pack = open_pack(pack_path)
+    if pack is not None:
+        return pack.read_name(frame_name)
+
+    if not os.path.isfile(frame_path):
+        return None
+    with open(frame_path, "rb") as f:
+        return f.read()
+
+
+def open_frame(tier, video_id, annotation_id, frame_name):
+    """ Get a frame as an image, or None if it doesn't exist """
+    data = read_frame(tier, video_id, annotation_id, frame_name)
+    if data is None:
+        return None
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+
+def pack_annotation(tier, video_id, annotation_id):
+    """ In the packed layout, move the frame files of an annotation into its pack. The PNG bytes are kept as they
+        are, so the frames don't change. Does nothing in the PNG layout. """
+    if FRAME_STORE != "packed":
+        return
+
+    frames_dir = annotation_frames_dir(tier, video_id, annotation_id)
+    if not os.path.isdir(frames_dir):
+        return
+
+    frames = []
+    for frame_name in sorted(os.listdir(frames_dir)):
+        with open(os.path.join(frames_dir, frame_name), "rb") as f:
+            frames.append((frame_name, f.read()))
+
+    write_pack(annotation_pack_path(tier, video_id, annotation_id), frames)
+    shutil.rmtree(frames_dir)
+
+
+def delete_annotation(tier, video_id, annotation_id):
+    """ Delete the frames of an annotation, in either layout """
+    frames_dir = annotation_frames_dir(tier, video_id, annotation_id)
+    if os.path.exists(frames_dir):
+        shutil.rmtree(frames_dir)
+
+    pack_path = annotation_pack_path(tier, video_id, annotation_id)
+    if os.path.exists(pack_path):
+        os.remove(pack_path)
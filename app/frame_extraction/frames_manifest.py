@@ -0,0 +1,123 @@
+import json
+import os
+import threading
+
+from app.frame_extraction import frame_store
+from app.utils import MANIFESTS_PATH, FACIAL_EXPRESSIONS_ID
+
+# Serializes the updates of the manifests, which are read, changed and written back by several threads
+manifests_lock = threading.Lock()
+
+
+def manifest_path(video_id):
+    return os.path.join(MANIFESTS_PATH, f"{video_id}.json")
+
+
+def load_manifest(video_id):
+    """ Load the manifest of a video, which records how its frames were extracted, or an empty one """
+    path = manifest_path(video_id)
+    if not os.path.exists(path):
+        return {}
+
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(video_id, manifest):
+    """ Save the manifest of a video, replacing the previous one only once it is fully written """
+    path = manifest_path(video_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def update_manifest(video_id, **fields):
+    """ Set some fields of the manifest of a video, keeping the others """
+    with manifests_lock:
+        manifest = load_manifest(video_id)
+        manifest.update(fields)
+        save_manifest(video_id, manifest)
+    return manifest
+
+
+def update_annotations_frames(video_id, frames_paths, frames_timestamps, frames_weights=None, streamed_frames=None):
+    """ Record the frames kept for some facial expressions annotations of a video, given as
+        {annotation_id: [frame paths]}, {annotation_id: [frame timestamps in milliseconds]} and, when the frames were
+        deduplicated, {annotation_id: [number of frames each kept frame stands for]}.
+        The annotations streamed in memory only keep their display frames, their embeddings are generated from all
+        the frames kept while decoding, given in streamed_frames as {annotation_id: ([timestamps], [weights] or None)}
+        (see list_streamed_annotations) """
+    frames_weights = frames_weights or {}
+    streamed_frames = streamed_frames or {}
+    with manifests_lock:
+        manifest = load_manifest(video_id)
+        if "annotations" not in manifest:
+            # Start from the frames of the other annotations, when they were extracted before the manifests
+            # recorded them
+            manifest["annotations"] = {annotation_id: {"frames": frames, "timestamps": None, "weights": None}
+                                       for annotation_id, frames in list_extracted_frames(video_id).items()}
+
+        for annotation_id, paths in frames_paths.items():
+            manifest["annotations"][annotation_id] = {
+                "frames": [os.path.basename(path) for path in paths],
+                "timestamps": frames_timestamps.get(annotation_id),
+                "weights": frames_weights.get(annotation_id),
+            }
+            if annotation_id in streamed_frames:
+                timestamps, weights = streamed_frames[annotation_id]
+                manifest["annotations"][annotation_id]["streamed"] = {"timestamps": timestamps, "weights": weights}
+        save_manifest(video_id, manifest)
+
+
+def delete_annotation_frames(video_id, annotation_id):
+    with manifests_lock:
+        manifest = load_manifest(video_id)
+        if annotation_id in manifest.get("annotations", {}):
+            del manifest["annotations"][annotation_id]
+            save_manifest(video_id, manifest)
+
+
+def list_annotations(video_id):
+    """ Get the ids of the facial expressions annotations of a video with extracted frames """
+    manifest = load_manifest(video_id)
+    if "annotations" in manifest:
+        return list(manifest["annotations"])
+    return list(list_extracted_frames(video_id))
+
+
+def list_frames(video_id, annotation_id):
+    """ Get the file names of the frames of a facial expressions annotation, in time order """
+    manifest = load_manifest(video_id)
+    if annotation_id in manifest.get("annotations", {}):
+        return manifest["annotations"][annotation_id]["frames"]
+    return list_extracted_frames(video_id).get(annotation_id, [])
+
+
+def list_annotations_frames(video_id):
+    """ Get {annotation_id: ([frame names], [number of frames each frame stands for] or None)} of the facial
+        expressions annotations of a video, the weights being None if the frames were not deduplicated """
+    manifest = load_manifest(video_id)
+    if "annotations" in manifest:
+        return {annotation_id: (annotation["frames"], annotation.get("weights"))
+                for annotation_id, annotation in manifest["annotations"].items()}
+    return {annotation_id: (frames, None) for annotation_id, frames in list_extracted_frames(video_id).items()}
+
+
+def list_streamed_annotations(video_id):
+    """ Get {annotation_id: {"timestamps": [...], "weights": [...] or None}} of the frames kept while streaming the
+        facial expressions annotations of a video that were streamed, whose stored frames are only the displayed ones,
+        so their embeddings are generated by streaming them again """
+    manifest = load_manifest(video_id)
+    annotations = manifest.get("annotations", {})
+    return {annotation_id: annotation["streamed"] for annotation_id, annotation in annotations.items()
+            if annotation.get("streamed") is not None}
+
+
+def list_extracted_frames(video_id):
+    """ Get {annotation_id: [frame names]} from the frame store, for the videos extracted before the manifests
+        recorded the frames """
+    return {annotation_id: frame_store.list_frames(FACIAL_EXPRESSIONS_ID, video_id, annotation_id)
+            for annotation_id in frame_store.list_annotations(FACIAL_EXPRESSIONS_ID, video_id)}
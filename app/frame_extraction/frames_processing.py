@@ -1,202 +1,370 @@
-import datetime
 import os
 import sys
 import json
 import shutil
-import subprocess
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
-from app.utils import PHRASES_ID, FACIAL_EXPRESSIONS_ID, VIDEO_PATH, FRAMES_PATH, ANNOTATIONS_PATH
+from PIL import Image
+from app.eaf_parser.eaf_parser import convert_time_format_to_milliseconds
+from app.frame_extraction import frame_sampling, frame_store, frames_manifest, video_decoder
+from app.frame_extraction.object_detector_client import object_detector, JOB_DONE
+from app.utils import PHRASES_ID, FACIAL_EXPRESSIONS_ID, VIDEO_PATH, FRAMES_PATH, ANNOTATIONS_PATH, THUMBNAILS_PATH, \
+    N_FRAMES_TO_DISPLAY, DISPLAY_FRAME_SIZE, FRAME_MAX_HEIGHT, FRAME_SAMPLING, FRAME_DEDUP_DISTANCE
 
 THREAD_COUNT = 4
+PHRASES_THREAD_COUNT = 4  # videos whose phrases frames are extracted at the same time
+CROP_THREAD_COUNT = 16  # cropping jobs in flight, so the object detector service can batch frames across annotations
 
 
-def extract_frames():
-    """ Extract the frames from the videos and save them in the static/videofiles/frames folder. """
+def extract_frames(facial_expressions=True):
+    """ Extract the frames from the videos and save them in the static/videofiles/frames folder.
+        The facial expressions frames are skipped when they are processed in streaming mode.
+        The phrases frames of several videos are extracted in parallel, alongside the facial expressions frames. """
 
-    for i, video in enumerate(os.listdir(VIDEO_PATH)):
-        # Stop the loop after processing #N_VIDEOS_TO_PROCESS videos
-        # if i >= N_VIDEOS_TO_PROCESS:
-        #     break
+    with ThreadPoolExecutor(max_workers=PHRASES_THREAD_COUNT) as phrases_executor:
+        phrases_futures = []
 
-        # Define the paths for the video, phrases frames and facial expressions frames
-        video_path = os.path.join(VIDEO_PATH, video)
-        videoname, extension = os.path.splitext(video)
-        video_phrases_dir = os.path.join(FRAMES_PATH, PHRASES_ID, videoname)
-        video_facial_expressions_dir = os.path.join(FRAMES_PATH, FACIAL_EXPRESSIONS_ID, videoname)
-        annotation_path = os.path.join(ANNOTATIONS_PATH, f"{videoname}.json")
+        for i, video in enumerate(os.listdir(VIDEO_PATH)):
+            # Stop the loop after processing #N_VIDEOS_TO_PROCESS videos
+            # if i >= N_VIDEOS_TO_PROCESS:
+            #     break
 
-        if not os.path.isdir(video_facial_expressions_dir):
-            os.makedirs(video_facial_expressions_dir, exist_ok=True)
-            extract_facial_expressions_frames(video_path, video_facial_expressions_dir, annotation_path)
+            # Define the paths for the video, phrases frames and facial expressions frames
+            video_path = os.path.join(VIDEO_PATH, video)
+            videoname, extension = os.path.splitext(video)
+            video_phrases_dir = os.path.join(FRAMES_PATH, PHRASES_ID, videoname)
+            video_facial_expressions_dir = os.path.join(FRAMES_PATH, FACIAL_EXPRESSIONS_ID, videoname)
+            annotation_path = os.path.join(ANNOTATIONS_PATH, f"{videoname}.json")
+
+            if not os.path.isdir(video_phrases_dir):
+                os.makedirs(video_phrases_dir, exist_ok=True)
+                phrases_futures.append(phrases_executor.submit(extract_phrases_frames, video_path, video_phrases_dir,
+                                                               annotation_path))
+
+            if facial_expressions and not os.path.isdir(video_facial_expressions_dir):
+                os.makedirs(video_facial_expressions_dir, exist_ok=True)
+                extract_facial_expressions_frames(video_path, video_facial_expressions_dir, annotation_path)
+
+        # Wait for all futures to complete
+        for future in phrases_futures:
+            future.result()
 
-        if not os.path.isdir(video_phrases_dir):
-            os.makedirs(video_phrases_dir, exist_ok=True)
-            extract_phrases_frames(video_path, video_phrases_dir, annotation_path)
 
 def extract_facial_expressions_frames(video_path, facial_expressions_dir, annotation_path):
     """ Extract the facial expressions frames from the videos
-    and save them in the static/videofiles/frames folder, using
-    threading to speed up the process.
+    and save them in the static/videofiles/frames folder.
+    The video is decoded only once and each frame is routed to all the
+    annotations that cover it, then the cropping is done using threading
+    to speed up the process.
     """
 
     # Cycle through the annotations referring facial expressions
     with open(annotation_path, "r") as f:
         annotations = json.load(f)
 
-        if FACIAL_EXPRESSIONS_ID in annotations:
-            with ThreadPoolExecutor(max_workers=THREAD_COUNT) as executor:
-                futures = []
-                for facial_expression in annotations[FACIAL_EXPRESSIONS_ID]["annotations"]:
-                    future = executor.submit(process_facial_expression, video_path, facial_expressions_dir,
-                                             facial_expression)
-                    futures.append(future)
+    if FACIAL_EXPRESSIONS_ID not in annotations:
+        return
 
-                # Wait for all futures to complete
-                for future in futures:
-                    future.result()
+    facial_expressions = annotations[FACIAL_EXPRESSIONS_ID]["annotations"]
+    video_name, _ = os.path.splitext(os.path.basename(video_path))
+    geometry = frames_geometry(video_path, reuse=False)
+    sampling = frames_sampling(video_path, reuse=False)
+
+    # Extract the frames of all the facial expressions in a single pass through the video
+    print(video_name, "|| Extraction Started", flush=True)
+    frames_paths, frames_timestamps, frames_weights = video_decoder.extract_annotations_frames(
+        video_path, facial_expressions, facial_expressions_dir, geometry, sampling)
+    frames_manifest.update_annotations_frames(video_name, frames_paths, frames_timestamps, frames_weights)
+    print(video_name, "|| Extraction Finished", flush=True)
+
+    with ThreadPoolExecutor(max_workers=CROP_THREAD_COUNT) as executor:
+        futures = []
+        for annotation_id, images_paths in frames_paths.items():
+            future = executor.submit(crop_facial_expression_frames, video_name, annotation_id, images_paths,
+                                     frames_timestamps[annotation_id])
+            futures.append(future)
+
+        # Wait for all futures to complete
+        for future in futures:
+            future.result()
+
+
+def crop_facial_expression_frames(video_name, annotation_id, images_paths, timestamps=None):
+    """ Crop the extracted frames of a facial expression to contain only the person.
+    Returns whether the frames were cropped. """
+
+    if not images_paths:
+        return True
+
+    # This step is done by a service running in a separate environment due to incompatible dependencies
+    # with the main environment, which keeps the models loaded between annotations
+    print(video_name, "-", annotation_id, "|| Cropping Started", flush=True)
+    job = object_detector.detect_person(images_paths, job_id=f"{video_name}_{annotation_id}", video_id=video_name,
+                                        timestamps=timestamps)
+    if job["status"] != JOB_DONE:
+        print(video_name, "-", annotation_id, f"|| Cropping Failed: {job.get('error')}", flush=True)
+    else:
+        print(video_name, "-", annotation_id, "|| Cropping Finished", flush=True)
 
-def process_facial_expression(video_path, facial_expressions_dir, facial_expression):
-    """ Extract the frames of a facial expression from the video. """
+    save_thumbnails(images_paths)
+    frame_store.pack_annotation(FACIAL_EXPRESSIONS_ID, video_name, annotation_id)
 
-    # Convert start and end time from milliseconds to hh:mm:ss format
-    start_time_milliseconds = facial_expression["start_time"]
-    start_time_seconds = int(start_time_milliseconds) / 1000  # convert milliseconds to seconds
-    start_time_str = str(datetime.timedelta(seconds=start_time_seconds))
+    return job["status"] == JOB_DONE
 
-    end_time_milliseconds = facial_expression["end_time"]
-    end_time_seconds = int(end_time_milliseconds) / 1000
-    end_time_str = str(datetime.timedelta(seconds=end_time_seconds))
 
-    annotation_id = facial_expression["annotation_id"]
+def stream_facial_expressions_frames(video_path, facial_expressions_dir, annotation_path, annotation_ids=None):
+    """ Decode, crop and remove the background of the facial expressions frames of a video, or of the ones in
+    annotation_ids, in memory, without writing intermediate PNGs. Only the frames displayed by the web application
+    are saved, together with their thumbnails. Yields (annotation_id, cropped RGBA frames as images, frame weights)
+    as each annotation is cropped.
+    """
 
-    # Create a directory for the facial expression inside the video directory
-    expression_dir = os.path.join(facial_expressions_dir, f"{annotation_id}")
-    os.makedirs(expression_dir, exist_ok=True)
+    with open(annotation_path, "r") as f:
+        annotations = json.load(f)
+
+    if FACIAL_EXPRESSIONS_ID not in annotations:
+        return
 
+    facial_expressions = annotations[FACIAL_EXPRESSIONS_ID]["annotations"]
+    if annotation_ids is not None:
+        facial_expressions = [expression for expression in facial_expressions
+                              if expression["annotation_id"] in annotation_ids]
     video_name, _ = os.path.splitext(os.path.basename(video_path))
+    geometry = frames_geometry(video_path, reuse=False)
+    sampling = frames_sampling(video_path, reuse=False)
+    display_frames_paths = {}
+    display_frames_timestamps = {}
+    streamed_frames = {}
+
+    print(video_name, "|| Streaming Started", flush=True)
+
+    # Each annotation is cropped as soon as it is decoded, while the decoder keeps going
+    with ThreadPoolExecutor(max_workers=CROP_THREAD_COUNT) as executor:
+        futures = deque()
+        for annotation_id, frames, timestamps, weights in video_decoder.iter_annotations_frames(
+                video_path, facial_expressions, geometry, sampling):
+            streamed_frames[annotation_id] = (timestamps, weights or None)
+            futures.append((weights, executor.submit(crop_facial_expression_frames_in_memory, video_name,
+                                                     annotation_id, frames, timestamps, facial_expressions_dir)))
+
+            # Hand over the finished annotations, bounding the ones held in memory
+            while futures and (futures[0][1].done() or len(futures) >= 2 * CROP_THREAD_COUNT):
+                weights, future = futures.popleft()
+                annotation_id, images, display_frames = future.result()
+                display_frames_paths[annotation_id], display_frames_timestamps[annotation_id] = display_frames
+                yield annotation_id, images, weights
+
+        while futures:
+            weights, future = futures.popleft()
+            annotation_id, images, display_frames = future.result()
+            display_frames_paths[annotation_id], display_frames_timestamps[annotation_id] = display_frames
+            yield annotation_id, images, weights
+
+    frames_manifest.update_annotations_frames(video_name, display_frames_paths, display_frames_timestamps,
+                                              streamed_frames=streamed_frames)
+    print(video_name, "|| Streaming Finished", flush=True)
+
+
+def restream_facial_expressions_frames(video_id, annotation_ids):
+    """ Decode, crop and remove the background of the frames of some streamed facial expressions of a video in memory
+    again, with the geometry and sampling they were streamed with, so they are the frames their embeddings were
+    generated from. Nothing is saved. Yields (annotation_id, cropped RGBA frames as images, frame weights) """
+
+    with open(os.path.join(ANNOTATIONS_PATH, f"{video_id}.json"), "r") as f:
+        annotations = json.load(f)
 
-    # Extract the facial expressions frames from the video
-    command = ["ffmpeg",
-               "-loglevel", "error",  # suppress the output
-               "-ss", start_time_str,  # start time
-               "-to", end_time_str,  # end time
-               "-i", video_path,  # input file
-               # "-vf", "fps=1",  # extract 1 frame per second
-               os.path.join(expression_dir, f"{annotation_id}_%02d.png")  # output file
-               ]
-
-    print(video_name, "-", facial_expression["annotation_id"], "|| Extraction Started", flush=True)
-    subprocess.call(command)
-    print(video_name, "-", facial_expression["annotation_id"], "|| Extraction Finished", flush=True)
-
-    # Prepend the directory path to each filename in expression_dir
-    images_paths = [os.path.join(expression_dir, image_path) for image_path in os.listdir(expression_dir)]
+    facial_expressions = [expression for expression in annotations.get(FACIAL_EXPRESSIONS_ID, {}).get("annotations", [])
+                          if expression["annotation_id"] in annotation_ids]
+    video_path = os.path.join(VIDEO_PATH, video_id + ".mp4")
+    geometry = frames_geometry(video_path)
+    sampling = frames_sampling(video_path)
 
-    # Crop the extracted frames to contain only the person
-    # This step is done in a separate environment due to incompatible dependencies with the main environment
-    image_paths_str = ",".join(images_paths)
+    print(video_id, "|| Streaming Again", len(facial_expressions), "annotations", flush=True)
+    for annotation_id, frames, timestamps, weights in video_decoder.iter_annotations_frames(
+            video_path, facial_expressions, geometry, sampling):
+        yield annotation_id, crop_frames_in_memory(video_id, annotation_id, frames, timestamps), weights
 
-    print(video_name, "-", facial_expression["annotation_id"], "|| Cropping Started", flush=True)
-    run_od_in_env("app/frame_extraction/run_object_detector.py",
-               "python_environments/object_detectors_env", image_paths_str)
-    print(video_name, "-", facial_expression["annotation_id"], "|| Cropping Finished", flush=True)
 
-def extract_phrases_frames(video_path, phrases_dir, annotation_path):
-    """" Extract one frame per phrase from the videos """
+def crop_facial_expression_frames_in_memory(video_name, annotation_id, frames, timestamps, facial_expressions_dir):
+    """ Crop in-memory frames of a facial expression to contain only the person and save the display frames """
 
-    # Cycle through the annotations referring facial expressions
-    with open(annotation_path, "r") as f:
-        annotations = json.load(f)
+    expression_dir = os.path.join(facial_expressions_dir, annotation_id)
+    os.makedirs(expression_dir, exist_ok=True)
+
+    if not frames:
+        return annotation_id, [], ([], [])
+
+    images = crop_frames_in_memory(video_name, annotation_id, frames, timestamps)
+    display_frames = save_display_frames(annotation_id, images, timestamps, expression_dir)
+    frame_store.pack_annotation(FACIAL_EXPRESSIONS_ID, video_name, annotation_id)
+
+    return annotation_id, images, display_frames
+
+
+def crop_frames_in_memory(video_name, annotation_id, frames, timestamps):
+    """ Crop in-memory frames of a facial expression to contain only the person, returned as images """
+
+    print(video_name, "-", annotation_id, "|| Cropping Started", flush=True)
+    job, cropped_frames = object_detector.detect_person_frames(frames, job_id=f"{video_name}_{annotation_id}",
+                                                               video_id=video_name, timestamps=timestamps)
+    if job["status"] != JOB_DONE:
+        # Keep the frames uncropped, as when cropping the PNG files fails
+        print(video_name, "-", annotation_id, f"|| Cropping Failed: {job.get('error')}", flush=True)
+        return [Image.fromarray(frame) for frame in frames]
+
+    print(video_name, "-", annotation_id, "|| Cropping Finished", flush=True)
+    return [Image.fromarray(frame, "RGBA") for frame in cropped_frames]
+
+
+def save_display_frames(annotation_id, images, timestamps, expression_dir, n_frames=N_FRAMES_TO_DISPLAY):
+    """ Save the evenly spaced frames of an annotation that the web application displays, and their thumbnails.
+    Returns the paths and timestamps of the saved frames. """
+
+    frames_paths = []
+    frames_timestamps = []
+    for index in frame_sampling.select_display_frames(list(range(len(images))), n_frames):
+        frame_path = os.path.join(expression_dir, f"{annotation_id}_{index + 1:02d}.png")
+        images[index].save(frame_path)
+        save_thumbnail(images[index], frame_path)
+        frames_paths.append(frame_path)
+        frames_timestamps.append(timestamps[index])
+
+    return frames_paths, frames_timestamps
+
+
+def save_thumbnails(frames_paths, n_frames=N_FRAMES_TO_DISPLAY):
+    """ Save the thumbnails of the frames of an annotation that the web application displays """
+
+    for frame_path in frame_sampling.select_display_frames(sorted(frames_paths), n_frames):
+        if not os.path.isfile(frame_path):
+            continue
+        with Image.open(frame_path) as image:
+            save_thumbnail(image, frame_path)
 
-        if PHRASES_ID in annotations:
-            for phrase in annotations[PHRASES_ID]["annotations"]:
-                # Convert start and end time from milliseconds to hh:mm:ss format
-                start_time_milliseconds = int(phrase["start_time"])
 
-                end_time_milliseconds = int(phrase["end_time"])
+def save_thumbnail(image, frame_path):
+    """ Save a small rendition of a frame in the thumbnails folder, under the same relative path as the frame """
 
-                middle_time_seconds = ((start_time_milliseconds + end_time_milliseconds) / 2) / 1000
-                middle_time_str = str(datetime.timedelta(seconds=middle_time_seconds))
+    thumbnail_path = os.path.join(THUMBNAILS_PATH, os.path.relpath(frame_path, FRAMES_PATH))
+    os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
 
-                annotation_id = phrase["annotation_id"]
+    thumbnail = image.copy()
+    thumbnail.thumbnail((DISPLAY_FRAME_SIZE, DISPLAY_FRAME_SIZE))
+    thumbnail.save(thumbnail_path)
 
-                # Create a directory for the facial expression inside the video directory
-                annotation_dir = os.path.join(phrases_dir, f"{annotation_id}")
-                os.makedirs(annotation_dir, exist_ok=True)
 
-                print("Extracting phrases frames from video", video_path, "of annotation",
-                      phrase["annotation_id"],
-                      flush=True)
+def frames_geometry(video_path, reuse=True):
+    """ Get the size of the frames extracted from a video and record it in the video's manifest.
+    With reuse, the size recorded by a previous extraction is kept, so new frames match the existing ones. """
 
-                # Extract the phrase middle frame from the video
-                command = ["ffmpeg",
-                           "-loglevel", "error",  # suppress the output
-                           "-ss", middle_time_str,  # start time
-                           "-i", video_path,  # input file
-                           "-vframes", "1",  # output one frame
-                           "-update", "1",  # write a single image
-                           os.path.join(annotation_dir, f"{annotation_id}.png")  # output file
-                           ]
+    video_id, _ = os.path.splitext(os.path.basename(video_path))
 
-                subprocess.call(command)
+    if reuse:
+        geometry = frames_manifest.load_manifest(video_id).get("geometry")
+        if geometry is not None:
+            return geometry
+
+    geometry = video_decoder.output_geometry(video_decoder.probe_video(video_path), FRAME_MAX_HEIGHT)
+    frames_manifest.update_manifest(video_id, geometry=geometry, thumbnail_size=DISPLAY_FRAME_SIZE)
+
+    return geometry
+
+
+def frames_sampling(video_path, reuse=True):
+    """ Get the sampling policy of the facial expressions frames of a video, including the deduplication distance,
+    and record it in the video's manifest.
+    With reuse, the policy recorded by a previous extraction is kept, so new frames are sampled as the others. """
+
+    video_id, _ = os.path.splitext(os.path.basename(video_path))
+
+    if reuse:
+        sampling = frames_manifest.load_manifest(video_id).get("sampling")
+        if sampling is not None:
+            return sampling
+
+    sampling = dict(frame_sampling.parse_policy(FRAME_SAMPLING), dedup=FRAME_DEDUP_DISTANCE)
+    frames_manifest.update_manifest(video_id, sampling=sampling)
+
+    return sampling
+
+
+def extract_phrases_frames(video_path, phrases_dir, annotation_path, annotation_ids=None):
+    """" Extract one frame per phrase from the videos, the one in the middle of the phrase.
+    The middle frames of all the phrases of a video, or of the ones in annotation_ids, are decoded together,
+    in time order. """
+
+    # Cycle through the annotations referring phrases
+    with open(annotation_path, "r") as f:
+        annotations = json.load(f)
+
+    if PHRASES_ID not in annotations:
+        return
+
+    video_name, _ = os.path.splitext(os.path.basename(video_path))
+    geometry = frames_geometry(video_path)
+    phrases = [phrase for phrase in annotations[PHRASES_ID]["annotations"]
+               if annotation_ids is None or phrase["annotation_id"] in annotation_ids]
+
+    # Paths of the frames to extract at each middle timestamp, shared by phrases with the same middle
+    timestamps_paths = {}
+    for phrase in phrases:
+        annotation_id = phrase["annotation_id"]
+        middle_time_milliseconds = (int(phrase["start_time"]) + int(phrase["end_time"])) / 2
+
+        # Create a directory for the phrase inside the video directory
+        annotation_dir = os.path.join(phrases_dir, f"{annotation_id}")
+        os.makedirs(annotation_dir, exist_ok=True)
+
+        frame_path = os.path.join(annotation_dir, f"{annotation_id}.png")
+        timestamps_paths.setdefault(middle_time_milliseconds, []).append(frame_path)
+
+    print(video_name, "|| Phrases Extraction Started", flush=True)
+    frames_paths = video_decoder.extract_frames_at(video_path, timestamps_paths, geometry)
+    save_thumbnails(frames_paths, n_frames=len(frames_paths))
+    for phrase in phrases:
+        frame_store.pack_annotation(PHRASES_ID, video_name, phrase["annotation_id"])
+    print(video_name, "|| Phrases Extraction Finished", flush=True)
 
 
 def extract_annotation_frames(video_id, annotation_id, start_time, end_time):
     """ Extract the frames of a facial expression from the video in the specified time range."""
 
-    # Create a directory for the facial expression inside the video directory
     video_facial_expressions_dir = os.path.join(FRAMES_PATH, FACIAL_EXPRESSIONS_ID, video_id)
-    expression_dir = os.path.join(video_facial_expressions_dir, f"{annotation_id}")
-    os.makedirs(expression_dir, exist_ok=True)
+    video_path = os.path.join(VIDEO_PATH, video_id + ".mp4")
+    geometry = frames_geometry(video_path)
+    sampling = frames_sampling(video_path)
 
-    # Extract the facial expressions frames from the video
-    command = ["ffmpeg",
-               "-loglevel", "error",  # suppress the output
-               "-ss", start_time,  # start time in HH:MM:SS format
-               "-to", end_time,  # end time in HH:MM:SS format
-               "-i", os.path.join(VIDEO_PATH, video_id + ".mp4"),  # input file
-               # "-vf", "fps=1",  # extract 1 frame per second
-               os.path.join(expression_dir, f"{annotation_id}_%02d.png")  # output file
-               ]
+    # Start and end times come in HH:MM:SS.MS format
+    annotation = {
+        "annotation_id": annotation_id,
+        "start_time": convert_time_format_to_milliseconds(start_time),
+        "end_time": convert_time_format_to_milliseconds(end_time),
+    }
 
+    # Extract the facial expressions frames from the video
     print(video_id, "-", annotation_id, "|| Extraction Started", flush=True)
-    subprocess.call(command)
+    frames_paths, frames_timestamps, frames_weights = video_decoder.extract_annotations_frames(
+        video_path, [annotation], video_facial_expressions_dir, geometry, sampling)
+    frames_manifest.update_annotations_frames(video_id, frames_paths, frames_timestamps, frames_weights)
     print(video_id, "-", annotation_id, "|| Extraction Finished", flush=True)
 
-    # Prepend the directory path to each filename in expression_dir
-    images_paths = [os.path.join(expression_dir, image_path) for image_path in os.listdir(expression_dir)]
-
     # Crop the extracted frames to contain only the person
-    # This step is done in a separate environment due to incompatible dependencies with the main environment
-    image_paths_str = ",".join(images_paths)
-
-    print(video_id, "-", annotation_id, "|| Cropping Started", flush=True)
-    run_od_in_env("app/frame_extraction/run_object_detector.py",
-               "python_environments/object_detectors_env", image_paths_str)
-    print(video_id, "-", annotation_id, "|| Cropping Finished", flush=True)
+    crop_facial_expression_frames(video_id, annotation_id, frames_paths[annotation_id],
+                                  frames_timestamps[annotation_id])
 
 
 def delete_frames(video_id, annotation_id):
     """ Delete the frames of a facial expression from the annotation in the video. """
 
-    video_facial_expressions_dir = os.path.join(FRAMES_PATH, FACIAL_EXPRESSIONS_ID, video_id)
-    expression_dir = os.path.join(video_facial_expressions_dir, f"{annotation_id}")
-
-    if os.path.exists(expression_dir):
-        shutil.rmtree(expression_dir)
-
-
-def run_od_in_env(script_path, env_path, image_paths):
-    """ Run a script in a virtual environment """
-    activate_script = f'source {env_path}/bin/activate'
-    command = f"{activate_script}; python -u {script_path} {image_paths}; deactivate"
-    process = subprocess.Popen(command, shell=True, executable="/bin/bash", stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    out, err = process.communicate()
-    out_decoded = out.decode()
-    err_decoded = err.decode()
-    if process.returncode != 0 or err_decoded:
-        print(f"Error occurred: {err_decoded}", flush=True)
-    else:
-        if out_decoded:
-            print(f"{out_decoded}", flush=True)
-    process.wait()
\ No newline at end of file
+    frame_store.delete_annotation(FACIAL_EXPRESSIONS_ID, video_id, f"{annotation_id}")
+
+    thumbnails_dir = os.path.join(THUMBNAILS_PATH, FACIAL_EXPRESSIONS_ID, video_id, f"{annotation_id}")
+    if os.path.exists(thumbnails_dir):
+        shutil.rmtree(thumbnails_dir)
+
+    frames_manifest.delete_annotation_frames(video_id, annotation_id)
+
+
+def shutdown_object_detector():
+    """ Stop the object detector service once there are no more frames to crop """
+    object_detector.shutdown()
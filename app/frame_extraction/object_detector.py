@@ -4,19 +4,40 @@ from transformers import DetrImageProcessor, DetrForObjectDetection, pipeline
 import torch
 import os
 
+from background_remover import LowResBackgroundRemover, MASK_SIZE, MASK_REUSE_THRESHOLD
+
 BATCH_SIZE = 16
 
+# "pipeline" runs the RMBG-1.4 pipeline on each full resolution crop, "lowres" computes the masks of a
+# whole batch at a reduced resolution and reuses them across consecutive frames that barely differ
+BACKGROUND_REMOVAL_MODE = os.getenv("BACKGROUND_REMOVAL_MODE", "pipeline")
+
+# "torch" runs the PyTorch fp32 models, "onnx" runs them exported to ONNX on onnxruntime (CPU only),
+# optionally with their weights dynamically quantized to int8. The onnx backend always uses the
+# low resolution background removal mode, with MASK_SIZE as the model input size
+OD_BACKEND = os.getenv("OD_BACKEND", "torch")
+OD_QUANTIZE = os.getenv("OD_QUANTIZE", "0") == "1"
+OD_INTRA_OP_THREADS = int(os.getenv("OD_INTRA_OP_THREADS", 0))  # 0 lets onnxruntime decide
+OD_INTER_OP_THREADS = int(os.getenv("OD_INTER_OP_THREADS", 0))
+
 
 class ObjectDetector:
     """ Class for detecting a person in an image, cropping the person box, detecting the person in the
         cropped image, removing the background and saving the cropped image. The models used are:
         - DETR-ResNet-50 for object detection
         - RMBG-1.4 for background removal
+
+        Each frame gives exactly one image, saved back to its own path: the frames show a single signer, so only the
+        most confident person box is cropped, and a frame where no person is found keeps its whole image. Cropping
+        every person box and dropping the frames without one, as the first version did, paired the crops with the
+        wrong frames as soon as a frame had no person, or more than one. See check_person_crops.py.
     """
 
-    def __init__(self):
+    def __init__(self, backend=OD_BACKEND, quantize=OD_QUANTIZE):
         # Check if a GPU is available and if so, move the model to the GPU
-        if torch.backends.mps.is_available():
+        if backend == "onnx":
+            self.device = 'cpu'
+        elif torch.backends.mps.is_available():
             self.device = 'mps'
         elif torch.cuda.is_available():
             self.device = 'cuda'
@@ -25,15 +46,36 @@ class ObjectDetector:
 
         #print("Person Detector's Device: ", self.device, flush=True)
 
+        mask_size = int(os.getenv("MASK_SIZE", MASK_SIZE))
+        reuse_threshold = float(os.getenv("MASK_REUSE_THRESHOLD", MASK_REUSE_THRESHOLD))
+
         # Initialize the DETR model for object detection and the Image Processor
         self.crop_processor = DetrImageProcessor.from_pretrained("facebook/detr-resnet-50", revision="no_timm")
-        self.crop_model = DetrForObjectDetection.from_pretrained("facebook/detr-resnet-50", revision="no_timm")
 
-        self.crop_model = self.crop_model.to(self.device)
+        if backend == "onnx":
+            import onnx_backend
+
+            self.crop_model = onnx_backend.OnnxDetr(quantize, OD_INTRA_OP_THREADS, OD_INTER_OP_THREADS)
+
+            # Initialize the RMBG-1.4 model for image segmentation
+            self.segmentation_model = None
+            segmentation_model = onnx_backend.OnnxRmbg(mask_size, quantize, OD_INTRA_OP_THREADS, OD_INTER_OP_THREADS)
+            self.background_removal_mode = "lowres"
+        else:
+            self.crop_model = DetrForObjectDetection.from_pretrained("facebook/detr-resnet-50", revision="no_timm")
+
+            self.crop_model = self.crop_model.to(self.device)
+
+            # Initialize the RMBG-1.4 model for image segmentation
+            self.segmentation_model = pipeline("image-segmentation", model="briaai/RMBG-1.4", trust_remote_code=True,
+                                               device=self.device)
 
-        # Initialize the RMBG-1.4 model for image segmentation
-        self.segmentation_model = pipeline("image-segmentation", model="briaai/RMBG-1.4", trust_remote_code=True,
-                                          device=self.device)
+            # The low resolution mode shares the model loaded by the pipeline
+            segmentation_model = self.segmentation_model.model
+            self.background_removal_mode = BACKGROUND_REMOVAL_MODE
+
+        self.background_remover = LowResBackgroundRemover(segmentation_model, self.device, mask_size=mask_size,
+                                                          reuse_threshold=reuse_threshold)
 
     def detect_person(self, images_paths):
         """ Detect a person in an image, crop the person box, detect the person in the
@@ -65,33 +107,65 @@ class ObjectDetector:
         # Load the images
         images = [Image.open(image_path) for image_path in images_paths]
 
+        boxes = self.detect_person_boxes(images)
+
+        return self.crop_person_boxes(images, boxes)
+
+    def detect_person_boxes(self, images):
+        """ Detect the most confident person box of each image, or None if no person is found. The other person
+            boxes, e.g. of people behind the signer, are ignored. """
+
         inputs = self.crop_processor(images=images, return_tensors="pt")
 
         # Move the inputs to the used device
         inputs = {name: tensor.to(self.device) for name, tensor in inputs.items()}
 
-        outputs = self.crop_model(**inputs)
+        with torch.no_grad():
+            outputs = self.crop_model(**inputs)
 
         target_sizes = torch.tensor([image.size[::-1] for image in images])
         results = self.crop_processor.post_process_object_detection(outputs, target_sizes=target_sizes, threshold=0.9)
 
-        cropped_images = []
+        boxes = []
+        for result in results:
+            person_boxes = [(score.item(), box) for score, box, label in
+                            zip(result["scores"], result["boxes"], result["labels"]) if label == 1]
 
-        # Extract the person boxes from the results and crop the images
-        for result, image in zip(results, images):
-            person_boxes = [box for box, label in zip(result["boxes"], result["labels"]) if label == 1]
+            if person_boxes:
+                _, box = max(person_boxes, key=lambda person_box: person_box[0])
+                boxes.append([round(i.item()) for i in box])
+            else:
+                boxes.append(None)
 
-            for box in person_boxes:
-                box = [round(i.item()) for i in box]
-                cropped_image = image.crop(box)
-                cropped_images.append(cropped_image)
+        return boxes
+
+    @staticmethod
+    def crop_person_boxes(images, boxes):
+        """ Crop each image to its person box, keeping the whole image if there is no box,
+            so that the cropped images stay aligned with the given images. The given images are closed. """
+
+        cropped_images = []
+
+        for image, box in zip(images, boxes):
+            if box is not None:
+                # Keep the box inside the image, since tracked boxes may include a margin
+                width, height = image.size
+                box = [max(0, box[0]), max(0, box[1]), min(width, box[2]), min(height, box[3])]
+                cropped_images.append(image.crop(box))
+            else:
+                cropped_images.append(image.copy())
 
             image.close()
 
         return cropped_images
 
-    def detect_person_remove_background(self, cropped_images):
-        """ Detect a person in a cropped image, remove the background and save the final image """
+    def detect_person_remove_background(self, cropped_images, groups=None, boxes=None):
+        """ Detect a person in a cropped image, remove the background and save the final image.
+            The groups identify consecutive frames of the same annotation, whose masks may be reused when they
+            were cropped to nearly the same boxes. """
+
+        if self.background_removal_mode == "lowres":
+            return self.background_remover.remove_background(cropped_images, groups, boxes)
 
         # pillow_mask = self.segmentation_model(image_paths, return_mask=True)  # outputs a pillow mask
         pillow_images = self.segmentation_model(cropped_images)  # applies mask on input and returns a pillow image
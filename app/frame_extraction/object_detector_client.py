@@ -0,0 +1,153 @@
+import atexit
+import json
+import os
+import socket
+import subprocess
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from app.utils import OBJECT_DETECTOR_ENV_PATH, OBJECT_DETECTOR_SOCKET_PATH, PERSON_BOXES_PATH, CROP_REUSE
+
+SERVER_SCRIPT_PATH = "app/frame_extraction/object_detector_server.py"
+STARTUP_TIMEOUT = 600  # seconds to wait for the models to be loaded
+
+# Job statuses reported by the service
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+class ObjectDetectorClient:
+    """ Client for the long-lived object detector service, which runs in the object_detectors_env environment
+        and keeps the cropping and background removal models loaded between requests.
+        If no service is listening on the socket, the client starts one and owns it until shutdown. """
+
+    def __init__(self, socket_path=OBJECT_DETECTOR_SOCKET_PATH, env_path=OBJECT_DETECTOR_ENV_PATH):
+        self.socket_path = socket_path
+        self.env_path = env_path
+        self.process = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """ Start the service if it isn't running yet and wait until its models are loaded """
+        with self.lock:
+            if self.is_ready():
+                return
+
+            python_path = os.path.join(self.env_path, "bin", "python")
+            self.process = subprocess.Popen([python_path, "-u", SERVER_SCRIPT_PATH, self.socket_path])
+
+            start = time.time()
+            while not self.is_ready():
+                if self.process.poll() is not None:
+                    raise RuntimeError(f"Object detector service exited with code {self.process.returncode}")
+                if time.time() - start > STARTUP_TIMEOUT:
+                    self.process.kill()
+                    raise TimeoutError("Object detector service did not start in time")
+                time.sleep(1)
+
+            print("Object detector service ready", flush=True)
+
+    def is_ready(self):
+        """ Check if there is a service answering on the socket """
+        if not os.path.exists(self.socket_path):
+            return False
+        try:
+            return self.request({"op": "ping"}).get("status") == "ready"
+        except OSError:
+            return False
+
+    def request(self, message, frames=None):
+        """ Send a message to the service using a new connection and wait for its response.
+            If frames are given, their raw bytes are sent after the message and the raw RGBA frames sent back
+            after the response are returned as well. """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.socket_path)
+            with sock.makefile("rwb") as stream:
+                stream.write((json.dumps(message) + "\n").encode("utf-8"))
+                for frame in frames or []:
+                    stream.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+                stream.flush()
+
+                line = stream.readline()
+                if not line:
+                    raise ConnectionError("Object detector service closed the connection")
+                response = json.loads(line.decode("utf-8"))
+
+                if frames is None:
+                    return response
+
+                results = []
+                for shape in response.get("shapes", []):
+                    size = int(np.prod(shape))
+                    buffer = stream.read(size)
+                    if len(buffer) < size:
+                        raise ConnectionError("Object detector service closed the connection")
+                    results.append(np.frombuffer(buffer, dtype=np.uint8).reshape(shape))
+                return response, results
+
+    def detect_person(self, images_paths, job_id=None, video_id=None, timestamps=None):
+        """ Crop the images to contain only the person and remove their background, saving them in place.
+            If the video and the timestamps of the frames are given and the crop reuse mode is enabled, the
+            person box is tracked from the video's cached keyframes instead of being detected in every frame.
+            Returns the job status reported by the service. """
+        self.start()
+
+        if job_id is None:
+            job_id = uuid.uuid4().hex
+
+        message = {"op": "detect", "job_id": job_id, "images_paths": list(images_paths)}
+        self.add_tracking(message, video_id, timestamps)
+
+        return self.request(message)
+
+    def detect_person_frames(self, frames, job_id=None, video_id=None, timestamps=None):
+        """ Crop in-memory RGB frames (HxWx3 uint8 arrays) to contain only the person and remove their background,
+            without writing them to disk. Returns the job status reported by the service and the resulting
+            RGBA frames, which are empty if the job failed. """
+        self.start()
+
+        if job_id is None:
+            job_id = uuid.uuid4().hex
+
+        message = {"op": "detect_frames", "job_id": job_id, "shapes": [list(frame.shape) for frame in frames]}
+        self.add_tracking(message, video_id, timestamps)
+
+        return self.request(message, frames)
+
+    @staticmethod
+    def add_tracking(message, video_id, timestamps):
+        """ Ask the service to track the person box from the video's cached keyframes, in crop reuse mode """
+        if CROP_REUSE and video_id is not None and timestamps is not None:
+            message["video_id"] = video_id
+            message["timestamps"] = list(timestamps)
+            message["boxes_cache_path"] = os.path.join(PERSON_BOXES_PATH, f"{video_id}.json")
+
+    def status(self, job_id=None):
+        """ Get the status of a job, or of all the jobs if no job_id is given """
+        return self.request({"op": "status", "job_id": job_id})
+
+    def shutdown(self):
+        """ Stop the service if it was started by this client, waiting for the running jobs to finish """
+        with self.lock:
+            if self.process is None:
+                return
+
+            if self.process.poll() is None:
+                try:
+                    self.request({"op": "shutdown"})
+                    self.process.wait(timeout=STARTUP_TIMEOUT)
+                except (OSError, subprocess.TimeoutExpired):
+                    self.process.kill()
+                    self.process.wait()
+
+            self.process = None
+
+
+# Object detector client to be shared by the frame extraction functions
+object_detector = ObjectDetectorClient()
+atexit.register(object_detector.shutdown)
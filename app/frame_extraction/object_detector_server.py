@@ -0,0 +1,196 @@
+""" Long-lived object detector service.
+
+This script runs inside the object_detectors_env environment, loads the cropping and background removal
+models once and serves requests over a local Unix socket, so that the models are not reloaded for every
+annotation. Each client connection is handled in its own thread and sends newline delimited JSON messages:
+
+- {"op": "detect", "job_id": ..., "images_paths": [...]}: crop and remove the background of the images in place.
+  If "video_id", "timestamps" and "boxes_cache_path" are also given, the person box is tracked along the video
+  from a few cached keyframes instead of being detected in every frame
+- {"op": "detect_frames", "job_id": ..., "shapes": [[height, width, 3], ...]}, followed by the raw RGB bytes of
+  the frames: crop and remove the background of in-memory frames, without writing them to disk. The response
+  has the "shapes" of the resulting RGBA frames and is followed by their raw bytes. The tracking fields of
+  "detect" are also accepted
+- {"op": "status", "job_id": ...}: status of a job (or of all the jobs if no job_id is given). The finished jobs
+  are forgotten FINISHED_JOB_TTL seconds after they finished
+- {"op": "ping"}: check if the service is ready
+- {"op": "shutdown"}: finish the running jobs and stop the service
+
+Usage: python object_detector_server.py <socket_path>
+"""
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+import detection_batcher
+import object_detector
+import person_tracker
+from detection_batcher import JOB_DONE, JOB_FAILED
+
+FINISHED_JOB_TTL = 600  # seconds the status of a finished job is kept, so the jobs don't pile up in a long-lived service
+
+
+class ObjectDetectorService:
+    """ Holds the loaded models, the batching scheduler in front of them and the submitted jobs """
+
+    def __init__(self):
+        self.detector = object_detector.ObjectDetector()
+        self.batcher = detection_batcher.DetectionBatcher(self.detector)
+        self.tracker = person_tracker.PersonTracker(self.detector)
+        self.jobs_lock = threading.Lock()
+        self.jobs = {}
+        self.jobs_finished_at = {}  # {job_id: time.monotonic() when it finished}
+
+    def expire_jobs(self):
+        """ Forget the jobs that finished more than FINISHED_JOB_TTL seconds ago, with jobs_lock held """
+        now = time.monotonic()
+        for job_id, finished_at in list(self.jobs_finished_at.items()):
+            if now - finished_at > FINISHED_JOB_TTL:
+                del self.jobs_finished_at[job_id]
+                self.jobs.pop(job_id, None)
+
+    def get_job_status(self, job_id=None):
+        with self.jobs_lock:
+            self.expire_jobs()
+            if job_id is None:
+                return {"jobs": [job.to_dict() for job in self.jobs.values()]}
+            if job_id not in self.jobs:
+                return {"job_id": job_id, "status": None, "error": "Unknown job"}
+            return self.jobs[job_id].to_dict()
+
+    def detect(self, job_id, frames, video_id=None, timestamps=None, boxes_cache_path=None):
+        """ Crop and remove the background of the frames of a job, given as image paths, which are saved in
+            place, or as images. The frames are batched together with the frames of the other clients' jobs.
+            Returns the finished job. """
+        boxes = None
+        if video_id is not None and timestamps is not None and boxes_cache_path is not None:
+            try:
+                boxes = self.tracker.track(video_id, frames, timestamps, boxes_cache_path)
+            except Exception as e:
+                # The frames are detected one by one instead
+                print("Error tracking the person in", video_id, ":", e, flush=True)
+
+        job = self.batcher.submit(job_id, frames, boxes)
+        with self.jobs_lock:
+            self.expire_jobs()
+            self.jobs[job_id] = job
+            self.jobs_finished_at.pop(job_id, None)
+        job.wait()
+
+        with self.jobs_lock:
+            if self.jobs.get(job_id) is job:
+                self.jobs_finished_at[job_id] = time.monotonic()
+        return job
+
+    def close(self):
+        self.batcher.close()
+
+
+class ObjectDetectorRequestHandler(socketserver.StreamRequestHandler):
+    """ Handles the messages of one client connection """
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+
+            payload = b""
+            try:
+                message = json.loads(line.decode("utf-8"))
+                response, payload = self.dispatch(message)
+            except Exception as e:
+                response = {"status": JOB_FAILED, "error": str(e)}
+
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+            self.wfile.write(payload)
+            self.wfile.flush()
+
+    def dispatch(self, message):
+        """ Handle a message, returning the response and the raw bytes to send after it """
+        service = self.server.service
+        op = message.get("op")
+
+        if op == "detect":
+            job = service.detect(message["job_id"], message["images_paths"], message.get("video_id"),
+                                 message.get("timestamps"), message.get("boxes_cache_path"))
+            return job.to_dict(), b""
+        elif op == "detect_frames":
+            frames = [Image.fromarray(self.read_frame(shape)) for shape in message["shapes"]]
+            job = service.detect(message["job_id"], frames, message.get("video_id"),
+                                 message.get("timestamps"), message.get("boxes_cache_path"))
+
+            response = job.to_dict()
+            if response["status"] != JOB_DONE:
+                job.release()
+                return response, b""
+
+            results = [np.asarray(image.convert("RGBA")) for image in job.results]
+            job.release()
+            response["shapes"] = [list(result.shape) for result in results]
+            return response, b"".join(result.tobytes() for result in results)
+        else:
+            return self.dispatch_control(message), b""
+
+    def read_frame(self, shape):
+        """ Read the raw bytes of a uint8 frame with the given shape from the connection """
+        size = int(np.prod(shape))
+        buffer = self.rfile.read(size)
+        if len(buffer) < size:
+            raise ConnectionError("Connection closed while reading a frame")
+        return np.frombuffer(buffer, dtype=np.uint8).reshape(shape)
+
+    def dispatch_control(self, message):
+        service = self.server.service
+        op = message.get("op")
+
+        if op == "status":
+            return service.get_job_status(message.get("job_id"))
+        elif op == "ping":
+            return {"status": "ready"}
+        elif op == "shutdown":
+            # shutdown() blocks until serve_forever() returns, so it can't be called from a handler thread
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return {"status": "shutting_down"}
+        else:
+            return {"status": JOB_FAILED, "error": f"Unknown operation {op}"}
+
+
+class ObjectDetectorServer(socketserver.ThreadingUnixStreamServer):
+    """ Unix socket server that handles each client in its own thread.
+        On close, it waits for the threads of the running jobs to finish. """
+    daemon_threads = False
+    block_on_close = True
+
+    def __init__(self, socket_path, service):
+        self.service = service
+        super().__init__(socket_path, ObjectDetectorRequestHandler)
+
+
+def serve(socket_path):
+    """ Load the models and serve requests until a shutdown message is received """
+    # The models are loaded before binding the socket so that clients only connect when the service is ready
+    service = ObjectDetectorService()
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    server = ObjectDetectorServer(socket_path, service)
+    print("Object detector service listening on", socket_path, flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        print("Object detector service stopped", flush=True)
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1])
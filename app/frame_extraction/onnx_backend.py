@@ -0,0 +1,95 @@
+import os
+
+import numpy as np
+import torch
+from transformers import AutoModelForImageSegmentation, DetrForObjectDetection
+from transformers.models.detr.modeling_detr import DetrObjectDetectionOutput
+
+from onnx_session import ONNX_MODELS_DIR, ONNX_OPSET, create_session, quantized_path
+
+
+class DetrOutputs(torch.nn.Module):
+    """ Wraps DETR so that the exported graph only returns the logits and the boxes """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values, pixel_mask):
+        outputs = self.model(pixel_values=pixel_values, pixel_mask=pixel_mask)
+        return outputs.logits, outputs.pred_boxes
+
+
+class RmbgMask(torch.nn.Module):
+    """ Wraps RMBG-1.4 so that the exported graph only returns the finest mask """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model(pixel_values)[0][0]
+
+
+def export_detr(model_path):
+    """ Export DETR-ResNet-50 to ONNX, with dynamic batch size and image size """
+    model = DetrForObjectDetection.from_pretrained("facebook/detr-resnet-50", revision="no_timm").eval()
+    pixel_values = torch.randn(1, 3, 800, 1066)
+    pixel_mask = torch.ones(1, 800, 1066, dtype=torch.long)
+
+    os.makedirs(os.path.dirname(model_path), exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(DetrOutputs(model), (pixel_values, pixel_mask), model_path,
+                          input_names=["pixel_values", "pixel_mask"], output_names=["logits", "pred_boxes"],
+                          dynamic_axes={"pixel_values": {0: "batch", 2: "height", 3: "width"},
+                                        "pixel_mask": {0: "batch", 1: "height", 2: "width"},
+                                        "logits": {0: "batch"}, "pred_boxes": {0: "batch"}},
+                          opset_version=ONNX_OPSET)
+
+
+def export_rmbg(model_path, mask_size):
+    """ Export RMBG-1.4 to ONNX, with dynamic batch size and a fixed mask_size x mask_size input """
+    model = AutoModelForImageSegmentation.from_pretrained("briaai/RMBG-1.4", trust_remote_code=True).eval()
+    pixel_values = torch.randn(1, 3, mask_size, mask_size)
+
+    os.makedirs(os.path.dirname(model_path), exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(RmbgMask(model), (pixel_values,), model_path,
+                          input_names=["pixel_values"], output_names=["mask"],
+                          dynamic_axes={"pixel_values": {0: "batch"}, "mask": {0: "batch"}},
+                          opset_version=ONNX_OPSET)
+
+
+class OnnxDetr:
+    """ DETR-ResNet-50 running on onnxruntime, called like the PyTorch model """
+
+    def __init__(self, quantize=False, intra_op_threads=0, inter_op_threads=0):
+        model_path = os.path.join(ONNX_MODELS_DIR, "detr-resnet-50.onnx")
+        if not os.path.exists(model_path):
+            export_detr(model_path)
+        if quantize:
+            model_path = quantized_path(model_path)
+        self.session = create_session(model_path, intra_op_threads, inter_op_threads)
+
+    def __call__(self, pixel_values, pixel_mask):
+        logits, pred_boxes = self.session.run(None, {
+            "pixel_values": pixel_values.cpu().numpy().astype(np.float32),
+            "pixel_mask": pixel_mask.cpu().numpy().astype(np.int64),
+        })
+        return DetrObjectDetectionOutput(logits=torch.from_numpy(logits), pred_boxes=torch.from_numpy(pred_boxes))
+
+
+class OnnxRmbg:
+    """ RMBG-1.4 running on onnxruntime, called like the PyTorch model (the mask is in result[0][0]) """
+
+    def __init__(self, mask_size, quantize=False, intra_op_threads=0, inter_op_threads=0):
+        model_path = os.path.join(ONNX_MODELS_DIR, f"rmbg-1.4-{mask_size}.onnx")
+        if not os.path.exists(model_path):
+            export_rmbg(model_path, mask_size)
+        if quantize:
+            model_path = quantized_path(model_path)
+        self.session = create_session(model_path, intra_op_threads, inter_op_threads)
+
+    def __call__(self, pixel_values):
+        mask, = self.session.run(None, {"pixel_values": pixel_values.cpu().numpy().astype(np.float32)})
+        return [[torch.from_numpy(mask)]]
@@ -0,0 +1,28 @@
+""" onnxruntime sessions and int8 quantization shared by the ONNX backends of the object detector, in the
+object_detectors_env environment, and of the text encoder, in the main one. Only onnxruntime is imported here, the
+quantization tools (which need the onnx package) are imported when a model is first quantized. """
+import os
+
+import onnxruntime as ort
+
+ONNX_MODELS_DIR = os.getenv("ONNX_MODELS_DIR", "python_environments/onnx_models")
+ONNX_OPSET = 14
+
+
+def create_session(model_path, intra_op_threads, inter_op_threads):
+    """ Create an onnxruntime CPU session with the given thread counts (0 lets onnxruntime decide) """
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+
+
+def quantized_path(model_path):
+    """ Quantize the weights of an ONNX model to int8, once, and return the quantized model's path """
+    root, extension = os.path.splitext(model_path)
+    output_path = f"{root}.int8{extension}"
+    if not os.path.exists(output_path):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(model_path, output_path, weight_type=QuantType.QInt8)
+    return output_path
@@ -0,0 +1,151 @@
+import bisect
+import json
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+KEYFRAME_INTERVAL = 2000  # milliseconds between the keyframes where the person is detected
+BOX_MARGIN = 0.05  # margin added to each side of the tracked boxes, relative to the box size
+MAX_FRAME_DIFFERENCE = 20  # mean absolute difference (0-255) to the nearest keyframe above which the scene changed
+MIN_KEYFRAMES_IOU = 0.7  # IoU between consecutive keyframe boxes below which the person moved too much
+THUMBNAIL_SIZE = (16, 16)
+
+
+class PersonTracker:
+    """ Tracks the bounding box of the signer along a video, instead of detecting it in every frame.
+
+        Since the videos have a fixed camera and a single signer, the person is only detected in one keyframe
+        every KEYFRAME_INTERVAL milliseconds. The box of the frames in between is the union of the boxes of the
+        surrounding keyframes, with a margin. A frame falls back to its own detection when its surrounding
+        keyframes disagree (low IoU), when no person was found in them or when the frame differs too much from
+        the nearest keyframe. The keyframes of each video are cached in a JSON file, so that later annotations
+        and annotation edits of the same video reuse them, as long as the frames are extracted at the same size. """
+
+    def __init__(self, detector, keyframe_interval=KEYFRAME_INTERVAL):
+        self.detector = detector
+        self.keyframe_interval = keyframe_interval
+        self.videos_keyframes = {}
+        self.videos_locks = {}
+        self.lock = threading.Lock()
+
+    def video_lock(self, video_id):
+        with self.lock:
+            if video_id not in self.videos_locks:
+                self.videos_locks[video_id] = threading.Lock()
+            return self.videos_locks[video_id]
+
+    def load_keyframes(self, video_id, cache_path):
+        if video_id not in self.videos_keyframes:
+            keyframes = {}
+            if os.path.exists(cache_path):
+                with open(cache_path, "r") as f:
+                    keyframes = json.load(f)
+            self.videos_keyframes[video_id] = keyframes
+        return self.videos_keyframes[video_id]
+
+    @staticmethod
+    def save_keyframes(keyframes, cache_path):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(keyframes, f)
+        os.replace(tmp_path, cache_path)
+
+    def track(self, video_id, frames, timestamps, cache_path):
+        """ Get the person box of each frame of a video, given as image paths or images, and their timestamps
+            in milliseconds. A frame gets None as its box when it must be detected on its own. """
+        thumbnails = [thumbnail(frame) for frame in frames]
+        size = list(frame_size(frames[0])) if frames else None
+
+        with self.video_lock(video_id):
+            keyframes = self.load_keyframes(video_id, cache_path)
+
+            # Pick one keyframe for each interval covered by these frames that wasn't detected yet at this size
+            new_keyframes = {}
+            for i in sorted(range(len(timestamps)), key=lambda i: timestamps[i]):
+                slot = str(int(timestamps[i] // self.keyframe_interval))
+                if (slot not in keyframes or keyframes[slot].get("size") != size) and slot not in new_keyframes:
+                    new_keyframes[slot] = i
+
+            if new_keyframes:
+                images = [Image.open(frames[i]) if isinstance(frames[i], str) else frames[i]
+                          for i in new_keyframes.values()]
+                boxes = self.detector.detect_person_boxes(images)
+                for i, image in zip(new_keyframes.values(), images):
+                    if isinstance(frames[i], str):
+                        image.close()
+
+                for (slot, i), box in zip(new_keyframes.items(), boxes):
+                    keyframes[slot] = {
+                        "timestamp": timestamps[i],
+                        "box": box,
+                        "size": size,
+                        "thumbnail": thumbnails[i].tolist(),
+                    }
+                self.save_keyframes(keyframes, cache_path)
+
+            ordered_keyframes = sorted([keyframe for keyframe in keyframes.values() if keyframe.get("size") == size],
+                                       key=lambda keyframe: keyframe["timestamp"])
+
+        keyframes_timestamps = [keyframe["timestamp"] for keyframe in ordered_keyframes]
+
+        boxes = []
+        for timestamp, frame_thumbnail in zip(timestamps, thumbnails):
+            # The keyframes right before and after the frame
+            position = bisect.bisect_left(keyframes_timestamps, timestamp)
+            surrounding = ordered_keyframes[max(0, position - 1):position + 1]
+            boxes.append(self.interpolate_box(surrounding, timestamp, frame_thumbnail))
+
+        return boxes
+
+    @staticmethod
+    def interpolate_box(surrounding_keyframes, timestamp, frame_thumbnail):
+        """ Get the box of a frame from its surrounding keyframes, or None if the frame must be detected """
+        if not surrounding_keyframes or any(keyframe["box"] is None for keyframe in surrounding_keyframes):
+            return None
+
+        if len(surrounding_keyframes) == 2 and \
+                iou(surrounding_keyframes[0]["box"], surrounding_keyframes[1]["box"]) < MIN_KEYFRAMES_IOU:
+            return None
+
+        # Cheap check for scene changes against the nearest keyframe
+        nearest = min(surrounding_keyframes, key=lambda keyframe: abs(keyframe["timestamp"] - timestamp))
+        difference = np.abs(frame_thumbnail - np.array(nearest["thumbnail"], dtype=np.float32)).mean()
+        if difference > MAX_FRAME_DIFFERENCE:
+            return None
+
+        boxes = [keyframe["box"] for keyframe in surrounding_keyframes]
+        x0, y0 = min(box[0] for box in boxes), min(box[1] for box in boxes)
+        x1, y1 = max(box[2] for box in boxes), max(box[3] for box in boxes)
+        margin_x, margin_y = round((x1 - x0) * BOX_MARGIN), round((y1 - y0) * BOX_MARGIN)
+
+        return [x0 - margin_x, y0 - margin_y, x1 + margin_x, y1 + margin_y]
+
+
+def thumbnail(frame):
+    """ Small grayscale version of a frame, given as an image path or an image, used to cheaply compare frames """
+    if isinstance(frame, str):
+        with Image.open(frame) as image:
+            return thumbnail(image)
+    return np.asarray(frame.convert("L").resize(THUMBNAIL_SIZE), dtype=np.float32)
+
+
+def frame_size(frame):
+    """ Width and height of a frame, given as an image path or an image """
+    if isinstance(frame, str):
+        with Image.open(frame) as image:
+            return image.size
+    return frame.size
+
+
+def iou(box_a, box_b):
+    """ Intersection over union of two boxes """
+    x0, y0 = max(box_a[0], box_b[0]), max(box_a[1], box_b[1])
+    x1, y1 = min(box_a[2], box_b[2]), min(box_a[3], box_b[3])
+    intersection = max(0, x1 - x0) * max(0, y1 - y0)
+    area_a = (box_a[2] - box_a[0]) * (box_a[3] - box_a[1])
+    area_b = (box_b[2] - box_b[0]) * (box_b[3] - box_b[1])
+    union = area_a + area_b - intersection
+    return intersection / union if union > 0 else 0.0
@@ -0,0 +1,366 @@
+import datetime
+import heapq
+import io
+import json
+import os
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from app.frame_extraction import frame_dedup, frame_sampling
+
+WRITER_THREAD_COUNT = 4
+MAX_PENDING_WRITES = 64  # bounds the number of decoded frames held in memory while waiting to be written
+MAX_DECODE_GAP = 10000  # milliseconds between requested frames above which the decoder seeks instead of decoding through
+
+
+def probe_video(video_path):
+    """ Get the width, height and frame rate of the first video stream of a video """
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+           '-show_entries', 'stream=width,height,r_frame_rate', '-of', 'json',
+           video_path]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stream = json.loads(result.stdout.decode('utf-8'))["streams"][0]
+
+    # The frame rate is usually in the format of NUM/DENOM (e.g., "30000/1001")
+    num, denom = map(int, stream["r_frame_rate"].split('/'))
+
+    return {
+        "width": int(stream["width"]),
+        "height": int(stream["height"]),
+        "frame_rate": num / denom,
+    }
+
+
+def output_geometry(geometry, max_height=None):
+    """ Get the geometry of the frames extracted from a video with the given geometry, downscaled to
+        max_height keeping the aspect ratio (never upscaled). The source size is kept in the result. """
+    width, height = geometry["width"], geometry["height"]
+    if max_height and height > max_height:
+        # Even dimensions, as most encoders and scalers expect
+        width, height = int(round(width * max_height / height / 2)) * 2, max_height
+
+    return {
+        "width": width,
+        "height": height,
+        "frame_rate": geometry["frame_rate"],
+        "source_width": geometry.get("source_width", geometry["width"]),
+        "source_height": geometry.get("source_height", geometry["height"]),
+    }
+
+
+def output_filters(geometry, selected_indexes=None):
+    """ ffmpeg filter arguments that keep only the decoded frames with the selected indexes, if given, and resize
+        them to the geometry's size, if it isn't the source's """
+    filters = []
+    if selected_indexes is not None:
+        filters.append("select='" + "+".join(f"eq(n,{index})" for index in selected_indexes) + "'")
+
+    width, height = geometry["width"], geometry["height"]
+    if (width, height) != (geometry.get("source_width", width), geometry.get("source_height", height)):
+        filters.append(f"scale={width}:{height}:flags=area")
+
+    return ["-vf", ",".join(filters)] if filters else []
+
+
+def decode(video_path, geometry, start_ms=0, end_ms=None, selected_indexes=None):
+    """ Decode a video from start_ms to end_ms in an ffmpeg process, resized to the geometry's size.
+        Yields the RGB frames as HxWx3 uint8 numpy arrays, only the ones with the selected indexes if given. """
+    width, height = geometry["width"], geometry["height"]
+    frame_size = width * height * 3
+
+    command = ["ffmpeg",
+               "-loglevel", "error",  # suppress the output
+               "-ss", str(datetime.timedelta(milliseconds=start_ms))]  # start time
+    if end_ms is not None:
+        command += ["-to", str(datetime.timedelta(milliseconds=end_ms))]  # end time
+    command += ["-i", video_path]  # input file
+    command += output_filters(geometry, selected_indexes)  # selected frames and output size
+    command += ["-vsync", "passthrough",  # one output frame per decoded frame
+                "-f", "rawvideo", "-pix_fmt", "rgb24",  # raw RGB frames
+                "pipe:1"]
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=frame_size)
+    try:
+        while True:
+            buffer = process.stdout.read(frame_size)
+            if len(buffer) < frame_size:
+                break
+            yield np.frombuffer(buffer, dtype=np.uint8).reshape((height, width, 3))
+    finally:
+        # The consumer may stop early, so make sure the decoder does not linger
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+
+
+def iter_frames(video_path, start_ms=0, end_ms=None, geometry=None):
+    """ Decode a video sequentially, from start_ms to end_ms, in a single ffmpeg process.
+        The frames are resized by ffmpeg to the size in geometry (see output_geometry), the source size by default.
+        Yields (timestamp in milliseconds, RGB frame as a HxWx3 uint8 numpy array) in time order. """
+    if geometry is None:
+        geometry = probe_video(video_path)
+
+    for index, frame in enumerate(decode(video_path, geometry, start_ms, end_ms)):
+        yield start_ms + index * 1000 / geometry["frame_rate"], frame
+
+
+def iter_frames_at(video_path, timestamps, geometry=None):
+    """ Decode the frame of a video shown at each of the given timestamps, in milliseconds.
+
+        The timestamps are sorted and split into runs without long gaps. Each run is decoded by a single ffmpeg
+        process that seeks to its start and only outputs the requested frames, so that a video is not decoded
+        once per timestamp nor converted in full. Yields (timestamp, RGB frame) in time order. """
+    if geometry is None:
+        geometry = probe_video(video_path)
+
+    frame_duration = 1000 / geometry["frame_rate"]
+    timestamps = sorted(set(timestamps))
+
+    runs = []
+    for timestamp in timestamps:
+        if runs and timestamp - runs[-1][-1] <= MAX_DECODE_GAP:
+            runs[-1].append(timestamp)
+        else:
+            runs.append([timestamp])
+
+    for run in runs:
+        start_ms = run[0]
+        indexes = [int((timestamp - start_ms) // frame_duration) for timestamp in run]
+
+        # Timestamps within the same frame share it
+        selected_indexes = sorted(set(indexes))
+        frames = dict(zip(selected_indexes, decode(video_path, geometry, start_ms, run[-1] + frame_duration,
+                                                   selected_indexes)))
+
+        for timestamp, index in zip(run, indexes):
+            if index in frames:
+                yield timestamp, frames[index]
+
+
+def route_frames(frames, intervals):
+    """ Route each decoded frame to every interval that covers its timestamp.
+
+        frames is an iterable of (timestamp, frame) in time order and intervals is a list of
+        (key, start_ms, end_ms). Overlapping and nested intervals are supported, since a sweep over the
+        intervals sorted by start time keeps a heap of the active ones ordered by end time.
+        Yields (timestamp, frame, keys) for every frame covered by at least one interval. """
+    pending = sorted(intervals, key=lambda interval: (interval[1], interval[2]))
+    active = []
+    next_interval = 0
+
+    for timestamp, frame in frames:
+        # Activate the intervals that started
+        while next_interval < len(pending) and pending[next_interval][1] <= timestamp:
+            key, _, end_ms = pending[next_interval]
+            heapq.heappush(active, (end_ms, next_interval, key))
+            next_interval += 1
+
+        # Retire the intervals that already ended
+        while active and active[0][0] < timestamp:
+            heapq.heappop(active)
+
+        if active:
+            yield timestamp, frame, [key for _, _, key in sorted(active, key=lambda item: item[1])]
+        elif next_interval >= len(pending):
+            # No interval is active nor will start, so there is nothing left to decode
+            break
+
+
+def sample_frames(routed_frames, intervals, sampling=None):
+    """ Select the frames routed to each interval with a sampling policy (see frame_sampling), all by default.
+
+        Yields (timestamp, frame, keys, ended_keys) in time order, where keys are the intervals that kept the
+        frame and ended_keys the intervals that ended, once all their kept frames were yielded. The frame is
+        None when an event only reports ended intervals. """
+    sampling = frame_sampling.parse_policy(sampling or "all")
+    bounds = {key: (start_ms, end_ms) for key, start_ms, end_ms in intervals}
+    samplers = {}
+
+    def events(kept_frames, ended_keys):
+        # Frames kept by several intervals are yielded once
+        grouped = {}
+        for key, items in kept_frames:
+            for timestamp, frame in items:
+                grouped.setdefault(timestamp, (frame, []))[1].append(key)
+        grouped = sorted(grouped.items(), key=lambda item: item[0])
+
+        if not grouped and ended_keys:
+            yield None, None, [], ended_keys
+        for i, (timestamp, (frame, keys)) in enumerate(grouped):
+            yield timestamp, frame, keys, ended_keys if i == len(grouped) - 1 else []
+
+    for timestamp, frame, keys in routed_frames:
+        # An interval's frames are contiguous, so once it isn't routed a frame it has ended
+        ended_keys = [key for key in samplers if key not in keys]
+        kept_frames = [(key, samplers.pop(key).flush()) for key in ended_keys]
+
+        for key in keys:
+            if key not in samplers:
+                samplers[key] = frame_sampling.create_sampler(sampling, *bounds[key])
+            kept_frames.append((key, samplers[key].push(timestamp, frame)))
+
+        yield from events(kept_frames, ended_keys)
+
+    ended_keys = list(samplers)
+    yield from events([(key, samplers.pop(key).flush()) for key in ended_keys], ended_keys)
+
+
+def deduplicate_frames(sampled_frames, max_distance, frames_weights):
+    """ Drop the frames of each interval that are near-identical to its previous kept frame (see frame_dedup), from
+        the events of sample_frames. The weight of each kept frame, the number of frames it stands for, is added to
+        frames_weights as {key: [weights]}, complete for an interval once it is reported as ended. """
+    deduplicators = {}
+
+    for timestamp, frame, keys, ended_keys in sampled_frames:
+        if frame is not None and max_distance >= 0:
+            frame_hash = frame_dedup.perceptual_hash(frame)
+            keys = [key for key in keys
+                    if deduplicators.setdefault(key, frame_dedup.FrameDeduplicator(max_distance)).push(frame_hash)]
+        else:
+            for key in keys:
+                frames_weights.setdefault(key, []).append(1)
+
+        for key in ended_keys:
+            if key in deduplicators:
+                frames_weights[key] = deduplicators.pop(key).weights
+
+        if keys:
+            yield timestamp, frame, keys, ended_keys
+        elif ended_keys:
+            yield timestamp, None, [], ended_keys
+
+
+def extract_annotations_frames(video_path, annotations, output_dir, geometry=None, sampling=None):
+    """ Extract the frames of all the given annotations of a video in a single decoding pass.
+
+        Every frame kept by the sampling policy is saved as {annotation_id}_{index:02d}.png inside
+        output_dir/{annotation_id}, for every annotation whose [start_time, end_time] covers it, with the size in
+        geometry. If the policy has a "dedup" distance, the near-identical consecutive frames of an annotation are
+        only saved once. Returns three dicts, {annotation_id: [frame paths]}, {annotation_id: [frame timestamps in
+        milliseconds]} and {annotation_id: [frame weights]}, the number of decoded frames each saved frame stands
+        for. """
+    intervals = [(annotation["annotation_id"], int(annotation["start_time"]), int(annotation["end_time"]))
+                 for annotation in annotations]
+
+    frames_paths = {}
+    frames_timestamps = {}
+    frames_weights = {}
+    for annotation_id, _, _ in intervals:
+        os.makedirs(os.path.join(output_dir, annotation_id), exist_ok=True)
+        frames_paths[annotation_id] = []
+        frames_timestamps[annotation_id] = []
+        frames_weights[annotation_id] = []
+
+    if not intervals:
+        return frames_paths, frames_timestamps, frames_weights
+
+    start_ms = min(start_ms for _, start_ms, _ in intervals)
+    end_ms = max(end_ms for _, _, end_ms in intervals)
+
+    # The PNG encoding and writing is done in a thread pool while the decoder keeps going
+    with ThreadPoolExecutor(max_workers=WRITER_THREAD_COUNT) as executor:
+        futures = deque()
+        routed_frames = route_frames(iter_frames(video_path, start_ms, end_ms, geometry), intervals)
+        sampled_frames = deduplicate_frames(sample_frames(routed_frames, intervals, sampling),
+                                            dedup_distance(sampling), frames_weights)
+        for timestamp, frame, annotation_ids, _ in sampled_frames:
+            if frame is None:
+                continue
+
+            paths = []
+            for annotation_id in annotation_ids:
+                frame_name = f"{annotation_id}_{len(frames_paths[annotation_id]) + 1:02d}.png"
+                path = os.path.join(output_dir, annotation_id, frame_name)
+                frames_paths[annotation_id].append(path)
+                frames_timestamps[annotation_id].append(timestamp)
+                paths.append(path)
+            futures.append(executor.submit(save_frame, frame, paths))
+
+            if len(futures) >= MAX_PENDING_WRITES:
+                futures.popleft().result()
+
+        # Wait for all futures to complete
+        for future in futures:
+            future.result()
+
+    return frames_paths, frames_timestamps, frames_weights
+
+
+def dedup_distance(sampling):
+    """ Maximum distance between the hashes of the frames deduplicated by a sampling policy, -1 if it doesn't """
+    return frame_sampling.parse_policy(sampling or "all").get("dedup", -1)
+
+
+def extract_frames_at(video_path, timestamps_paths, geometry=None):
+    """ Extract the frames of a video shown at some timestamps, given as {timestamp in milliseconds: [paths]},
+        decoding the video in as few passes as possible. Returns the paths that were written. """
+    written_paths = []
+
+    with ThreadPoolExecutor(max_workers=WRITER_THREAD_COUNT) as executor:
+        futures = deque()
+        for timestamp, frame in iter_frames_at(video_path, list(timestamps_paths), geometry):
+            futures.append(executor.submit(save_frame, frame, timestamps_paths[timestamp]))
+            written_paths += timestamps_paths[timestamp]
+
+            if len(futures) >= MAX_PENDING_WRITES:
+                futures.popleft().result()
+
+        # Wait for all futures to complete
+        for future in futures:
+            future.result()
+
+    return written_paths
+
+
+def save_frame(frame, paths):
+    """ Encode a frame as PNG once and write it to all the given paths """
+    buffer = io.BytesIO()
+    Image.fromarray(frame).save(buffer, format="PNG")
+    data = buffer.getvalue()
+
+    for path in paths:
+        with open(path, "wb") as f:
+            f.write(data)
+
+
+def iter_annotations_frames(video_path, annotations, geometry=None, sampling=None):
+    """ Decode all the given annotations of a video in a single pass, keeping the frames kept by the sampling
+        policy in memory, deduplicated as in extract_annotations_frames.
+        Yields (annotation_id, [RGB frames], [timestamps in milliseconds], [frame weights]) as soon as each
+        annotation ends, so only the frames of the annotations being decoded are held at once. """
+    intervals = [(annotation["annotation_id"], int(annotation["start_time"]), int(annotation["end_time"]))
+                 for annotation in annotations]
+
+    if not intervals:
+        return
+
+    start_ms = min(start_ms for _, start_ms, _ in intervals)
+    end_ms = max(end_ms for _, _, end_ms in intervals)
+
+    open_annotations = {}
+    finished_annotations = set()
+    frames_weights = {}
+    routed_frames = route_frames(iter_frames(video_path, start_ms, end_ms, geometry), intervals)
+    sampled_frames = deduplicate_frames(sample_frames(routed_frames, intervals, sampling), dedup_distance(sampling),
+                                        frames_weights)
+    for timestamp, frame, annotation_ids, ended_annotations in sampled_frames:
+        for annotation_id in annotation_ids:
+            frames, timestamps = open_annotations.setdefault(annotation_id, ([], []))
+            frames.append(frame)
+            timestamps.append(timestamp)
+
+        for annotation_id in ended_annotations:
+            finished_annotations.add(annotation_id)
+            yield (annotation_id, *open_annotations.pop(annotation_id, ([], [])),
+                   frames_weights.pop(annotation_id, []))
+
+    # Annotations too short to have any frame
+    for annotation_id, _, _ in intervals:
+        if annotation_id not in finished_annotations:
+            finished_annotations.add(annotation_id)
+            yield annotation_id, [], [], []
@@ -0,0 +1,27 @@
+from flask import Blueprint, Response, abort
+from werkzeug.utils import safe_join
+
+from app.frame_extraction import frame_store
+from app.utils import PHRASES_ID, FACIAL_EXPRESSIONS_ID
+
+bp = Blueprint('frames', __name__)
+
+FRAME_CACHE_MAX_AGE = 24 * 60 * 60  # seconds the browsers keep a frame, frames only change when annotations are edited
+FRAME_TIERS = (PHRASES_ID, FACIAL_EXPRESSIONS_ID)
+
+
+@bp.route('/frames/<tier>/<video_id>/<annotation_id>/<frame_name>')
+def get_frame(tier, video_id, annotation_id, frame_name):
+    """ Serves a single frame, read from the frame store, so frames packed per annotation can still be requested
+        one by one. """
+    # The parts of the path must not leave the folder of the frames
+    if tier not in FRAME_TIERS or safe_join(tier, video_id, annotation_id, frame_name) is None:
+        abort(404)
+
+    data = frame_store.read_frame(tier, video_id, annotation_id, frame_name)
+    if data is None:
+        abort(404)
+
+    response = Response(data, mimetype="image/png")
+    response.cache_control.max_age = FRAME_CACHE_MAX_AGE
+    return response
@@ -4,10 +4,10 @@ import subprocess
 from .eaf_parser import eaf_parser
 from .embeddings import embeddings_processing
 from .frame_extraction import frames_processing
+from . import preprocessing_scheduler
 from .opensearch.opensearch import LGPOpenSearch, gen_doc
-from .utils import CPU_Unpickler, RESULTS_PATH, EAF_PATH, VIDEO_PATH, FRAMES_PATH, ANNOTATIONS_PATH, EMBEDDINGS_PATH, \
-    FACIAL_EXPRESSIONS_FRAMES_DIR, FACIAL_EXPRESSIONS_ID, BASE_FRAMES_EMBEDDINGS_FILE, AVERAGE_FRAMES_EMBEDDINGS_FILE, \
-    BEST_FRAMES_EMBEDDINGS_FILE, SUMMED_FRAMES_EMBEDDINGS_FILE, ANNOTATIONS_EMBEDDINGS_FILE, ALL_FRAMES_EMBEDDINGS_FILE
+from .utils import FRAME_PIPELINE_MODE, RESULTS_PATH, EAF_PATH, VIDEO_PATH, FRAMES_PATH, ANNOTATIONS_PATH, EMBEDDINGS_PATH, \
+    FACIAL_EXPRESSIONS_FRAMES_DIR, FACIAL_EXPRESSIONS_ID
 
 # Initialize the OpenSearch client
 opensearch = LGPOpenSearch()
@@ -31,32 +31,23 @@ if not os.path.exists(FRAMES_PATH):
 import time
 
 start = time.time()
-frames_processing.extract_frames()
-print("Extracted facial expressions frames", flush=True)
+if FRAME_PIPELINE_MODE == "streaming":
+    # The facial expressions frames are cropped and encoded in memory, while being decoded
+    frames_processing.extract_frames(facial_expressions=False)
+    embeddings_processing.generate_streamed_video_embeddings()
+    frames_processing.shutdown_object_detector()
+    print("Extracted facial expressions frames and generated embeddings", flush=True)
+else:
+    # The videos are extracted, cropped and embedded concurrently
+    preprocessing_scheduler.preprocess_videos()
+    frames_processing.shutdown_object_detector()
+    print("Extracted facial expressions frames and generated embeddings", flush=True)
 end = time.time()
 print("Time elapsed: ", end - start , flush=True)
 
-# Generate embeddings
-embeddings_processing.generate_video_embeddings()
-
-# Load the base, average, and best frame embeddings
-with open(BASE_FRAMES_EMBEDDINGS_FILE, "rb") as f:
-    base_frame_embeddings = CPU_Unpickler(f).load()
-
-with open(AVERAGE_FRAMES_EMBEDDINGS_FILE, "rb") as f:
-    average_frame_embeddings = CPU_Unpickler(f).load()
-
-with open(BEST_FRAMES_EMBEDDINGS_FILE, "rb") as f:
-    best_frame_embeddings = CPU_Unpickler(f).load()
-
-with open(SUMMED_FRAMES_EMBEDDINGS_FILE, "rb") as f:
-    summed_frame_embeddings = CPU_Unpickler(f).load()
-
-with open(ALL_FRAMES_EMBEDDINGS_FILE, "rb") as f:
-    all_frame_embeddings = CPU_Unpickler(f).load()
-
-with open(ANNOTATIONS_EMBEDDINGS_FILE, "rb") as f:
-    annotations_embeddings = CPU_Unpickler(f).load()
+# Open the stores of the embeddings, the vectors are read as the documents are generated
+(base_frame_embeddings, average_frame_embeddings, best_frame_embeddings, summed_frame_embeddings,
+ all_frame_embeddings, annotations_embeddings) = embeddings_processing.load_embeddings()
 
 print("ENTERING INDEXING LOOP", flush=True)
 opensearch.delete_index()
@@ -88,12 +79,12 @@ for video_id in os.listdir(FACIAL_EXPRESSIONS_FRAMES_DIR):
             doc = gen_doc(
                 video_id=video_id,
                 annotation_id=annotation_id,
-                base_frame_embedding=base_frame_embeddings[video_id][annotation_id].tolist(),
-                average_frame_embedding=average_frame_embeddings[video_id][annotation_id].tolist(),
-                best_frame_embedding=best_frame_embeddings[video_id][annotation_id].tolist(),
-                summed_frame_embeddings=summed_frame_embeddings[video_id][annotation_id].tolist(),
-                all_frames_embeddings=all_frame_embeddings[video_id][annotation_id].tolist(),
-                annotation_embedding=annotations_embeddings[video_id][annotation_id].tolist(),
+                base_frame_embedding=base_frame_embeddings.get(video_id, annotation_id).tolist(),
+                average_frame_embedding=average_frame_embeddings.get(video_id, annotation_id).tolist(),
+                best_frame_embedding=best_frame_embeddings.get(video_id, annotation_id).tolist(),
+                summed_frame_embeddings=summed_frame_embeddings.get(video_id, annotation_id).tolist(),
+                all_frames_embeddings=all_frame_embeddings.get(video_id, annotation_id).tolist(),
+                annotation_embedding=annotations_embeddings.get(video_id, annotation_id).tolist(),
             )
 
             # Index the document in OpenSearch
@@ -0,0 +1,101 @@
+""" Completion records of the pre-processing, so an interrupted or repeated pre-processing only redoes what is missing.
+
+Each unit of work, an annotation (or the whole video) in a stage, is recorded in the video's manifest once finished,
+under "stages": {stage: {unit: fingerprint}}. The fingerprint is a hash of the unit's inputs (the annotation's time
+range, the video file, the extraction settings, the model, ...), so a unit is redone when it was never finished or
+when any of its inputs changed since it was.
+"""
+import hashlib
+import json
+import os
+
+from .frame_extraction import frames_manifest
+from .utils import FRAME_MAX_HEIGHT, FRAME_SAMPLING, FRAME_DEDUP_DISTANCE
+
+STAGE_PARSE = "parse"
+STAGE_PHRASES = "phrases"
+STAGE_EXTRACT = "extract"
+STAGE_CROP = "crop"
+STAGE_EMBED = "embed"
+STAGE_GLOSSES = "glosses"
+
+VIDEO_UNIT = "video"  # unit of the stages done once per video
+
+# Stages of the facial expressions annotations, recorded for each annotation
+FACIAL_EXPRESSIONS_STAGES = (STAGE_EXTRACT, STAGE_CROP, STAGE_EMBED)
+
+
+def fingerprint(*inputs):
+    """ Hash of the inputs of a unit of work, which must be JSON serializable """
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def file_fingerprint(path, content=False):
+    """ Fingerprint of a file, from its size and modification time or, with content, from its bytes """
+    if not os.path.exists(path):
+        return None
+    if content:
+        with open(path, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()[:16]
+    stat = os.stat(path)
+    return fingerprint(stat.st_size, stat.st_mtime_ns)
+
+
+def extract_fingerprint(video_fingerprint, annotation):
+    """ Fingerprint of the extraction and cropping of the frames of a facial expression annotation """
+    return fingerprint(video_fingerprint, annotation["start_time"], annotation["end_time"], FRAME_MAX_HEIGHT,
+                       FRAME_SAMPLING, FRAME_DEDUP_DISTANCE)
+
+
+def embed_fingerprint(extract_fingerprint, model_id):
+    """ Fingerprint of the frame embeddings of a facial expression annotation """
+    return fingerprint(extract_fingerprint, model_id)
+
+
+def completed_units(video_id, stage):
+    """ Get {unit: fingerprint} of the finished units of a stage of a video """
+    return frames_manifest.load_manifest(video_id).get("stages", {}).get(stage, {})
+
+
+def stale_units(video_id, stage, fingerprints):
+    """ Get the units, given as {unit: fingerprint}, that weren't finished with the same inputs """
+    completed = completed_units(video_id, stage)
+    return [unit for unit, unit_fingerprint in fingerprints.items() if completed.get(unit) != unit_fingerprint]
+
+
+def start_stage(video_id, stage):
+    """ Record that a stage of a video started, so its outputs are never adopted (see adopt_units) """
+    mark_completed(video_id, stage, {})
+
+
+def mark_completed(video_id, stage, fingerprints):
+    """ Record some units of a stage of a video as finished, given as {unit: fingerprint} """
+    with frames_manifest.manifests_lock:
+        manifest = frames_manifest.load_manifest(video_id)
+        manifest.setdefault("stages", {}).setdefault(stage, {}).update(fingerprints)
+        frames_manifest.save_manifest(video_id, manifest)
+
+
+def forget_units(video_id, stages, units):
+    """ Remove the records of some units from the given stages of a video, e.g. after deleting their annotations """
+    if not units:
+        return
+
+    with frames_manifest.manifests_lock:
+        manifest = frames_manifest.load_manifest(video_id)
+        for stage in stages:
+            for unit in units:
+                manifest.get("stages", {}).get(stage, {}).pop(unit, None)
+        frames_manifest.save_manifest(video_id, manifest)
+
+
+def adopt_units(video_id, stage, fingerprints):
+    """ Record the units of a stage as finished with the current inputs if the stage never started, for the outputs
+        of pre-processings that ran before the completion records existed. Returns whether they were adopted. """
+    with frames_manifest.manifests_lock:
+        manifest = frames_manifest.load_manifest(video_id)
+        if stage in manifest.get("stages", {}):
+            return False
+        manifest.setdefault("stages", {})[stage] = dict(fingerprints)
+        frames_manifest.save_manifest(video_id, manifest)
+    return True
@@ -0,0 +1,338 @@
+""" Parallel scheduler for the pre-processing of many videos.
+
+The pre-processing of each video is split into tasks of four stages: the extraction of the facial expressions
+frames (in chunks of annotations), their cropping, the generation of their embeddings and the extraction of the
+phrases frames. Tasks of different videos run concurrently, with a concurrency limit per stage: the extraction
+stages run in a process pool sized from the available cores and memory, the cropping in threads that wait on the
+object detector service and the embeddings in a single thread that owns the GPU. Each stage serves the videos
+round robin, so a long video does not stall the rest of the corpus.
+"""
+import functools
+import json
+import multiprocessing
+import os
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from . import preprocessing_manifest
+from .embeddings import embeddings_processing, frame_embeddings_store
+from .embeddings.embeddings_generator import Embedder
+from .frame_extraction import frames_manifest, frames_processing, video_decoder
+from .utils import VIDEO_PATH, ANNOTATIONS_PATH, FRAMES_PATH, PHRASES_ID, FACIAL_EXPRESSIONS_ID, \
+    PREPROCESS_STAGE_LIMITS, FRAME_MAX_HEIGHT
+
+STAGE_EXTRACT = "extract"
+STAGE_PHRASES = "phrases"
+STAGE_CROP = "crop"
+STAGE_EMBED = "embed"
+PROCESS_STAGES = (STAGE_EXTRACT, STAGE_PHRASES)
+
+EXTRACT_WORKER_MEMORY = 512 * 1024 ** 2  # bytes used by an extraction worker, mostly frames waiting to be written
+EXTRACT_CHUNK_SIZE = 32  # facial expressions annotations decoded by each extraction task
+
+# Completion records of the facial expressions annotations, see preprocessing_manifest
+FACIAL_EXPRESSIONS_STAGES = preprocessing_manifest.FACIAL_EXPRESSIONS_STAGES
+
+
+def available_memory():
+    """ Memory available to new processes, in bytes """
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+
+
+def default_stage_limits():
+    """ Concurrency limit of each stage, from the available cores and memory. ffmpeg decodes with several threads,
+        so the extraction stages take half of the cores. """
+    extraction_workers = max(1, min((os.cpu_count() or 1) // 2, available_memory() // EXTRACT_WORKER_MEMORY))
+    return {
+        STAGE_EXTRACT: extraction_workers,
+        STAGE_PHRASES: max(1, extraction_workers // 2),
+        STAGE_CROP: frames_processing.CROP_THREAD_COUNT,
+        STAGE_EMBED: 1,
+    }
+
+
+def parse_stage_limits(limits):
+    """ Parse stage limits given as "stage=limit,..." (e.g. "extract=4,crop=8"), the others keep their default """
+    stage_limits = default_stage_limits()
+    for item in filter(None, limits.split(",")):
+        stage, _, limit = item.partition("=")
+        if stage.strip() not in stage_limits:
+            raise ValueError(f"Unknown pre-processing stage {stage}, expected one of {', '.join(stage_limits)}")
+        stage_limits[stage.strip()] = max(1, int(limit))
+    return stage_limits
+
+
+class FairQueue:
+    """ Queue of the tasks of many videos, which are served round robin """
+
+    def __init__(self):
+        self.queues = OrderedDict()
+
+    def push(self, video_id, task):
+        self.queues.setdefault(video_id, deque()).append(task)
+
+    def pop(self):
+        """ Pop the next task of the video that was served the longest time ago """
+        video_id, queue = self.queues.popitem(last=False)
+        task = queue.popleft()
+        if queue:
+            self.queues[video_id] = queue
+        return task
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+
+class Task:
+    def __init__(self, stage, video_id, function, args, callback=None):
+        self.stage = stage
+        self.video_id = video_id
+        self.function = function
+        self.args = args
+        self.callback = callback
+
+
+class PreprocessingScheduler:
+    """ Runs the tasks of many videos, respecting the concurrency limit of each stage.
+        The worker processes are forked when the scheduler is created, so it must be created before loading the
+        models or starting other threads. """
+
+    def __init__(self, stage_limits=None):
+        self.stage_limits = stage_limits or default_stage_limits()
+        self.queues = {stage: FairQueue() for stage in self.stage_limits}
+        self.running = {}
+        self.running_count = {stage: 0 for stage in self.stage_limits}
+
+        processes_count = sum(self.stage_limits[stage] for stage in PROCESS_STAGES)
+        self.processes = ProcessPoolExecutor(max_workers=processes_count,
+                                             mp_context=multiprocessing.get_context("fork"))
+        self.processes.submit(os.getpid).result()
+
+    def submit(self, stage, video_id, function, *args, callback=None):
+        """ Queue a task. The callback is called with the task's result in the scheduler's thread, so it can
+            update shared state and submit the next tasks of the video. """
+        self.queues[stage].push(video_id, Task(stage, video_id, function, args, callback))
+
+    def run(self):
+        """ Run the queued tasks, and the ones they submit, until all of them finished """
+        print("Pre-processing stage limits:", self.stage_limits, flush=True)
+
+        threads_count = sum(limit for stage, limit in self.stage_limits.items() if stage not in PROCESS_STAGES)
+        with self.processes, ThreadPoolExecutor(max_workers=threads_count) as threads:
+            while any(self.queues.values()) or self.running:
+                for stage, queue in self.queues.items():
+                    while queue and self.running_count[stage] < self.stage_limits[stage]:
+                        task = queue.pop()
+                        executor = self.processes if stage in PROCESS_STAGES else threads
+                        self.running[executor.submit(task.function, *task.args)] = task
+                        self.running_count[stage] += 1
+
+                done, _ = wait(self.running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self.finish(future)
+
+    def finish(self, future):
+        task = self.running.pop(future)
+        self.running_count[task.stage] -= 1
+
+        try:
+            result = future.result()
+        except Exception as e:
+            # The video's next stages are not run, so it is picked up again by the next pre-processing
+            print(task.video_id, "||", task.stage, "Failed:", e, flush=True)
+            return
+
+        if task.callback is not None:
+            task.callback(result)
+
+
+class VideoPipeline:
+    """ Submits the stages of the pre-processing of one video as the previous ones finish.
+        Only the annotations whose stages didn't finish with the same inputs are processed (see
+        preprocessing_manifest), so an interrupted pre-processing resumes where it stopped. """
+
+    def __init__(self, scheduler, video, embedder, frames_embeddings):
+        self.scheduler = scheduler
+        self.video_path = os.path.join(VIDEO_PATH, video)
+        self.video_id, _ = os.path.splitext(video)
+        self.annotation_path = os.path.join(ANNOTATIONS_PATH, f"{self.video_id}.json")
+        self.phrases_dir = os.path.join(FRAMES_PATH, PHRASES_ID, self.video_id)
+        self.facial_expressions_dir = os.path.join(FRAMES_PATH, FACIAL_EXPRESSIONS_ID, self.video_id)
+        self.embedder = embedder
+        self.frames_embeddings = frames_embeddings
+        self.pending_tasks = 0
+        self.extract_fingerprints = {}
+        self.embed_fingerprints = {}
+        self.pending_embeddings = set()
+
+    def start(self):
+        if not os.path.exists(self.annotation_path):
+            return
+
+        with open(self.annotation_path, "r") as f:
+            annotations = json.load(f)
+
+        video_fingerprint = preprocessing_manifest.file_fingerprint(self.video_path)
+        self.start_phrases(annotations.get(PHRASES_ID, {}).get("annotations", []), video_fingerprint)
+        self.start_facial_expressions(annotations.get(FACIAL_EXPRESSIONS_ID, {}).get("annotations", []),
+                                      video_fingerprint)
+
+    def start_phrases(self, phrases, video_fingerprint):
+        fingerprints = {phrase["annotation_id"]: preprocessing_manifest.fingerprint(
+            video_fingerprint, phrase["start_time"], phrase["end_time"], FRAME_MAX_HEIGHT) for phrase in phrases}
+
+        if os.path.isdir(self.phrases_dir):
+            preprocessing_manifest.adopt_units(self.video_id, preprocessing_manifest.STAGE_PHRASES, fingerprints)
+        preprocessing_manifest.start_stage(self.video_id, preprocessing_manifest.STAGE_PHRASES)
+
+        stale_phrases = preprocessing_manifest.stale_units(self.video_id, preprocessing_manifest.STAGE_PHRASES,
+                                                           fingerprints)
+        if not stale_phrases:
+            return
+
+        os.makedirs(self.phrases_dir, exist_ok=True)
+        completed = {annotation_id: fingerprints[annotation_id] for annotation_id in stale_phrases}
+        self.scheduler.submit(STAGE_PHRASES, self.video_id, frames_processing.extract_phrases_frames,
+                              self.video_path, self.phrases_dir, self.annotation_path, stale_phrases,
+                              callback=lambda _: preprocessing_manifest.mark_completed(
+                                  self.video_id, preprocessing_manifest.STAGE_PHRASES, completed))
+
+    def start_facial_expressions(self, facial_expressions, video_fingerprint):
+        for annotation in facial_expressions:
+            annotation_id = annotation["annotation_id"]
+            self.extract_fingerprints[annotation_id] = preprocessing_manifest.extract_fingerprint(video_fingerprint,
+                                                                                                  annotation)
+            self.embed_fingerprints[annotation_id] = preprocessing_manifest.embed_fingerprint(
+                self.extract_fingerprints[annotation_id], self.embedder.model_id)
+
+        # Videos pre-processed before the completion records existed were finished if they have their embeddings
+        if os.path.isdir(self.facial_expressions_dir) and \
+                all(self.video_id in embeddings for embeddings in self.frames_embeddings):
+            preprocessing_manifest.adopt_units(self.video_id, preprocessing_manifest.STAGE_EXTRACT,
+                                               self.extract_fingerprints)
+            preprocessing_manifest.adopt_units(self.video_id, preprocessing_manifest.STAGE_CROP,
+                                               self.extract_fingerprints)
+            preprocessing_manifest.adopt_units(self.video_id, preprocessing_manifest.STAGE_EMBED,
+                                               self.embed_fingerprints)
+        for stage in FACIAL_EXPRESSIONS_STAGES:
+            preprocessing_manifest.start_stage(self.video_id, stage)
+
+        self.delete_removed_annotations()
+
+        # The frames are cropped in place, so the annotations whose cropping didn't finish are extracted again
+        stale_annotations = preprocessing_manifest.stale_units(self.video_id, preprocessing_manifest.STAGE_CROP,
+                                                               self.extract_fingerprints)
+        self.pending_embeddings = set(stale_annotations) | set(preprocessing_manifest.stale_units(
+            self.video_id, preprocessing_manifest.STAGE_EMBED, self.embed_fingerprints))
+
+        if stale_annotations:
+            os.makedirs(self.facial_expressions_dir, exist_ok=True)
+            self.submit_extraction([annotation for annotation in facial_expressions
+                                    if annotation["annotation_id"] in stale_annotations])
+        elif self.pending_embeddings:
+            self.submit_embeddings()
+
+    def delete_removed_annotations(self):
+        """ Delete the frames and embeddings of the annotations that were pre-processed but no longer exist """
+        removed_annotations = set()
+        for stage in FACIAL_EXPRESSIONS_STAGES:
+            removed_annotations.update(preprocessing_manifest.completed_units(self.video_id, stage))
+        removed_annotations.difference_update(self.extract_fingerprints)
+
+        if not removed_annotations:
+            return
+
+        for annotation_id in removed_annotations:
+            frames_processing.delete_frames(self.video_id, annotation_id)
+        for embeddings in self.frames_embeddings:
+            embeddings.delete_many([(self.video_id, annotation_id) for annotation_id in removed_annotations])
+
+        frame_embeddings_store.delete_annotations(self.video_id, removed_annotations)
+        preprocessing_manifest.forget_units(self.video_id, FACIAL_EXPRESSIONS_STAGES, removed_annotations)
+
+    def submit_extraction(self, facial_expressions):
+        facial_expressions = sorted(facial_expressions, key=lambda annotation: int(annotation["start_time"]))
+
+        # The frames of partially pre-processed annotations are replaced
+        for annotation in facial_expressions:
+            frames_processing.delete_frames(self.video_id, annotation["annotation_id"])
+
+        # Recorded in the manifest before the workers start, so they only read it
+        geometry = frames_processing.frames_geometry(self.video_path, reuse=False)
+        sampling = frames_processing.frames_sampling(self.video_path, reuse=False)
+
+        # Chunks of annotations close in time, so each chunk is decoded in a single short pass
+        for i in range(0, len(facial_expressions), EXTRACT_CHUNK_SIZE):
+            self.pending_tasks += 1
+            self.scheduler.submit(STAGE_EXTRACT, self.video_id, video_decoder.extract_annotations_frames,
+                                  self.video_path, facial_expressions[i:i + EXTRACT_CHUNK_SIZE],
+                                  self.facial_expressions_dir, geometry, sampling, callback=self.extracted)
+
+    def extracted(self, result):
+        frames_paths, frames_timestamps, frames_weights = result
+        frames_manifest.update_annotations_frames(self.video_id, frames_paths, frames_timestamps, frames_weights)
+        preprocessing_manifest.mark_completed(self.video_id, preprocessing_manifest.STAGE_EXTRACT, {
+            annotation_id: self.extract_fingerprints[annotation_id] for annotation_id in frames_paths})
+
+        for annotation_id, images_paths in frames_paths.items():
+            self.pending_tasks += 1
+            self.scheduler.submit(STAGE_CROP, self.video_id, frames_processing.crop_facial_expression_frames,
+                                  self.video_id, annotation_id, images_paths, frames_timestamps[annotation_id],
+                                  callback=functools.partial(self.cropped, annotation_id))
+
+        self.task_finished()
+
+    def cropped(self, annotation_id, cropped):
+        # Annotations whose cropping failed keep their uncropped frames until the next pre-processing
+        if cropped:
+            preprocessing_manifest.mark_completed(self.video_id, preprocessing_manifest.STAGE_CROP,
+                                                  {annotation_id: self.extract_fingerprints[annotation_id]})
+        self.task_finished()
+
+    def task_finished(self):
+        self.pending_tasks -= 1
+        if self.pending_tasks == 0:
+            self.submit_embeddings()
+
+    def submit_embeddings(self):
+        self.scheduler.submit(STAGE_EMBED, self.video_id, embeddings_processing.generate_video_frames_embeddings,
+                              self.video_id, self.embedder, sorted(self.pending_embeddings), callback=self.embedded)
+
+    def embedded(self, video_embeddings):
+        embeddings_processing.save_video_frames_embeddings(self.frames_embeddings, self.video_id, video_embeddings,
+                                                           self.pending_embeddings)
+
+        # Recorded once the embeddings are saved, so they are generated again if the pre-processing stops before
+        preprocessing_manifest.mark_completed(self.video_id, preprocessing_manifest.STAGE_EMBED, {
+            annotation_id: self.embed_fingerprints[annotation_id] for annotation_id in self.pending_embeddings})
+        print(self.video_id, "|| Frame embeddings generated", flush=True)
+
+
+def preprocess_videos(stage_limits=None):
+    """ Extract the frames of all the videos and generate their embeddings, processing many videos concurrently """
+    if stage_limits is None:
+        stage_limits = parse_stage_limits(PREPROCESS_STAGE_LIMITS)
+
+    scheduler = PreprocessingScheduler(stage_limits)
+    frames_embeddings = embeddings_processing.load_frames_embeddings()
+
+    # Initialize the Embeddings Generator using the GPU
+    embedder = Embedder(check_gpu=True)
+
+    for video in sorted(os.listdir(VIDEO_PATH)):
+        if video.startswith("."):
+            continue
+        VideoPipeline(scheduler, video, embedder, frames_embeddings).start()
+
+    scheduler.run()
+    print("Frame embeddings generated", flush=True)
+
+    embeddings_processing.generate_annotations_embeddings(embedder)
+    print("Annotations embeddings generated", flush=True)
@@ -4,22 +4,20 @@ import os
 import re
 from collections import OrderedDict
 from datetime import datetime as dt
-from sklearn.decomposition import PCA
-from sklearn.manifold import TSNE
 import numpy as np
 
 from flask import (
     Blueprint, flash, redirect, render_template, request, session, url_for
 )
-from sklearn.preprocessing import StandardScaler
 
-from .embeddings import embeddings_processing
-from .utils import embedder, opensearch, CPU_Unpickler, FRAMES_PATH, FACIAL_EXPRESSIONS_ID, PHRASES_ID, \
-    ANNOTATIONS_PATH, AVERAGE_FRAMES_EMBEDDINGS_FILE, BASE_FRAMES_EMBEDDINGS_FILE, BEST_FRAMES_EMBEDDINGS_FILE, \
-    SUMMED_FRAMES_EMBEDDINGS_FILE, ALL_FRAMES_EMBEDDINGS_FILE
+from .embeddings import vector_store
+from .embeddings.query_batcher import query_batcher
+from .embeddings.query_cache import query_cache
+from .frame_extraction import frame_sampling, frame_store
+from .utils import embedder, opensearch, FRAMES_PATH, FACIAL_EXPRESSIONS_ID, PHRASES_ID, ANNOTATIONS_PATH, \
+    N_FRAMES_TO_DISPLAY
 
 N_RESULTS = 10
-N_FRAMES_TO_DISPLAY = 6
 
 bp = Blueprint('query', __name__)
 
@@ -104,8 +102,7 @@ def videos_results():
         videos_info[video_id]['first_annotation'] = first_annotation
 
         # Get the first frame of the first annotation to display in the results page
-        frames_path = os.path.join(FRAMES_PATH, search_mode, video_id, first_annotation)
-        frames[video_id] = os.listdir(frames_path)[0]
+        frames[video_id] = frame_store.list_frames(search_mode, video_id, first_annotation)[0]
 
     if request.method == "POST":
         selected_video = request.form.get("selected_video")
@@ -137,8 +134,7 @@ def clips_results(video):
 
     # Collect information about the retrieved video segments
     for annotation_id in query_results:
-        frames_path = os.path.join(FRAMES_PATH, search_mode, video, annotation_id)
-        frames[annotation_id] = os.listdir(frames_path)
+        frames[annotation_id] = frame_store.list_frames(search_mode, video, annotation_id)
 
         converted_start_time = str(datetime.timedelta(seconds=int(query_results[annotation_id]["start_time"]) // 1000))
         converted_end_time = str(datetime.timedelta(seconds=int(query_results[annotation_id]["end_time"]) // 1000))
@@ -183,9 +179,7 @@ def thesaurus_results(video_id, annotation_id):
     # Collect information about the retrieved video segments
     for video in search_results:
         for annotation_id in search_results[video]:
-            frames_path = os.path.join(FRAMES_PATH, search_mode, video, annotation_id)
-
-            frames[video + "_" + annotation_id] = os.listdir(frames_path)
+            frames[video + "_" + annotation_id] = frame_store.list_frames(search_mode, video, annotation_id)
 
             converted_start_time = str(
                 datetime.timedelta(seconds=int(search_results[video][annotation_id]["start_time"]) // 1000))
@@ -210,51 +204,58 @@ def thesaurus_results(video_id, annotation_id):
                            frames_info=frames_info, search_mode=search_mode, video=video_id)
 
 
+def generate_query_embeddings(query_input):
+    """ Get the embedding of a query. The embeddings module imports torch, so it is only imported once there is a
+    query, and the web application starts without loading it """
+    from .embeddings import embeddings_processing
+    return embeddings_processing.generate_query_embeddings(query_input, embedder)
+
+
 def query_frames_embeddings(query_input):
     """ Get the results of the query using the frames embeddings """
-    query_embedding = embeddings_processing.generate_query_embeddings(query_input, embedder)
+    query_embedding = generate_query_embeddings(query_input)
     search_results = opensearch.knn_query(query_embedding.tolist(), N_RESULTS)
     return set_query_results(search_results, query_input)
 
 
 def query_average_frames_embeddings(query_input):
     """ Get the results of the query using the average of the frames embeddings """
-    query_embedding = embeddings_processing.generate_query_embeddings(query_input, embedder)
+    query_embedding = generate_query_embeddings(query_input)
     search_results = opensearch.knn_query_average(query_embedding.tolist(), N_RESULTS)
     return set_query_results(search_results, query_input)
 
 
 def query_best_frame_embedding(query_input):
     """ Get the results of the query using the best frame embedding """
-    query_embedding = embeddings_processing.generate_query_embeddings(query_input, embedder)
+    query_embedding = generate_query_embeddings(query_input)
     search_results = opensearch.knn_query_best(query_embedding.tolist(), N_RESULTS)
     return set_query_results(search_results, query_input)
 
 
 def query_summed_frames_embeddings(query_input):
     """ Get the results of the query using the summed frames embeddings """
-    query_embedding = embeddings_processing.generate_query_embeddings(query_input, embedder)
+    query_embedding = generate_query_embeddings(query_input)
     search_results = opensearch.knn_query_summed(query_embedding.tolist(), N_RESULTS)
     return set_query_results(search_results, query_input)
 
 
 def query_all_frames_embeddings(query_input):
     """ Get the results of the query using all frames embeddings """
-    query_embedding = embeddings_processing.generate_query_embeddings(query_input, embedder)
+    query_embedding = generate_query_embeddings(query_input)
     search_results = opensearch.knn_query_all(query_embedding.tolist(), N_RESULTS)
     return set_query_results(search_results, query_input)
 
 
 def query_combined_frames_embeddings(query_input):
     """ Get the results of the query using the combined frames embeddings """
-    query_embedding = embeddings_processing.generate_query_embeddings(query_input, embedder)
+    query_embedding = generate_query_embeddings(query_input)
     search_results = opensearch.knn_query_combined(query_embedding.tolist(), N_RESULTS)
     return set_query_results(search_results, query_input)
 
 
 def query_annotations_embeddings(query_input):
     """ Get the results of the query using the annotations embeddings """
-    query_embedding = embeddings_processing.generate_query_embeddings(query_input, embedder)
+    query_embedding = generate_query_embeddings(query_input)
     search_results = opensearch.knn_query_annotations(query_embedding.tolist(), N_RESULTS)
     return set_query_results(search_results, query_input)
 
@@ -264,39 +265,33 @@ def query_thesaurus(video_id, annotation_id):
 
     selected_field = session.get('selected_field')
     if selected_field == 1:  # Base Frames Embeddings
-        with open(BASE_FRAMES_EMBEDDINGS_FILE, "rb") as f:
-            base_frame_embeddings = CPU_Unpickler(f).load()
-        embedding = base_frame_embeddings[video_id][annotation_id].tolist()
+        frame_embeddings = vector_store.open_store(vector_store.BASE_FRAMES_EMBEDDINGS)
+        embedding = frame_embeddings.get(video_id, annotation_id).tolist()
         search_results = opensearch.knn_query(embedding, N_RESULTS)
         print(f"Searching using Base Frames Embeddings...")
     elif selected_field == 2:  # Average Frames Embeddings
-        with open(AVERAGE_FRAMES_EMBEDDINGS_FILE, "rb") as f:
-            average_frame_embeddings = CPU_Unpickler(f).load()
-        embedding = average_frame_embeddings[video_id][annotation_id].tolist()
+        frame_embeddings = vector_store.open_store(vector_store.AVERAGE_FRAMES_EMBEDDINGS)
+        embedding = frame_embeddings.get(video_id, annotation_id).tolist()
         search_results = opensearch.knn_query_average(embedding, N_RESULTS)
         print(f"Searching using Average Frames Embeddings...")
     elif selected_field == 3:  # Best Frame Embeddings
-        with open(BEST_FRAMES_EMBEDDINGS_FILE, "rb") as f:
-            best_frame_embeddings = CPU_Unpickler(f).load()
-        embedding = best_frame_embeddings[video_id][annotation_id].tolist()
+        frame_embeddings = vector_store.open_store(vector_store.BEST_FRAMES_EMBEDDINGS)
+        embedding = frame_embeddings.get(video_id, annotation_id).tolist()
         search_results = opensearch.knn_query_best(embedding, N_RESULTS)
         print(f"Searching using Best Frame Embeddings...")
     elif selected_field == 4:  # Summed Frames Embeddings
-        with open(SUMMED_FRAMES_EMBEDDINGS_FILE, "rb") as f:
-            summed_frame_embeddings = CPU_Unpickler(f).load()
-        embedding = summed_frame_embeddings[video_id][annotation_id].tolist()
+        frame_embeddings = vector_store.open_store(vector_store.SUMMED_FRAMES_EMBEDDINGS)
+        embedding = frame_embeddings.get(video_id, annotation_id).tolist()
         search_results = opensearch.knn_query_summed(embedding, N_RESULTS)
         print(f"Searching using Summed Frames Embeddings...")
     elif selected_field == 5:  # All Frames Embeddings
-        with open(ALL_FRAMES_EMBEDDINGS_FILE, "rb") as f:
-            all_frame_embeddings = CPU_Unpickler(f).load()
-        embedding = all_frame_embeddings[video_id][annotation_id].tolist()
+        frame_embeddings = vector_store.open_store(vector_store.ALL_FRAMES_EMBEDDINGS)
+        embedding = frame_embeddings.get(video_id, annotation_id).tolist()
         search_results = opensearch.knn_query_all(embedding, N_RESULTS)
         print(f"Searching using All Frames Embeddings...")
     else :  # Combined Frames Embeddings or Annotations Embeddings or True Expression
-        with open(AVERAGE_FRAMES_EMBEDDINGS_FILE, "rb") as f:
-            average_frame_embeddings = CPU_Unpickler(f).load()
-        embedding = average_frame_embeddings[video_id][annotation_id].tolist()
+        frame_embeddings = vector_store.open_store(vector_store.AVERAGE_FRAMES_EMBEDDINGS)
+        embedding = frame_embeddings.get(video_id, annotation_id).tolist()
         search_results = opensearch.knn_query_average(embedding, N_RESULTS)
 
     annotation_value = None
@@ -426,26 +421,20 @@ def get_frames_to_display(frames, n_frames=N_FRAMES_TO_DISPLAY):
     """ Get the frames to display """
     frames_to_display = {}
 
-    # Display only #num_frames_to_display frames of each expression
+    # Display only #num_frames_to_display frames of each expression, the ones with a thumbnail
     for expression, all_frames in frames.items():
-
-        # Calculate the step size
-        if len(all_frames) <= n_frames:
-            step_size = 1
-        else:
-            step_size = (len(all_frames) - 1) // n_frames + 1
-
-        # Select frames to display
-        frames_to_display[expression] = all_frames[::step_size]
-
-        # Ensure that only num_frames_to_display frames are selected
-        frames_to_display[expression] = frames_to_display[expression][:n_frames]
+        frames_to_display[expression] = frame_sampling.select_display_frames(all_frames, n_frames)
 
     return frames_to_display
 
 
 def get_results_tsne(results_embeddings):
     """ Get the 2D coordinates of the results using t-SNE """
+    # Imported here, scikit-learn takes a while to import and is only used to plot the results
+    from sklearn.decomposition import PCA
+    from sklearn.manifold import TSNE
+    from sklearn.preprocessing import StandardScaler
+
     # Standardize the embeddings
     scaler = StandardScaler()
     results_embeddings = scaler.fit_transform(results_embeddings)
@@ -466,6 +455,18 @@ def get_results_tsne(results_embeddings):
     return embeddings_2d
 
 
+@bp.route("/query_cache_stats")
+def query_cache_stats():
+    """ Get the hit rates of the query embeddings cache of this process """
+    return query_cache.stats()
+
+
+@bp.route("/query_batcher_stats")
+def query_batcher_stats():
+    """ Get the queue depth, batch sizes and waits of the query encoding batcher of this process """
+    return query_batcher.stats()
+
+
 @bp.route("/update_annotation_rating", methods=["POST"])
 def update_annotation_rating():
     """ Update the rating of an annotation in the session variable """
@@ -0,0 +1,13 @@
+from flask import Blueprint
+
+from app.utils import embedder, opensearch
+
+bp = Blueprint('readiness', __name__)
+
+
+@bp.route('/ready')
+def ready():
+    """ Reports whether the encoder is loaded and warm, with status 503 until it is, so the deployment only sends
+        queries to a worker once they won't wait for the model to load. """
+    status = {"encoder": embedder.lazy_state, "opensearch": opensearch.lazy_state}
+    return status, 200 if embedder.lazy_state == "ready" else 503
@@ -0,0 +1,45 @@
+""" Pre-fork production server of the web application, as a gunicorn configuration.
+
+Loads the encoder once, in the master process, freezes it (inference only, weights in shared memory) and then forks
+the workers, which share its weights instead of each loading its own copy. The objects loaded before the fork are also
+moved out of the garbage collector's reach, so collecting in a worker doesn't copy their pages.
+
+Usage: gunicorn -c app/serve.py app:app (see SERVE_BIND, SERVE_WORKERS and SERVE_PRELOAD in utils.py)
+"""
+import gc
+import os
+
+import torch
+
+from app.utils import embedder, SERVE_BIND, SERVE_WORKERS, SERVE_THREADS, SERVE_PRELOAD
+
+bind = SERVE_BIND
+workers = SERVE_WORKERS or len(os.sched_getaffinity(0))
+# With more than one thread the requests of a worker are served concurrently, and their queries encoded in batches
+worker_class = "gthread" if SERVE_THREADS > 1 else "sync"
+threads = SERVE_THREADS
+timeout = 120
+preload_app = True
+
+
+def worker_threads():
+    """ Threads each worker runs the model on, so the workers together use each core once """
+    return max(1, len(os.sched_getaffinity(0)) // workers)
+
+
+def when_ready(server):
+    if SERVE_PRELOAD:
+        # A single thread in the master, the forked workers can't use its thread pools
+        torch.set_num_threads(1)
+        torch.set_grad_enabled(False)
+        embedder.lazy_load().freeze()
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    torch.set_num_threads(worker_threads())
+    torch.set_grad_enabled(False)
+    if SERVE_PRELOAD:
+        embedder.after_fork()
+    else:
+        embedder.lazy_load()
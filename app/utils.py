@@ -1,9 +1,8 @@
 # Description: This file contains the global variables, constants and functions used throughout the application.
 import io
 import pickle
-import torch
 import os
-from app.embeddings import embeddings_processing
+import threading
 from app.opensearch.opensearch import LGPOpenSearch
 
 # Constants
@@ -14,6 +13,71 @@ ANNOTATIONS_PATH = "app/static/videofiles/annotations"  # sys.argv[4]
 FRAMES_PATH = "app/static/videofiles/frames"  # sys.argv[5]
 EMBEDDINGS_PATH = "app/embeddings"  # sys.argv[6]
 CAPTIONS_PATH = "app/static/videofiles/captions"
+PERSON_BOXES_PATH = "app/static/videofiles/person_boxes"
+THUMBNAILS_PATH = "app/static/videofiles/thumbnails"
+MANIFESTS_PATH = "app/static/videofiles/manifests"
+
+OBJECT_DETECTOR_ENV_PATH = "python_environments/object_detectors_env"
+OBJECT_DETECTOR_SOCKET_PATH = os.getenv("OBJECT_DETECTOR_SOCKET_PATH", "/tmp/slvideo_object_detector.sock")
+# "files" extracts the frames to PNG files and crops and encodes them from disk, "streaming" decodes, crops and
+# encodes the frames in memory and only saves the frames displayed by the web application, at a reduced size
+FRAME_PIPELINE_MODE = os.getenv("FRAME_PIPELINE_MODE", "files")
+N_FRAMES_TO_DISPLAY = 6
+DISPLAY_FRAME_SIZE = 256  # maximum width and height of the thumbnails of the frames shown by the web application
+# The frames are downscaled to this height while being decoded (0 keeps the video's resolution). The signer fills most
+# of the frame, so it keeps enough detail for the cropping models while the crops stay above the encoder's 224px input
+FRAME_MAX_HEIGHT = int(os.getenv("FRAME_MAX_HEIGHT", "720"))
+# Frames of each facial expression kept while decoding: "all", "fps:<frames per second>", "uniform:<number of frames>",
+# "scene:<difference threshold>" or "motion:<difference threshold>" (see frame_extraction/frame_sampling.py)
+FRAME_SAMPLING = os.getenv("FRAME_SAMPLING", "all")
+# Consecutive kept frames of a facial expression whose perceptual hashes differ in at most this many bits (out of 64)
+# are collapsed into one frame weighted by the frames it stands for, so they are cropped and encoded once. -1, the
+# default, keeps every frame, as the frames and embeddings of existing setups were generated (see
+# frame_extraction/frame_dedup.py)
+FRAME_DEDUP_DISTANCE = int(os.getenv("FRAME_DEDUP_DISTANCE", "-1"))
+
+# "png" keeps each extracted frame in its own file, "packed" packs the frames of each annotation in a single file once
+# they are cropped (see frame_extraction/frame_store.py). Frames in either layout can always be read
+FRAME_STORE = os.getenv("FRAME_STORE", "png")
+
+# Frames (or texts) encoded by each call to the model while generating the embeddings
+ENCODE_BATCH_SIZE = int(os.getenv("ENCODE_BATCH_SIZE", "32"))
+
+# "torch" encodes the queries with the PyTorch model, "onnx" with its text tower exported to ONNX and run on
+# onnxruntime, with its weights quantized to int8 if TEXT_QUANTIZE=1 (see embeddings/encoders/onnx_backend.py)
+TEXT_BACKEND = os.getenv("TEXT_BACKEND", "torch")
+TEXT_QUANTIZE = os.getenv("TEXT_QUANTIZE", "1") == "1"
+TEXT_INTRA_OP_THREADS = int(os.getenv("TEXT_INTRA_OP_THREADS", "0"))  # 0 uses up to 4 of the available cores
+
+# Models downloaded from the Hugging Face hub are kept here and, once loaded, loaded offline from here
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", "python_environments/model_cache")
+
+# Load the encoder in a background thread when the application starts, instead of on the first query
+WARMUP = os.getenv("WARMUP", "1") == "1"
+
+# Pre-fork serving (see serve.py): address, worker processes (0 for one per core), threads serving the requests in
+# each worker and whether the encoder is loaded once, before forking the workers, which then share its weights, or by
+# each worker
+SERVE_BIND = os.getenv("SERVE_BIND", "0.0.0.0:5000")
+SERVE_WORKERS = int(os.getenv("SERVE_WORKERS", "0"))
+SERVE_THREADS = int(os.getenv("SERVE_THREADS", "1"))
+SERVE_PRELOAD = os.getenv("SERVE_PRELOAD", "1") == "1"
+
+# Queries whose embeddings are kept in memory by each process (see embeddings/query_cache.py)
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "1024"))
+
+# Concurrent queries are encoded together, in batches of the queries arriving within the window, up to the batch size
+# (see embeddings/query_batcher.py). A window of 0 encodes each query on its own, the default unless the workers serve
+# requests on several threads, as otherwise a worker never has concurrent queries to batch
+QUERY_BATCH_WINDOW_MS = float(os.getenv("QUERY_BATCH_WINDOW_MS", "3" if SERVE_THREADS > 1 else "0"))
+QUERY_BATCH_SIZE = int(os.getenv("QUERY_BATCH_SIZE", "32"))
+
+# Concurrency limits of the pre-processing stages, as "stage=limit,..." (e.g. "extract=4,crop=8"), the stages without
+# a limit are sized from the available cores and memory (see preprocessing_scheduler.py)
+PREPROCESS_STAGE_LIMITS = os.getenv("PREPROCESS_STAGE_LIMITS", "")
+
+# Track the signer's box from a few keyframes per video instead of detecting it in every frame
+CROP_REUSE = os.getenv("CROP_REUSE", "1") == "1"
 
 PHRASES_ID = "LP_P1 transcrição livre"
 FACIAL_EXPRESSIONS_ID = "GLOSA_P1_EXPRESSAO"
@@ -28,18 +92,79 @@ BEST_FRAMES_EMBEDDINGS_FILE = os.path.join(EMBEDDINGS_PATH, 'best_frame_embeddin
 SUMMED_FRAMES_EMBEDDINGS_FILE = os.path.join(EMBEDDINGS_PATH, 'summed_frame_embeddings.json.embeddings')
 ALL_FRAMES_EMBEDDINGS_FILE = os.path.join(EMBEDDINGS_PATH, 'all_frame_embeddings.json.embeddings')
 ANNOTATIONS_EMBEDDINGS_FILE = os.path.join(EMBEDDINGS_PATH, 'annotations_embeddings.json.embeddings')
+# Embeddings of every facial expressions frame, see embeddings/frame_embeddings_store.py
+FRAME_EMBEDDINGS_PATH = os.path.join(EMBEDDINGS_PATH, 'frame_embeddings')
+# Memory mapped stores of the annotations embeddings, replacing the files above, see embeddings/vector_store.py
+VECTORS_PATH = os.path.join(EMBEDDINGS_PATH, 'vectors')
+
+
+
+class LazyInstance:
+    """ Instance created on its first use, or by lazy_load (see warm_up), so the application starts without loading
+        the models or creating the clients. Its attributes are the instance's """
+
+    def __init__(self, create):
+        self.lazy_create = create
+        self.lazy_instance = None
+        self.lazy_state = "cold"  # "cold", "loading", "ready" or "failed"
+        self.lazy_lock = threading.Lock()
+
+    def lazy_load(self):
+        """ Get the instance, creating it if it wasn't yet. The threads using it meanwhile wait for it """
+        if self.lazy_instance is None:
+            with self.lazy_lock:
+                if self.lazy_instance is None:
+                    self.lazy_state = "loading"
+                    try:
+                        self.lazy_instance = self.lazy_create()
+                    except Exception:
+                        self.lazy_state = "failed"
+                        raise
+                    self.lazy_state = "ready"
+        return self.lazy_instance
+
+    def __getattr__(self, name):
+        return getattr(self.lazy_load(), name)
+
+
+def create_embedder():
+    """ Load the encoder and encode a first text, so the first query doesn't wait for the lazy initializations of
+    the model. The embeddings modules import torch, so they are only imported here, when the encoder is loaded """
+    import torch
+    from app.embeddings.embeddings_generator import Embedder
+
+    eb = Embedder(check_gpu=False, text_backend=TEXT_BACKEND, text_quantize=TEXT_QUANTIZE,
+                  text_intra_op_threads=TEXT_INTRA_OP_THREADS, model_cache_dir=MODEL_CACHE_DIR)
+    with torch.no_grad():
+        eb.text_encode("expressão facial")
+    return eb
+
+
+def warm_up():
+    """ Load the encoder and create the OpenSearch client in a background thread """
+
+    def load():
+        for instance in (embedder, opensearch):
+            try:
+                instance.lazy_load()
+            except Exception as e:
+                print("Warm up failed:", e, flush=True)
+
+    threading.Thread(target=load, daemon=True).start()
+
 
 # Embedder to be used throughout the application
-embedder = embeddings_processing.Embedder(check_gpu=False)
+embedder = LazyInstance(create_embedder)
 
 # OpenSearch instance to be used throughout the application
-opensearch = LGPOpenSearch()
+opensearch = LazyInstance(LGPOpenSearch)
 
 
 # Custom Unpickler to load torch tensors on CPU
 class CPU_Unpickler(pickle.Unpickler):
     def find_class(self, module, name):
         if module == 'torch.storage' and name == '_load_from_bytes':
+            import torch
             return lambda b: torch.load(io.BytesIO(b), map_location='cpu')
         else:
             return super().find_class(module, name)
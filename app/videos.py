@@ -4,6 +4,7 @@ import datetime
 
 from flask import Blueprint, render_template, request, redirect, url_for
 
+from app.frame_extraction import frame_store
 from app.utils import VIDEO_PATH, FRAMES_PATH, PHRASES_ID, ANNOTATIONS_PATH, FACIAL_EXPRESSIONS_ID
 
 bp = Blueprint('videos', __name__)
@@ -18,9 +19,8 @@ def list_videos():
         if not video.endswith(".mp4"):
             continue
         video_name = video.split('.')[0]
-        frames_path = os.path.join(FRAMES_PATH, PHRASES_ID, video_name)
-        first_annotation_path = os.listdir(frames_path)[0]
-        thumbnail = os.listdir(os.path.join(frames_path, first_annotation_path))[0]
+        first_annotation_path = frame_store.list_annotations(PHRASES_ID, video_name)[0]
+        thumbnail = frame_store.list_frames(PHRASES_ID, video_name, first_annotation_path)[0]
 
         videos[video_name] = {}
         videos[video_name]['path'] = os.path.join(VIDEO_PATH, video)
@@ -0,0 +1,10 @@
+""" Entry point of the development web server (flask --app app.web run).
+
+Starts loading the models in the background (WARMUP=1) while the application already serves requests, see /ready.
+Only the web server starts the warm up: importing the app package, as the pre-processing does, loads nothing.
+"""
+from app import app
+from app.utils import WARMUP, warm_up
+
+if WARMUP:
+    warm_up()